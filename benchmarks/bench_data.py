@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Time the data layer on synthetic cxi files: opening a run, reading events,
+saving segmasks, masking and downsampling.  Results are saved to JSON, and a
+previous result can be compared against to catch regressions.
+
+Usage:
+    python -m benchmarks.bench_data [--size 1024] [--compression lzf] [--output data.json] [--compare baseline.json]
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import argparse
+import platform
+import tempfile
+import statistics
+
+import h5py
+import numpy as np
+import yaml
+
+from manual_peak_labeler.data  import PeakNetData, CXI_KEY
+from manual_peak_labeler.utils import apply_mask, downsample
+
+from .synthetic import write_synthetic_cxi
+
+def time_call(func, repeat, setup = None):
+    ''' Return the time of each of repeat calls to func, calling setup before
+        each one without timing it.
+    '''
+    time_list = []
+    for _ in range(repeat):
+        if setup is not None: setup()
+
+        t = time.perf_counter()
+        func()
+        time_list.append(time.perf_counter() - t)
+
+    return time_list
+
+
+def summarize(time_list):
+    return { "median" : statistics.median(time_list), "min" : min(time_list), "max" : max(time_list), "repeat" : len(time_list) }
+
+
+def bench_data(path_yaml, num_event, repeat):
+    ''' Return timings of PeakNetData on the run in path_yaml.
+    '''
+    config_data = types.SimpleNamespace(path_yaml = path_yaml, username = "bench", seed = 0)
+    result_dict = {}
+
+    def init():
+        PeakNetData(config_data).close()
+    result_dict["PeakNetData.__init__"] = summarize(time_call(init, repeat))
+
+    with PeakNetData(config_data) as data_manager:
+        # Each event is read once, so the buffer never helps...
+        time_list = []
+        for idx in range(num_event):
+            time_list.extend(time_call(lambda: data_manager.get_img(idx), 1))
+        result_dict["get_img"] = summarize(time_list)
+
+        result_dict["get_img buffered"] = summarize(time_call(lambda: data_manager.get_img(0), repeat))
+
+        # Change one pixel in each buffered label, so that every event is saved...
+        def touch():
+            for idx in range(num_event):
+                _, segmask = data_manager.get_img(idx)
+                segmask[0, 0, 0] = 1 - segmask[0, 0, 0]
+        time_list = time_call(data_manager.save_buffered_segmask, repeat, setup = touch)
+        result_dict["save_buffered_segmask per event"] = summarize([ t / num_event for t in time_list ])
+
+        # Pure numpy kernels on one frame...
+        fh   = data_manager.cxi_dict[data_manager.idx_list[0][0]]["file_handle"]
+        img  = fh.get(CXI_KEY["data"])[0]
+        mask = fh.get(CXI_KEY["mask"])[()]
+        result_dict["apply_mask"] = summarize(time_call(lambda: apply_mask(img, 1 - mask, mask_value = 0), repeat))
+
+        try:
+            result_dict["downsample"] = summarize(time_call(lambda: downsample(img, 4, 4, mask = 1 - mask), repeat))
+        except ImportError as e:
+            print(f"Skip downsample: {e}")
+
+    return result_dict
+
+
+def compare(result_dict, path_baseline, tolerance):
+    ''' Print the ratio of each median to the baseline and return the names
+        slower than tolerance times the baseline.
+    '''
+    with open(path_baseline, 'r') as fh:
+        baseline_dict = json.load(fh)["result"]
+
+    slower_list = []
+    for name, summary in result_dict.items():
+        if not name in baseline_dict: continue
+
+        ratio = summary["median"] / baseline_dict[name]["median"]
+        print(f"{name:<36s} {ratio:6.2f}x baseline")
+        if ratio > tolerance: slower_list.append(name)
+
+    return slower_list
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the data layer on synthetic cxi files.")
+    parser.add_argument("--num_event"     , type = int, default = 32)
+    parser.add_argument("--size"          , type = int, default = 1024, help = "Height and width of an image.")
+    parser.add_argument("--chunks"        , default = "event", help = "'event', 'none' or events per chunk of data and segmask.")
+    parser.add_argument("--compression"   , default = None, help = "HDF5 filter of data and segmask, e.g. lzf or gzip.")
+    parser.add_argument("--level"         , type = int, default = None, help = "Compression level for gzip.")
+    parser.add_argument("--repeat"        , type = int, default = 5)
+    parser.add_argument("--output"        , default = None, help = "Save results to a JSON file.")
+    parser.add_argument("--compare"       , default = None, help = "Compare against results saved by --output.")
+    parser.add_argument("--tolerance"     , type = float, default = 1.2, help = "Fail when a median is slower than this times the baseline.")
+    args = parser.parse_args()
+
+    chunks = None if args.chunks == 'none' else args.chunks
+
+    with tempfile.TemporaryDirectory() as dir_tmp:
+        path_cxi  = os.path.join(dir_tmp, "bench.cxi")
+        path_yaml = os.path.join(dir_tmp, "bench.yaml")
+        write_synthetic_cxi(path_cxi, num_event           = args.num_event,
+                                      size_y              = args.size,
+                                      size_x              = args.size,
+                                      chunks_data         = chunks,
+                                      chunks_segmask      = chunks,
+                                      compression_data    = args.compression,
+                                      compression_segmask = args.compression,
+                                      compression_level   = args.level)
+        with open(path_yaml, 'w') as fh: yaml.safe_dump({ "cxi" : [ path_cxi ] }, fh)
+
+        result_dict = bench_data(path_yaml, args.num_event, args.repeat)
+
+    for name, summary in result_dict.items():
+        print(f"{name:<36s} median {summary['median'] * 1e3:9.3f} ms  (min {summary['min'] * 1e3:.3f}, max {summary['max'] * 1e3:.3f})")
+
+    if args.output is not None:
+        report = {
+            "config" : vars(args),
+            "env"    : { "python" : platform.python_version(), "numpy" : np.__version__, "h5py" : h5py.__version__, "machine" : platform.machine() },
+            "result" : result_dict,
+        }
+        with open(args.output, 'w') as fh: json.dump(report, fh, indent = 2)
+
+    if args.compare is not None:
+        slower_list = compare(result_dict, args.compare, args.tolerance)
+        if len(slower_list) > 0:
+            for name in slower_list: print(f"FAILED: {name} is slower than {args.tolerance}x baseline")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
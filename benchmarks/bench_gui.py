@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Replay key presses and clicks against the labeler window under the offscreen
+Qt platform, and report per-action latency (p50/p99) and memory growth, so
+that GUI hot paths can be benchmarked on a headless box.
+
+A script is a JSON list of steps:
+
+    { "key" : "N" }                          press a shortcut
+    { "click" : [x, y] }                     click at image coordinates
+    { "key" : "N", "repeat" : 10 }           repeat a step
+    { "click" : [x, y], "name" : "point" }   report under a custom name
+
+Clicks go through the active click mode (F, B, D or E), like real clicks.
+Keys that open dialogs, e.g. R or G, can't be replayed.
+
+Usage:
+    python -m benchmarks.bench_gui [--script steps.json] [--rounds 3] [--output gui.json]
+    python -m benchmarks.bench_gui --record steps.json    # Record a session in a real window.
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import argparse
+import tempfile
+import tracemalloc
+
+import numpy as np
+import yaml
+
+from .synthetic import write_synthetic_cxi
+
+def make_default_script(size_y, size_x, num_event):
+    ''' Return a script that covers navigation, overlay toggles, and point,
+        rectangle and polygon labeling.
+    '''
+    rng = np.random.default_rng(0)
+    def get_pos(): return [ int(rng.integers(0, size_x)), int(rng.integers(0, size_y)) ]
+
+    script = [ { "key" : "N", "repeat" : min(num_event - 1, 10) }, { "key" : "P", "repeat" : 5 } ]
+
+    # Point labeling...
+    script.append({ "key" : "F" })
+    script.extend({ "click" : get_pos(), "name" : "click point" } for _ in range(20))
+
+    # Rectangle labeling takes two clicks...
+    script.append({ "key" : "B" })
+    script.extend({ "click" : get_pos(), "name" : "click rectangle" } for _ in range(10))
+
+    # Polygon labeling...
+    script.append({ "key" : "D" })
+    for _ in range(3):
+        x, y = get_pos()
+        for dx, dy in ((0, 0), (30, 0), (30, 30), (0, 30)):
+            script.append({ "click" : [ min(x + dx, size_x - 1), min(y + dy, size_y - 1) ], "name" : "click polygon" })
+        script.append({ "key" : "C" })
+
+    script.extend([ { "key" : "Space" }, { "key" : "S", "repeat" : 10 }, { "key" : "N", "repeat" : 5 } ])
+
+    return script
+
+
+class FakeClickEvent:
+    """
+    The part of a pyqtgraph mouse click event used by the click handlers.
+    """
+
+    def __init__(self, scene_pos):
+        self.scene_pos = scene_pos
+
+    def scenePos(self):
+        return self.scene_pos
+
+    def double(self):
+        return False
+
+
+class Replayer:
+    """
+    Drive a Window through the same slots that real key presses and clicks
+    reach.
+    """
+
+    def __init__(self, app, win):
+        from pyqtgraph.Qt import QtWidgets, QtGui
+
+        self.app = app
+        self.win = win
+
+        # Map key sequences to their shortcuts and buttons...
+        self.trigger_dict = {}
+        for shortcut in win.findChildren(QtWidgets.QShortcut):
+            self.trigger_dict[shortcut.key().toString()] = shortcut.activated.emit
+        for button in win.layout.area.findChildren(QtWidgets.QAbstractButton):
+            if not button.shortcut().isEmpty(): self.trigger_dict[button.shortcut().toString()] = button.click
+
+        self.QKeySequence = QtGui.QKeySequence
+
+        return None
+
+
+    def press(self, key):
+        key = self.QKeySequence(key).toString()
+        if not key in self.trigger_dict: raise KeyError(f"No shortcut is bound to {key}!!!")
+
+        self.trigger_dict[key]()
+
+
+    def click(self, x, y):
+        from pyqtgraph.Qt import QtCore
+
+        # Mouse mode is off...
+        proxy = self.win.proxy_click
+        if proxy is None: return None
+
+        # Aim at the pixel center...
+        vb = self.win.layout.viewer_img.getView().vb
+        scene_pos = vb.mapViewToScene(QtCore.QPointF(x + 0.5, y + 0.5))
+
+        proxy.signalReceived(FakeClickEvent(scene_pos))
+        proxy.flush()
+
+
+    def run_step(self, step):
+        ''' Run one step and return (name, latency), where the latency includes
+            processing the events it posted, e.g. repaints.
+        '''
+        t = time.perf_counter()
+        if "key" in step:
+            self.press(step["key"])
+            name = step.get("name", f"key {step['key']}")
+        else:
+            self.click(*step["click"])
+            name = step.get("name", "click")
+        self.app.processEvents()
+
+        return name, time.perf_counter() - t
+
+
+    def run(self, script):
+        latency_dict = {}
+        for step in script:
+            for _ in range(step.get("repeat", 1)):
+                name, latency = self.run_step(step)
+                latency_dict.setdefault(name, []).append(latency)
+
+        return latency_dict
+
+
+
+
+def record(app, win, path_script):
+    ''' Record shortcuts and clicks of a real session into a script, which is
+        saved when the window closes.
+    '''
+    from pyqtgraph.Qt import QtWidgets
+
+    script = []
+    for shortcut in win.findChildren(QtWidgets.QShortcut):
+        shortcut.activated.connect(lambda key = shortcut.key().toString(): script.append({ "key" : key }))
+    for button in win.layout.area.findChildren(QtWidgets.QAbstractButton):
+        if not button.shortcut().isEmpty():
+            button.clicked.connect(lambda _ = None, key = button.shortcut().toString(): script.append({ "key" : key }))
+
+    vb = win.layout.viewer_img.getView().vb
+    def record_click(event):
+        pos = vb.mapSceneToView(event.scenePos())
+        script.append({ "click" : [ int(pos.x()), int(pos.y()) ] })
+    win.layout.viewer_img.getView().scene().sigMouseClicked.connect(record_click)
+
+    app.exec_()
+
+    with open(path_script, 'w') as fh: json.dump(script, fh, indent = 1)
+    print(f"{len(script)} steps are saved to {path_script}.")
+
+
+def summarize(latency_list):
+    latency_list = np.asarray(latency_list)
+
+    return {
+        "p50"   : float(np.percentile(latency_list, 50)),
+        "p99"   : float(np.percentile(latency_list, 99)),
+        "mean"  : float(latency_list.mean()),
+        "count" : len(latency_list),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Replay key presses and clicks against the labeler window.")
+    parser.add_argument("--script"    , default = None, help = "A JSON script of steps (default: a built-in one).")
+    parser.add_argument("--record"    , default = None, help = "Record a session in a real window into a script.")
+    parser.add_argument("--rounds"    , type = int, default = 3, help = "Replay the script this many times after a warm-up.")
+    parser.add_argument("--num_event" , type = int, default = 16)
+    parser.add_argument("--size"      , type = int, default = 1024, help = "Height and width of an image.")
+    parser.add_argument("--output"    , default = None, help = "Save results to a JSON file.")
+    parser.add_argument("--budget_p99", type = float, default = None, help = "Fail when any p99 exceeds this many ms.")
+    args = parser.parse_args()
+
+    if args.record is None: os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+    from pyqtgraph.Qt import QtWidgets
+    from manual_peak_labeler.layout import MainLayout
+    from manual_peak_labeler.window import Window
+    from manual_peak_labeler.data   import PeakNetData
+
+    with tempfile.TemporaryDirectory() as dir_tmp:
+        path_cxi  = os.path.join(dir_tmp, "bench.cxi")
+        path_yaml = os.path.join(dir_tmp, "bench.yaml")
+        write_synthetic_cxi(path_cxi, num_event = args.num_event, size_y = args.size, size_x = args.size)
+        with open(path_yaml, 'w') as fh: yaml.safe_dump({ "cxi" : [ path_cxi ] }, fh)
+
+        config_data  = types.SimpleNamespace(path_yaml = path_yaml, username = "bench", seed = 0)
+        app          = QtWidgets.QApplication([])
+        data_manager = PeakNetData(config_data)
+        win = Window(MainLayout(), data_manager)
+        win.config()
+        win.show()
+        app.processEvents()
+
+        if args.record is not None:
+            record(app, win, args.record)
+            data_manager.close()
+            return None
+
+        if args.script is None:
+            script = make_default_script(args.size, args.size, args.num_event)
+        else:
+            with open(args.script, 'r') as fh: script = json.load(fh)
+
+        replayer = Replayer(app, win)
+
+        # Warm up caches, e.g. the event buffer, before measuring...
+        replayer.run(script)
+
+        tracemalloc.start()
+        latency_dict = {}
+        memory_list  = []
+        for _ in range(args.rounds):
+            for name, latency_list in replayer.run(script).items():
+                latency_dict.setdefault(name, []).extend(latency_list)
+            memory_list.append(tracemalloc.get_traced_memory()[0])
+        _, memory_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        win.close()
+        data_manager.close()
+
+    result_dict = { name : summarize(latency_list) for name, latency_list in latency_dict.items() }
+    memory_dict = {
+        "growth_per_round" : (memory_list[-1] - memory_list[0]) / max(len(memory_list) - 1, 1),
+        "growth"           : memory_list[-1],
+        "peak"             : memory_peak,
+    }
+
+    for name, summary in result_dict.items():
+        print(f"{name:<20s} p50 {summary['p50'] * 1e3:8.3f} ms  p99 {summary['p99'] * 1e3:8.3f} ms  ({summary['count']} times)")
+    print(f"Memory grows by {memory_dict['growth'] / 2**20:.2f} MB over {args.rounds} rounds "
+          f"({memory_dict['growth_per_round'] / 2**20:.2f} MB per round, peak {memory_dict['peak'] / 2**20:.2f} MB).")
+
+    if args.output is not None:
+        with open(args.output, 'w') as fh: json.dump({ "config" : vars(args), "latency" : result_dict, "memory" : memory_dict }, fh, indent = 2)
+
+    if args.budget_p99 is not None:
+        failure_list = [ name for name, summary in result_dict.items() if summary["p99"] * 1e3 > args.budget_p99 ]
+        if len(failure_list) > 0:
+            for name in failure_list: print(f"FAILED: p99 of {name} exceeds {args.budget_p99} ms")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
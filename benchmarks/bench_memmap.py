@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare reading events through h5py against reading them through a memory map
+of a contiguous, uncompressed data dataset, with a cold and a warm page cache.
+The page cache is dropped per file with posix_fadvise, so no root is needed
+(Linux only).
+
+Usage:
+    python -m benchmarks.bench_memmap [--num_event 64] [--size 1024] [--output memmap.json]
+"""
+
+import os
+import json
+import time
+import argparse
+import tempfile
+import statistics
+
+import yaml
+
+from manual_peak_labeler.data import PeakNetData
+
+from .synthetic import write_synthetic_cxi
+
+class ConfigData:
+    username = "bench"
+    seed     = 0
+
+
+def write_cxi(path_cxi, num_event, size_y, size_x):
+    ''' Write a cxi file whose data is contiguous and uncompressed.
+    '''
+    write_synthetic_cxi(path_cxi, num_event = num_event, size_y = size_y, size_x = size_x, chunks_data = None)
+
+    # Dirty pages can't be dropped...
+    with open(path_cxi, 'rb') as fh: os.fsync(fh.fileno())
+
+
+def drop_page_cache(path):
+    with open(path, 'rb') as fh: os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def time_read(data_manager, path_cxi, is_cold):
+    ''' Return the time of reading every event once.
+    '''
+    time_list = []
+    for idx in range(len(data_manager.idx_list)):
+        if is_cold: drop_page_cache(path_cxi)
+
+        t = time.perf_counter()
+        data_manager.fetch_img(idx)
+        time_list.append(time.perf_counter() - t)
+
+    return time_list
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark memory mapped reads against h5py reads.")
+    parser.add_argument("--num_event", type = int, default = 64)
+    parser.add_argument("--size"     , type = int, default = 1024, help = "Height and width of an image.")
+    parser.add_argument("--output"   , default = None, help = "Save results to a JSON file.")
+    args = parser.parse_args()
+
+    result_dict = {}
+    with tempfile.TemporaryDirectory() as dir_tmp:
+        path_cxi  = os.path.join(dir_tmp, "bench.cxi")
+        path_yaml = os.path.join(dir_tmp, "bench.yaml")
+        write_cxi(path_cxi, args.num_event, args.size, args.size)
+        with open(path_yaml, 'w') as fh: yaml.safe_dump({ "cxi" : [ path_cxi ] }, fh)
+
+        ConfigData.path_yaml = path_yaml
+        for uses_memmap in (False, True):
+            ConfigData.uses_memmap = uses_memmap
+            with PeakNetData(ConfigData) as data_manager:
+                for is_cold in (True, False):
+                    # Warm up the cache before warm reads...
+                    if not is_cold: time_read(data_manager, path_cxi, is_cold = False)
+
+                    time_list = time_read(data_manager, path_cxi, is_cold)
+                    name = f"{'memmap' if uses_memmap else 'h5py'} {'cold' if is_cold else 'warm'}"
+                    result_dict[name] = { "median" : statistics.median(time_list), "min" : min(time_list), "max" : max(time_list) }
+
+    for name, summary in result_dict.items():
+        print(f"{name:<20s} median {summary['median'] * 1e3:8.3f} ms  (min {summary['min'] * 1e3:.3f}, max {summary['max'] * 1e3:.3f})")
+
+    if args.output is not None:
+        with open(args.output, 'w') as fh: json.dump(result_dict, fh, indent = 2)
+
+
+if __name__ == "__main__":
+    main()
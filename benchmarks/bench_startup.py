@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measure import time and time to first frame in fresh interpreters, and fail
+when they exceed a budget or when a headless import pulls in GUI or facility
+dependencies.
+
+Usage:
+    python -m benchmarks.bench_startup [--repeat 5] [--output startup.json]
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+import yaml
+
+from .synthetic import write_synthetic_cxi
+
+# Modules that a headless import of the data layer must not load...
+HEAVY_MODULE_LIST = [ 'PyQt5', 'PyQt6', 'PySide2', 'PySide6', 'pyqtgraph', 'psana', 'skimage' ]
+
+SNIPPET_IMPORT = """
+import sys, time, json
+t = time.perf_counter()
+import {module}
+dt = time.perf_counter() - t
+print(json.dumps({{ "time" : dt, "loaded" : [ m for m in {heavy} if m in sys.modules ] }}))
+"""
+
+SNIPPET_HEADLESS_FRAME = """
+import time, json
+t = time.perf_counter()
+from manual_peak_labeler.data import PeakNetData
+
+class ConfigData:
+    path_yaml = {path_yaml!r}
+    username  = "bench"
+    seed      = 0
+
+with PeakNetData(ConfigData) as data_manager:
+    img, label = data_manager.get_img(0)
+    dt = time.perf_counter() - t
+print(json.dumps({{ "time" : dt }}))
+"""
+
+SNIPPET_GUI_FRAME = """
+import os, time, json
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+t = time.perf_counter()
+from pyqtgraph.Qt import QtWidgets
+from manual_peak_labeler.layout import MainLayout
+from manual_peak_labeler.window import Window
+from manual_peak_labeler.data   import PeakNetData
+
+class ConfigData:
+    path_yaml = {path_yaml!r}
+    username  = "bench"
+    seed      = 0
+
+app = QtWidgets.QApplication([])
+data_manager = PeakNetData(ConfigData)
+win = Window(MainLayout(), data_manager)
+win.config()
+win.show()
+app.processEvents()
+dt = time.perf_counter() - t
+data_manager.close()
+print(json.dumps({{ "time" : dt }}))
+"""
+
+
+def run_snippet(snippet, repeat):
+    ''' Run a snippet in fresh interpreters and collect its reports.
+    '''
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([ os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env.get("PYTHONPATH", "") ])
+
+    report_list = []
+    for _ in range(repeat):
+        output = subprocess.run([ sys.executable, "-c", snippet ], env = env, check = True,
+                                stdout = subprocess.PIPE, universal_newlines = True).stdout
+        report_list.append(json.loads(output.strip().splitlines()[-1]))
+
+    return report_list
+
+
+def summarize(report_list):
+    time_list = [ report["time"] for report in report_list ]
+
+    return { "median" : statistics.median(time_list), "min" : min(time_list), "max" : max(time_list) }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark import time and time to first frame.")
+    parser.add_argument("--repeat"          , type = int  , default = 5)
+    parser.add_argument("--budget_import"   , type = float, default = 1.0, help = "Seconds allowed to import the data layer.")
+    parser.add_argument("--budget_headless" , type = float, default = 2.0, help = "Seconds allowed to get the first frame headless.")
+    parser.add_argument("--budget_gui"      , type = float, default = 5.0, help = "Seconds allowed to show the first frame.")
+    parser.add_argument("--skip_gui"        , action = "store_true", help = "Skip the GUI measurement, e.g. without Qt.")
+    parser.add_argument("--output"          , default = None, help = "Save results to a JSON file.")
+    args = parser.parse_args()
+
+    result_dict  = {}
+    failure_list = []
+
+    # Importing the package and the data layer must stay headless...
+    for module, budget in (("manual_peak_labeler", args.budget_import), ("manual_peak_labeler.data", args.budget_import)):
+        report_list = run_snippet(SNIPPET_IMPORT.format(module = module, heavy = HEAVY_MODULE_LIST), args.repeat)
+        summary = summarize(report_list)
+        summary["loaded"] = report_list[0]["loaded"]
+        result_dict[f"import {module}"] = summary
+
+        if summary["median"] > budget: failure_list.append(f"import {module} takes {summary['median']:.3f} s > {budget} s")
+        if len(summary["loaded"]) > 0: failure_list.append(f"import {module} loads {summary['loaded']}")
+
+    with tempfile.TemporaryDirectory() as dir_tmp:
+        path_cxi  = os.path.join(dir_tmp, "bench.cxi")
+        path_yaml = os.path.join(dir_tmp, "bench.yaml")
+        write_synthetic_cxi(path_cxi, num_event = 4)
+        with open(path_yaml, 'w') as fh: yaml.safe_dump({ "cxi" : [ path_cxi ] }, fh)
+
+        case_list = [ ("first frame headless", SNIPPET_HEADLESS_FRAME, args.budget_headless) ]
+        if not args.skip_gui: case_list.append(("first frame gui", SNIPPET_GUI_FRAME, args.budget_gui))
+
+        for name, snippet, budget in case_list:
+            summary = summarize(run_snippet(snippet.format(path_yaml = path_yaml), args.repeat))
+            result_dict[name] = summary
+
+            if summary["median"] > budget: failure_list.append(f"{name} takes {summary['median']:.3f} s > {budget} s")
+
+    for name, summary in result_dict.items():
+        print(f"{name:<40s} median {summary['median']:8.3f} s  (min {summary['min']:.3f}, max {summary['max']:.3f})")
+
+    if args.output is not None:
+        with open(args.output, 'w') as fh: json.dump(result_dict, fh, indent = 2)
+
+    if len(failure_list) > 0:
+        for failure in failure_list: print(f"FAILED: {failure}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
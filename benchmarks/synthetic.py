@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Generate synthetic cxi files with the layout in CXI_KEY, i.e. data, mask,
+segmask, nPeaks and peak positions, so that benchmarks don't depend on the
+facility filesystem.
+
+Images hold a noisy background with Gaussian peaks, and the mask marks gaps
+between panels and scattered bad pixels.  Part of the events can come with
+labeled peaks.
+"""
+
+import h5py
+import numpy as np
+
+from manual_peak_labeler.data import CXI_KEY
+
+def get_chunks(chunks, shape):
+    ''' Turn a chunking option into h5py chunks: None for contiguous, 'event'
+        for one chunk per event, or an int for that many events per chunk.
+    '''
+    if chunks is None   : return None
+    if chunks == 'event': return (1, ) + tuple(shape[1:])
+
+    return (int(chunks), ) + tuple(shape[1:])
+
+
+def make_mask(size_y, size_x, num_panel_y = 2, num_panel_x = 2, fraction_bad = 1e-3, rng = None):
+    ''' Return a bad pixel mask (1 is bad) with gaps between panels.
+    '''
+    rng  = np.random.default_rng(0) if rng is None else rng
+    mask = np.zeros((size_y, size_x), dtype = 'uint16')
+
+    for i in range(1, num_panel_y): mask[i * size_y // num_panel_y - 2 : i * size_y // num_panel_y + 2, :] = 1
+    for i in range(1, num_panel_x): mask[:, i * size_x // num_panel_x - 2 : i * size_x // num_panel_x + 2] = 1
+
+    mask[rng.random((size_y, size_x)) < fraction_bad] = 1
+
+    return mask
+
+
+def make_event(size_y, size_x, num_peaks, rng, background = 100.0, intensity = 500.0, sigma = 1.2):
+    ''' Return an image with num_peaks Gaussian peaks over a noisy background,
+        along with the peak positions.
+    '''
+    img = rng.normal(background, np.sqrt(background), (size_y, size_x)).astype('float32')
+
+    peak_y = rng.uniform(8, size_y - 8, num_peaks).astype('float32')
+    peak_x = rng.uniform(8, size_x - 8, num_peaks).astype('float32')
+
+    # Paint each peak within a small window...
+    radius = int(np.ceil(3 * sigma))
+    offset = np.arange(-radius, radius + 1)
+    for y, x in zip(peak_y, peak_x):
+        y0, x0 = int(y), int(x)
+        window = np.exp(-((offset[:, None] + y0 - y) ** 2 + (offset[None, :] + x0 - x) ** 2) / (2 * sigma ** 2))
+        img[y0 - radius : y0 + radius + 1, x0 - radius : x0 + radius + 1] += intensity * window
+
+    return img, peak_y, peak_x
+
+
+def write_synthetic_cxi(path_cxi, num_event           = 16,
+                                  size_y              = 512,
+                                  size_x              = 512,
+                                  max_num_peaks       = 50,
+                                  fraction_labeled    = 0.0,
+                                  chunks_data         = 'event',
+                                  chunks_segmask      = 'event',
+                                  compression_data    = None,
+                                  compression_segmask = None,
+                                  compression_level   = None,
+                                  dtype_segmask       = 'int32',
+                                  block_size          = 16,
+                                  seed                = 0):
+    ''' Write a synthetic cxi file.  Events are generated and written in blocks,
+        so memory stays bounded.  The same seed always gives the same file.
+    '''
+    rng = np.random.default_rng(seed)
+
+    num_peaks_list = rng.integers(0, max_num_peaks + 1, num_event).astype('int32')
+    shape = (num_event, size_y, size_x)
+
+    def create(fh, k, chunks, compression, **kwargs):
+        if compression is None: compression_opts = None
+        else                  : compression_opts = compression_level if compression == 'gzip' else None
+
+        return fh.create_dataset(CXI_KEY[k], shape            = shape,
+                                             chunks           = get_chunks(chunks, shape),
+                                             compression      = compression,
+                                             compression_opts = compression_opts,
+                                             **kwargs)
+
+    with h5py.File(path_cxi, 'w') as fh:
+        fh.create_dataset(CXI_KEY["num_peaks"], data = num_peaks_list)
+        fh.create_dataset(CXI_KEY["mask"]     , data = make_mask(size_y, size_x, rng = rng))
+
+        dataset_peak_y  = fh.create_dataset(CXI_KEY["peak_y"], shape = (num_event, max(max_num_peaks, 1)), dtype = 'float32')
+        dataset_peak_x  = fh.create_dataset(CXI_KEY["peak_x"], shape = (num_event, max(max_num_peaks, 1)), dtype = 'float32')
+        dataset_data    = create(fh, "data"   , chunks_data   , compression_data   , dtype = 'float32')
+        dataset_segmask = create(fh, "segmask", chunks_segmask, compression_segmask, dtype = dtype_segmask)
+
+        for event_begin in range(0, num_event, block_size):
+            event_end = min(event_begin + block_size, num_event)
+
+            img_block     = np.zeros((event_end - event_begin, size_y, size_x), dtype = 'float32')
+            segmask_block = np.zeros((event_end - event_begin, size_y, size_x), dtype = dtype_segmask)
+            for i, event_idx in enumerate(range(event_begin, event_end)):
+                num_peaks = num_peaks_list[event_idx]
+                img, peak_y, peak_x = make_event(size_y, size_x, num_peaks, rng)
+
+                img_block[i] = img
+                dataset_peak_y[event_idx, :num_peaks] = peak_y
+                dataset_peak_x[event_idx, :num_peaks] = peak_x
+
+                # Label a 3x3 blob around each peak...
+                if rng.random() < fraction_labeled:
+                    for y, x in zip(peak_y.astype(int), peak_x.astype(int)): segmask_block[i, y - 1 : y + 2, x - 1 : x + 2] = 1
+
+            dataset_data[event_begin:event_end] = img_block
+
+            # Leave unlabeled chunks unallocated like a fresh file...
+            if segmask_block.any(): dataset_segmask[event_begin:event_end] = segmask_block
+
+    return None
@@ -9,6 +9,8 @@ from pyqtgraph.Qt import QtWidgets
 from manual_peak_labeler.layout import MainLayout
 from manual_peak_labeler.window import Window
 from manual_peak_labeler.data   import PeakNetData
+from manual_peak_labeler.server import RemoteData
+from manual_peak_labeler.coordinator import CoordinatorClient, CoordinatedData
 
 import socket
 
@@ -19,8 +21,16 @@ def run(config_data):
     # Layout
     layout = MainLayout()
 
-    # Data
-    data_manager = PeakNetData(config_data)
+    # Data, optionally served by a separate process or shared with other
+    # labelers through a coordinator...
+    uses_server         = getattr(config_data, 'uses_server', False)
+    coordinator_address = getattr(config_data, 'coordinator_address', None)
+    if coordinator_address is not None:
+        data_manager = CoordinatedData(config_data, CoordinatorClient(coordinator_address))
+    elif uses_server:
+        data_manager = RemoteData(config_data)
+    else:
+        data_manager = PeakNetData(config_data)
 
     # Window
     win = Window(layout, data_manager)
@@ -38,8 +48,12 @@ class ConfigData:
         self.kwargs = kwargs
         for k, v in kwargs.items(): setattr(self, k, v)
 
-config_data = ConfigData( path_yaml = "/reg/data/ana03/scratch/cwang31/pf/manual_label.cxic00318_run0123.yaml",
-                          username  = os.environ.get('USER'),
-                          seed      = 0, )
+# Worker processes are spawned, so only run the labeler in the main process...
+if __name__ == "__main__":
+    config_data = ConfigData( path_yaml = "/reg/data/ana03/scratch/cwang31/pf/manual_label.cxic00318_run0123.yaml",
+                              username  = os.environ.get('USER'),
+                              seed      = 0,
+                              uses_server = False,
+                              coordinator_address = None, )
 
-run(config_data)
+    run(config_data)
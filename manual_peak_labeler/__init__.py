@@ -1,9 +1,36 @@
-from . import data, layout, window, utils
+import importlib
 
 __all__ = [
             "data", 
             "layout", 
             "window", 
             "utils",
+            "thumbnail",
+            "gallery",
+            "prefetch",
+            "patch_grid",
+            "rechunk",
+            "server",
+            "coordinator",
+            "autolabel",
+            "report",
+            "perf",
+            "geometry",
+            "propagate",
+            "consensus",
 ]
 
+
+def __getattr__(name):
+    # Import submodules on first access, so that headless scripts don't pay
+    # for Qt and pyqtgraph...
+    if name in __all__:
+        module = importlib.import_module(f".{name}", __name__)
+        globals()[name] = module
+        return module
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Pre-label peaks across a run before hand correction.  Each masked frame has
+its block-wise background subtracted, local maxima above a signal-to-noise
+threshold become peaks, and each peak grows into a small blob in the peak
+layer.  Batches of consecutive frames are processed in a process pool, and
+the main process paints each batch into its segmask with one slab read and
+one slab write, like a propagation.
+
+Usage:
+    python -m manual_peak_labeler.autolabel run.yaml [--snr 6] [--num_workers 8] [--path_geometry geometry.npz]
+"""
+
+import time
+import argparse
+import types
+import numpy as np
+import multiprocessing as mp
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from .data      import PeakNetData, CXI_KEY, open_cxi_readonly, read_masked_img, get_view_dict
+from .propagate import iter_slab
+
+def get_block_stats(img, valid, size_bg):
+    ''' Return the mean and standard deviation of valid pixels in each block
+        of size_bg, along with the image padded to whole blocks and viewed as
+        (num_block_y, size_bg, num_block_x, size_bg).
+    '''
+    size_y, size_x = img.shape
+    pad_y = -size_y % size_bg
+    pad_x = -size_x % size_bg
+    img   = np.pad(img.astype('float32'), ((0, pad_y), (0, pad_x)))
+    valid = np.pad(valid                , ((0, pad_y), (0, pad_x)))
+
+    shape_block = (img.shape[0] // size_bg, size_bg, img.shape[1] // size_bg, size_bg)
+    img_block   = img.reshape(shape_block)
+    valid_block = valid.reshape(shape_block)
+
+    # Averages over valid pixels only...
+    num     = np.maximum(valid_block.sum(axis = (1, 3)), 1)
+    mean    = (img_block * valid_block).sum(axis = (1, 3)) / num
+    mean_sq = (img_block * img_block * valid_block).sum(axis = (1, 3)) / num
+    std     = np.sqrt(np.maximum(mean_sq - mean * mean, 0))
+
+    return mean, std, img_block
+
+
+def get_window_idx(y, x, radius, shape):
+    ''' Return pixel indices of a (2 * radius + 1) square window around each
+        of the N pixels at (y, x), clipped to the image, with the shape of
+        (N, (2 * radius + 1) ** 2).
+    '''
+    offset = np.arange(-radius, radius + 1)
+    offset_y, offset_x = np.meshgrid(offset, offset, indexing = 'ij')
+
+    window_y = np.clip(y[:, None] + offset_y.ravel(), 0, shape[0] - 1)
+    window_x = np.clip(x[:, None] + offset_x.ravel(), 0, shape[1] - 1)
+
+    return window_y, window_x
+
+
+def find_peak_blobs(img, snr_min = 6.0, snr_grow = 3.0, size_bg = 32, size_max = 5, radius = 2):
+    ''' Return a boolean mask of peak blobs in a masked image, where masked
+        pixels are 0.
+
+        - The background and the noise are the mean and the standard deviation
+          of each block of size_bg.
+        - A peak is a local maximum in a window of size_max whose signal to
+          noise ratio against the background exceeds snr_min.
+        - A blob covers pixels within radius of a peak whose signal to noise
+          ratio exceeds snr_grow.
+
+        Only the few pixels above snr_min are examined one window at a time,
+        so the cost is a handful of passes over the image.
+    '''
+    size_y, size_x = img.shape
+    valid = img != 0
+    mean, std, img_block = get_block_stats(img, valid, size_bg)
+
+    # Compare against per block thresholds by broadcasting...
+    threshold   = (mean + snr_min * std)[:, None, :, None]
+    is_bright   = (img_block > threshold).reshape(img_block.shape[0] * size_bg, -1)[:size_y, :size_x] & valid
+    y, x        = np.nonzero(is_bright)
+
+    # Keep local maxima among bright pixels...
+    window_y, window_x = get_window_idx(y, x, size_max // 2, img.shape)
+    is_max = img[y, x] >= img[window_y, window_x].max(axis = 1)
+    y, x   = y[is_max], x[is_max]
+
+    # Grow each peak into pixels bright enough around it...
+    window_y, window_x = get_window_idx(y, x, radius, img.shape)
+    window_y, window_x = window_y.ravel(), window_x.ravel()
+    block_y,  block_x  = window_y // size_bg, window_x // size_bg
+    snr     = (img[window_y, window_x] - mean[block_y, block_x]) / (std[block_y, block_x] + 1e-6)
+    is_grow = (snr > snr_grow) & valid[window_y, window_x]
+
+    is_blob = np.zeros(img.shape, dtype = bool)
+    is_blob[window_y[is_grow], window_x[is_grow]] = True
+    is_blob[y, x] = True
+
+    return is_blob
+
+
+def autolabel_batch(path_cxi, event_begin, event_end, param_dict):
+    ''' Find peak blobs of the consecutive events [event_begin, event_end) in
+        one cxi file.  It runs in a worker process, so the file is opened read
+        only, and the segmask, which the main process writes meanwhile, is
+        never read.  Blobs of the whole batch are returned as packed bits in
+        the layout of the segmask, i.e. panel by panel for panel stacks, each
+        panel with its own background.
+    '''
+    is_blob_list = []
+    with open_cxi_readonly(path_cxi) as fh:
+        view_dict = get_view_dict(fh)
+        for event_idx in range(event_begin, event_end):
+            img = read_masked_img(fh, event_idx, view_dict)
+            if img.ndim == 3:
+                is_blob = np.stack([ find_peak_blobs(panel, **param_dict) for panel in img ])
+            else:
+                is_blob = find_peak_blobs(img, **param_dict)
+
+            is_blob_list.append(is_blob)
+
+    is_blob = np.stack(is_blob_list)
+
+    return path_cxi, event_begin, event_end, is_blob.shape, np.packbits(is_blob)
+
+
+def get_layer_by_name(layer_manager, name):
+    for encode, metadata in layer_manager['layer_metadata'].items():
+        if metadata['name'] == name: return encode
+
+    raise ValueError(f"No layer is named {name}!!!")
+
+
+def autolabel(data_manager, param_dict, layer, overwrites = False, num_workers = None, batch_size = 16, max_pending = None):
+    ''' Label peak blobs of all events of a PeakNetData that holds its cxi
+        files for writing.  At most max_pending batches are in flight, so
+        memory stays bounded.  Return the number of events written.
+    '''
+    if not data_manager.can_write_slab: raise ValueError(f"{type(data_manager).__name__} can't write segmasks as slabs!!!")
+
+    num_workers = mp.cpu_count() if num_workers is None else num_workers
+    max_pending = 2 * num_workers if max_pending is None else max_pending
+
+    # Batches are slabs of consecutive events in one file...
+    key_list   = sorted(set((path_cxi, event_idx) for path_cxi, event_idx, _ in data_manager.idx_list))
+    batch_list = list(iter_slab(key_list, batch_size))
+
+    num_written = 0
+    num_done    = 0
+    t_start     = time.perf_counter()
+    with ProcessPoolExecutor(max_workers = num_workers, mp_context = mp.get_context('spawn')) as executor:
+        pending_set = set()
+        batch_iter  = iter(batch_list)
+        while True:
+            # Keep the pool busy, but not more than that...
+            while len(pending_set) < max_pending:
+                batch = next(batch_iter, None)
+                if batch is None: break
+
+                path_cxi, event_begin, event_end = batch
+                pending_set.add(executor.submit(autolabel_batch, path_cxi, event_begin, event_end, param_dict))
+
+            if len(pending_set) == 0: break
+
+            done_set, pending_set = wait(pending_set, return_when = FIRST_COMPLETED)
+            for future in done_set:
+                path_cxi, event_begin, event_end, shape, is_blob_packed = future.result()
+                is_blob = np.unpackbits(is_blob_packed, count = int(np.prod(shape))).reshape(shape).astype(bool)
+
+                fh      = data_manager.cxi_dict[path_cxi]["file_handle"]
+                dataset = fh.get(CXI_KEY["segmask"])
+                slab    = dataset[event_begin:event_end]
+
+                # Paint in the layout of the file, so panel stacks are never assembled...
+                label = data_manager.from_segmask(slab.copy())
+
+                if overwrites:
+                    data_manager.paint_label(label, data_manager.is_labeled(label, layer), layer, erases = True)
+
+                # Leave pixels labeled otherwise by hand alone...
+                if not data_manager.uses_bitplane: is_blob &= label == 0
+                data_manager.paint_label(label, is_blob, layer)
+
+                slab_new   = data_manager.to_segmask(label, dtype = slab.dtype)
+                is_changed = (slab_new != slab).reshape(len(slab), -1).any(axis = 1)
+                if is_changed.any():
+                    dataset[event_begin:event_end] = slab_new
+                    fh.flush()
+                    num_written += int(is_changed.sum())
+
+                num_done += event_end - event_begin
+                t_elapsed = time.perf_counter() - t_start
+                print(f"{num_done}/{len(key_list)} events are labeled ({num_done / t_elapsed:.1f} frames/s).")
+
+    return num_written
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Pre-label peaks across all events listed in a yaml file.")
+    parser.add_argument("path_yaml", help = "The yaml file listing cxi files.")
+    parser.add_argument("--snr"        , type = float, default = 6.0, help = "Signal to noise ratio of a peak.")
+    parser.add_argument("--snr_grow"   , type = float, default = 3.0, help = "Signal to noise ratio of pixels grown into a blob.")
+    parser.add_argument("--size_bg"    , type = int  , default = 32 , help = "Block size of the local background.")
+    parser.add_argument("--size_max"   , type = int  , default = 5  , help = "Window size of a local maximum.")
+    parser.add_argument("--radius"     , type = int  , default = 2  , help = "Largest distance of a blob pixel from its peak.")
+    parser.add_argument("--layer"      , default = "peak", help = "Name of the layer to label.")
+    parser.add_argument("--overwrite"  , action = "store_true", help = "Clear the layer before labeling.")
+    parser.add_argument("--num_workers", type = int  , default = None)
+    parser.add_argument("--batch_size" , type = int  , default = 16, help = "Number of events per job.")
+    parser.add_argument("--bitplane"   , action = "store_true", help = "Edit labels as bit planes, see PeakNetData.")
+    parser.add_argument("--path_geometry", default = None, help = "The geometry npz of panel stacks, see geometry.py.")
+    parser.add_argument("--dir_geometry" , default = None, help = "Where index maps are cached.")
+    args = parser.parse_args()
+
+    config_data = types.SimpleNamespace(path_yaml     = args.path_yaml,
+                                        username      = "autolabel",
+                                        seed          = 0,
+                                        uses_bitplane = args.bitplane,
+                                        path_geometry = args.path_geometry,
+                                        dir_geometry  = args.dir_geometry)
+    param_dict  = { "snr_min" : args.snr, "snr_grow" : args.snr_grow, "size_bg" : args.size_bg, "size_max" : args.size_max, "radius" : args.radius }
+
+    with PeakNetData(config_data) as data_manager:
+        layer = get_layer_by_name(data_manager.layer_manager, args.layer)
+
+        t_start     = time.perf_counter()
+        num_written = autolabel(data_manager, param_dict, layer, args.overwrite, args.num_workers, args.batch_size)
+        t_elapsed   = time.perf_counter() - t_start
+
+    print(f"{num_written} segmasks are written in {t_elapsed:.1f} s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Merge segmasks of the same events labeled by several annotators into copies
+of one cxi file.  Blocks of events are streamed from every annotator file in
+a process pool, and for each block:
+
+- a pixel takes the layer with the most (weighted) votes if they exceed a
+  fraction of all votes, otherwise the background,
+- the agreement of each event and layer is the pooled pairwise IoU, i.e.
+  labels shared by pairs of annotators over labels of either of them, summed
+  over all pairs.
+
+The consensus is written to a new segmask dataset, and agreement scores next
+to it.
+
+Usage:
+    python -m manual_peak_labeler.consensus a.cxi b.cxi c.cxi --output merged.cxi [--weights 1 1 2]
+"""
+
+import os
+import time
+import json
+import argparse
+import h5py
+import numpy as np
+import multiprocessing as mp
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from .data    import CXI_KEY, open_cxi_readonly, get_default_layer_manager
+from .rechunk import create_rechunked_dataset
+
+def merge_block(path_cxi_list, event_begin, event_end, weight_list, num_layer, threshold):
+    ''' Merge segmasks of a block of events.  It runs in a worker process and
+        reads one annotator at a time, so only the votes of the block stay in
+        memory.  Return the consensus and per-layer agreement of each event.
+    '''
+    num_annotator = len(path_cxi_list)
+    uses_weight   = len(set(weight_list)) > 1
+
+    count = None
+    vote  = None
+    for path_cxi, weight in zip(path_cxi_list, weight_list):
+        with open_cxi_readonly(path_cxi) as fh:
+            segmask = fh.get(CXI_KEY["segmask"])[event_begin:event_end]
+
+        if count is None:
+            dtype_count = 'uint8' if num_annotator < 256 else 'uint16'
+            count = np.zeros((num_layer - 1, ) + segmask.shape, dtype = dtype_count)
+            if uses_weight: vote = np.zeros(count.shape, dtype = 'float32')
+
+        # Layer 0 is the background, which is never voted for...
+        for layer in range(1, num_layer):
+            is_labeled = segmask == layer
+            count[layer - 1] += is_labeled
+            if uses_weight: vote[layer - 1] += weight * is_labeled
+
+    if not uses_weight: vote = count
+
+    # Pick the layer with the most votes, if there are enough of them...
+    layer_best  = vote.argmax(axis = 0)
+    vote_best   = np.take_along_axis(vote, layer_best[None,], axis = 0)[0]
+    is_accepted = vote_best > threshold * sum(weight_list)
+    dtype_out   = 'uint8' if num_layer <= 256 else 'uint16'
+    consensus   = np.where(is_accepted, layer_best + 1, 0).astype(dtype_out)
+
+    # Sum pairwise intersections and unions from a histogram of per-pixel
+    # counts, i.e. k annotators on a pixel share it in k * (k - 1) / 2 pairs...
+    def get_num_pair(n): return n * (n - 1) / 2
+
+    k = np.arange(num_annotator + 1)
+    num_inter_per_k = get_num_pair(k)
+    num_union_per_k = get_num_pair(num_annotator) - get_num_pair(num_annotator - k)
+
+    num_inter = np.zeros(count.shape[:2], dtype = 'float64')
+    num_union = np.zeros(count.shape[:2], dtype = 'float64')
+    for layer in range(num_layer - 1):
+        for i in range(count.shape[1]):
+            hist = np.bincount(count[layer, i].ravel(), minlength = num_annotator + 1)
+            num_inter[layer, i] = hist @ num_inter_per_k
+            num_union[layer, i] = hist @ num_union_per_k
+
+    # Nothing labeled by anyone is a perfect agreement...
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        agreement       = np.where(num_union > 0, num_inter / num_union, 1.0).T
+        num_union_total = num_union.sum(axis = 0)
+        agreement_total = np.where(num_union_total > 0, num_inter.sum(axis = 0) / num_union_total, 1.0)
+
+    return event_begin, consensus, agreement.astype('float32'), agreement_total.astype('float32')
+
+
+def check_annotator_files(path_cxi_list):
+    ''' Return the shape and the dtype of segmasks, which must match across
+        annotator files.
+    '''
+    shape_dtype_list = []
+    for path_cxi in path_cxi_list:
+        with open_cxi_readonly(path_cxi) as fh:
+            dataset = fh.get(CXI_KEY["segmask"])
+            shape_dtype_list.append((dataset.shape, dataset.dtype))
+
+    for path_cxi, shape_dtype in zip(path_cxi_list, shape_dtype_list):
+        if shape_dtype[0] != shape_dtype_list[0][0]:
+            raise ValueError(f"Segmasks of {path_cxi} {shape_dtype[0]} and {path_cxi_list[0]} {shape_dtype_list[0][0]} don't match!!!")
+
+    return shape_dtype_list[0]
+
+
+def merge(path_cxi_list, path_out, weight_list = None, layer_manager = None, threshold = 0.5,
+          key_out = "/entry_1/data_1/segmask_consensus", key_agreement = "/entry_1/result_1/agreement",
+          overwrites = False, num_workers = None, block_size = 4, max_pending = None):
+    ''' Merge segmasks of all events in annotator files into a new dataset
+        key_out of path_out, which is created unless it exists.  At most
+        max_pending blocks are in flight, so memory stays bounded.  Return
+        the per-layer and overall agreement of every event.
+    '''
+    if os.path.abspath(path_out) in [ os.path.abspath(path_cxi) for path_cxi in path_cxi_list ]:
+        raise ValueError(f"{path_out} is an annotator file, merge into another file!!!")
+
+    weight_list = [ 1.0 ] * len(path_cxi_list) if weight_list is None else [ float(weight) for weight in weight_list ]
+    if len(weight_list) != len(path_cxi_list):
+        raise ValueError(f"{len(weight_list)} weights are given for {len(path_cxi_list)} annotators!!!")
+
+    layer_manager = get_default_layer_manager() if layer_manager is None else layer_manager
+    num_layer     = max(layer_manager['layer_order']) + 1
+
+    num_workers = mp.cpu_count() if num_workers is None else num_workers
+    max_pending = 2 * num_workers if max_pending is None else max_pending
+
+    shape, dtype = check_annotator_files(path_cxi_list)
+    num_event    = shape[0]
+
+    agreement       = np.zeros((num_event, num_layer - 1), dtype = 'float32')
+    agreement_total = np.zeros(num_event, dtype = 'float32')
+
+    with h5py.File(path_out, 'a') as fh_out:
+        for key in (key_out, key_agreement, f"{key_agreement}_total"):
+            if not key in fh_out: continue
+            if not overwrites: raise ValueError(f"{key} exists in {path_out}!!!")
+            del fh_out[key]
+
+        # Lay out the consensus like a rechunked segmask...
+        parent, basename = os.path.split(key_out)
+        with open_cxi_readonly(path_cxi_list[0]) as fh:
+            dataset_out = create_rechunked_dataset(fh_out.require_group(parent), basename, fh.get(CXI_KEY["segmask"]))
+        dataset_out.attrs["annotators"] = [ os.path.abspath(path_cxi) for path_cxi in path_cxi_list ]
+        dataset_out.attrs["weights"]    = weight_list
+        dataset_out.attrs["threshold"]  = threshold
+
+        block_list = [ (event_begin, min(event_begin + block_size, num_event)) for event_begin in range(0, num_event, block_size) ]
+
+        num_done = 0
+        t_start  = time.perf_counter()
+        with ProcessPoolExecutor(max_workers = num_workers, mp_context = mp.get_context('spawn')) as executor:
+            pending_set = set()
+            block_iter  = iter(block_list)
+            while True:
+                while len(pending_set) < max_pending:
+                    block = next(block_iter, None)
+                    if block is None: break
+
+                    pending_set.add(executor.submit(merge_block, path_cxi_list, *block, weight_list, num_layer, threshold))
+
+                if len(pending_set) == 0: break
+
+                done_set, pending_set = wait(pending_set, return_when = FIRST_COMPLETED)
+                for future in done_set:
+                    event_begin, consensus, agreement_block, agreement_total_block = future.result()
+                    event_end = event_begin + len(consensus)
+
+                    dataset_out[event_begin:event_end] = consensus.astype(dtype)
+                    agreement      [event_begin:event_end] = agreement_block
+                    agreement_total[event_begin:event_end] = agreement_total_block
+
+                    num_done += len(consensus)
+                    t_elapsed = time.perf_counter() - t_start
+                    print(f"{num_done}/{num_event} events are merged ({num_done / t_elapsed:.1f} frames/s).")
+
+        layer_name_list = [ layer_manager['layer_metadata'].get(encode, {'name' : str(encode)})['name'] for encode in range(1, num_layer) ]
+        fh_out.create_dataset(key_agreement, data = agreement)
+        fh_out[key_agreement].attrs["layers"] = layer_name_list
+        fh_out.create_dataset(f"{key_agreement}_total", data = agreement_total)
+
+    return agreement, agreement_total
+
+
+def summarize_agreement(agreement, agreement_total, layer_manager = None, num_worst = 10):
+    ''' Return a JSON-friendly summary of agreement scores.
+    '''
+    layer_manager  = get_default_layer_manager() if layer_manager is None else layer_manager
+    layer_metadata = layer_manager['layer_metadata']
+
+    idx_worst = np.argsort(agreement_total, kind = 'stable')[:num_worst]
+    summary = {
+        "num_event"       : len(agreement_total),
+        "mean_agreement"  : float(agreement_total.mean()) if len(agreement_total) > 0 else None,
+        "mean_per_layer"  : { layer_metadata.get(encode, {'name' : str(encode)})['name'] : float(v)
+                              for encode, v in enumerate(agreement.mean(axis = 0), start = 1) },
+        "worst_event"     : { int(event_idx) : float(agreement_total[event_idx]) for event_idx in idx_worst },
+    }
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Merge segmasks of the same events labeled by several annotators.")
+    parser.add_argument("path_cxi_list", nargs = "+", help = "Annotator copies of one cxi file.")
+    parser.add_argument("--output"     , required = True, help = "The file to write the consensus into, created unless it exists.")
+    parser.add_argument("--weights"    , type = float, nargs = "+", default = None, help = "Vote weight of each annotator (default: equal).")
+    parser.add_argument("--threshold"  , type = float, default = 0.5, help = "Fraction of all votes a layer must exceed.")
+    parser.add_argument("--key"        , default = "/entry_1/data_1/segmask_consensus", help = "Dataset of the consensus.")
+    parser.add_argument("--key_agreement", default = "/entry_1/result_1/agreement", help = "Dataset of agreement scores.")
+    parser.add_argument("--overwrite"  , action = "store_true", help = "Replace existing datasets.")
+    parser.add_argument("--num_workers", type = int, default = None)
+    parser.add_argument("--block_size" , type = int, default = 4, help = "Number of events read at a time.")
+    parser.add_argument("--summary"    , default = None, help = "Save a summary of agreement to a JSON file.")
+    args = parser.parse_args()
+
+    t_start = time.perf_counter()
+    agreement, agreement_total = merge(args.path_cxi_list, args.output, args.weights, threshold = args.threshold,
+                                       key_out = args.key, key_agreement = args.key_agreement, overwrites = args.overwrite,
+                                       num_workers = args.num_workers, block_size = args.block_size)
+    t_elapsed = time.perf_counter() - t_start
+
+    summary = summarize_agreement(agreement, agreement_total)
+    print(f"{summary['num_event']} events are merged in {t_elapsed:.1f} s, mean agreement {summary['mean_agreement']:.3f}.")
+    print("Per layer: " + ", ".join(f"{name} {v:.3f}" for name, v in summary["mean_per_layer"].items()))
+    print("Least agreed: " + ", ".join(f"{event_idx} ({v:.3f})" for event_idx, v in summary["worst_event"].items()))
+
+    if args.summary is not None:
+        with open(args.summary, 'w') as fh: json.dump(summary, fh)
+
+
+if __name__ == "__main__":
+    main()
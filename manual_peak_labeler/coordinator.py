@@ -0,0 +1,692 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Coordinate several labelers working on the same run.  A coordinator hands out
+event leases in batches, queues segmask writes, and is the only one that opens
+cxi files for writing.  A writer thread applies queued writes to each cxi file
+in batches sorted by event.
+
+The Coordinator runs in process, e.g. for tests, or behind a local socket:
+
+    python -m manual_peak_labeler.coordinator run.yaml [--port 6021]
+
+Labelers then connect with CoordinatorClient and use CoordinatedData, which
+opens cxi files read only, reads segmasks from the coordinator and sends its
+writes to the coordinator.  All of them must use the same yaml file, as
+events are referred to by index.
+
+Connections are always authenticated.  The authkey is taken from
+MANUAL_PEAK_LABELER_AUTHKEY, otherwise from a file only readable by its owner
+(default: ~/.cache/manual_peak_labeler/coordinator.authkey), which the
+coordinator creates with a random authkey unless either exists.  Share it
+with other labelers, who put it in the same place.
+"""
+
+import os
+import time
+import secrets
+import argparse
+import threading
+import h5py
+import yaml
+import numpy as np
+
+from multiprocessing.connection import Listener, Client, AuthenticationError
+
+from .data import PeakNetData, CXI_KEY, open_cxi_readonly, read_masked_img
+
+# Methods of Coordinator that a client can call...
+COORDINATOR_METHOD_LIST = [ 'get_num_event', 'lease', 'acquire', 'renew', 'release', 'get_owner', 'read_segmask',
+                            'submit', 'flush', 'get_status' ]
+
+# Exceptions sent back to a client by name, any other is a RuntimeError...
+EXCEPTION_DICT = { e.__name__ : e for e in (PermissionError, ValueError, KeyError, IndexError) }
+
+def get_path_authkey():
+    return os.path.join(os.path.expanduser('~'), '.cache', 'manual_peak_labeler', 'coordinator.authkey')
+
+
+def get_authkey(path_authkey = None):
+    ''' Return the authkey from MANUAL_PEAK_LABELER_AUTHKEY or from the file
+        path_authkey, or None if neither exists.
+    '''
+    authkey = os.environ.get('MANUAL_PEAK_LABELER_AUTHKEY', '')
+    if authkey != '': return authkey.encode()
+
+    path_authkey = get_path_authkey() if path_authkey is None else path_authkey
+    if not os.path.exists(path_authkey): return None
+
+    # Refuse keys that anyone else can read, like ssh does...
+    if os.stat(path_authkey).st_mode & 0o077:
+        raise PermissionError(f"{path_authkey} is readable by others, run `chmod 600 {path_authkey}`!!!")
+
+    with open(path_authkey, 'r') as fh:
+        authkey = fh.read().strip()
+
+    return authkey.encode() if authkey != '' else None
+
+
+def create_authkey(path_authkey = None):
+    ''' Save a random authkey to a new file only readable by its owner.
+    '''
+    path_authkey = get_path_authkey() if path_authkey is None else path_authkey
+    os.makedirs(os.path.dirname(os.path.abspath(path_authkey)), exist_ok = True)
+
+    authkey = secrets.token_hex(32)
+    fd = os.open(path_authkey, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as fh:
+        fh.write(authkey)
+
+    return authkey.encode()
+
+
+def open_cxi_writable(path_cxi):
+    ''' Open a cxi file for writing with the same locking flags as readers,
+        as HDF5 refuses to open one file with different flags in one process,
+        e.g. with an in-process coordinator.
+    '''
+    try:
+        fh = h5py.File(path_cxi, 'r+', locking = False)
+    except TypeError:
+        # h5py < 3.5 doesn't know about locking...
+        fh = h5py.File(path_cxi, 'r+')
+
+    return fh
+
+
+def iter_run(write_list):
+    ''' Group sorted (event_idx, segmask) pairs into runs of consecutive events,
+        so that each run is written as one slab.
+    '''
+    run_list = []
+    for event_idx, segmask in write_list:
+        if len(run_list) > 0 and event_idx != run_list[0][0] + len(run_list):
+            yield run_list[0][0], [ segmask for _, segmask in run_list ]
+            run_list = []
+        run_list.append((event_idx, segmask))
+
+    if len(run_list) > 0: yield run_list[0][0], [ segmask for _, segmask in run_list ]
+
+
+
+
+class Coordinator:
+    """
+    Event leases and the single writer of segmasks.
+
+    - A lease lets one user write the segmask of an event.  Leases expire
+      after lease_timeout seconds unless their user renews them.
+    - Events released as done are not handed out again by `lease`, but can
+      still be acquired one by one.
+    - Writes are queued and coalesced per event, then applied every
+      flush_interval seconds or on `flush`.
+    """
+
+    def __init__(self, path_yaml, lease_size = 20, lease_timeout = 1800, flush_interval = 2.0):
+        self.lease_size    = lease_size
+        self.lease_timeout = lease_timeout
+
+        with open(path_yaml, 'r') as fh:
+            config = yaml.safe_load(fh)
+
+        # Open each cxi file once for writing...
+        self.fh_dict  = {}
+        self.key_list = []
+        for path_cxi in config['cxi']:
+            if path_cxi in self.fh_dict: continue
+
+            fh = open_cxi_writable(path_cxi)
+            self.fh_dict[path_cxi] = fh
+
+            num_event = len(fh.get(CXI_KEY["num_peaks"]))
+            self.key_list.extend([ (path_cxi, event_idx) for event_idx in range(num_event) ])
+
+        self.lease_dict  = {}    # idx -> (username, expiry)
+        self.queue_dict  = {}    # idx -> (username, segmask)
+        self.done_set    = set()
+        self.num_written = 0
+
+        self.lock = threading.RLock()
+
+        # Apply queued writes in the background...
+        self.is_running = threading.Event()
+        self.is_running.set()
+        self.writer = threading.Thread(target = self.run_writer, args = (flush_interval, ), daemon = True)
+        self.writer.start()
+
+        return None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+    def close(self):
+        if not self.is_running.is_set(): return None
+
+        self.is_running.clear()
+        self.writer.join()
+
+        with self.lock:
+            self.flush()
+            for path_cxi, fh in self.fh_dict.items():
+                fh.close()
+                print(f"{path_cxi} is closed.")
+
+
+    def run_writer(self, flush_interval):
+        while self.is_running.is_set():
+            time.sleep(flush_interval)
+            self.flush()
+
+
+    ##############
+    ### LEASES ###
+    ##############
+    def get_num_event(self):
+        return len(self.key_list)
+
+
+    def drop_expired(self):
+        now = time.time()
+        for idx, (_, expiry) in list(self.lease_dict.items()):
+            if expiry < now: del self.lease_dict[idx]
+
+
+    def renew(self, username, idx_list):
+        ''' Extend the leases of a user on events being worked on, and drop
+            expired ones.  Return the idx list of extended leases.
+        '''
+        with self.lock:
+            self.drop_expired()
+
+            expiry           = time.time() + self.lease_timeout
+            idx_renewed_list = []
+            for idx in idx_list:
+                owner, _ = self.lease_dict.get(idx, (None, None))
+                if owner != username: continue
+
+                self.lease_dict[idx] = (username, expiry)
+                idx_renewed_list.append(idx)
+
+        return idx_renewed_list
+
+
+    def lease(self, username, num_event = None):
+        ''' Lease a batch of events that are neither leased nor done.  Return
+            the idx list of the batch.
+        '''
+        num_event = self.lease_size if num_event is None else num_event
+
+        with self.lock:
+            self.drop_expired()
+
+            expiry   = time.time() + self.lease_timeout
+            idx_list = []
+            for idx in range(len(self.key_list)):
+                if len(idx_list) == num_event: break
+                if idx in self.lease_dict or idx in self.done_set: continue
+
+                self.lease_dict[idx] = (username, expiry)
+                idx_list.append(idx)
+
+        return idx_list
+
+
+    def acquire(self, username, idx):
+        ''' Lease one event unless another user holds it.  Return whether the
+            user holds it.
+        '''
+        with self.lock:
+            self.drop_expired()
+
+            owner, _ = self.lease_dict.get(idx, (username, None))
+            if owner != username: return False
+
+            self.lease_dict[idx] = (username, time.time() + self.lease_timeout)
+
+        return True
+
+
+    def get_owner(self, idx):
+        ''' Return the user holding the lease on an event, or None.
+        '''
+        with self.lock:
+            owner, expiry = self.lease_dict.get(idx, (None, None))
+            if owner is not None and expiry < time.time(): return None
+
+        return owner
+
+
+    def release(self, username, idx_list = None, is_done = True):
+        ''' Release leases of a user, all of them by default.
+        '''
+        with self.lock:
+            if idx_list is None: idx_list = [ idx for idx, (owner, _) in self.lease_dict.items() if owner == username ]
+
+            for idx in idx_list:
+                owner, _ = self.lease_dict.get(idx, (None, None))
+                if owner != username: continue
+
+                del self.lease_dict[idx]
+                if is_done: self.done_set.add(idx)
+
+        return None
+
+
+    ##############
+    ### WRITER ###
+    ##############
+    def read_segmask(self, idx):
+        ''' Return the segmask of an event as it is going to be in the file,
+            i.e. the pending write, otherwise the one in the file.  Reads take
+            the lock, so they never see a file in the middle of a write,
+            unlike readers holding their own handles.
+        '''
+        with self.lock:
+            if idx in self.queue_dict:
+                _, segmask = self.queue_dict[idx]
+            else:
+                path_cxi, event_idx = self.key_list[idx]
+                segmask = self.fh_dict[path_cxi].get(CXI_KEY["segmask"])[event_idx]
+
+        return segmask
+
+
+    def submit(self, username, idx, segmask):
+        ''' Queue the segmask of an event for writing.  Return whether it
+            differs from what is going to be in the file.
+        '''
+        with self.lock:
+            if np.array_equal(self.read_segmask(idx), segmask): return False
+
+            if not self.acquire(username, idx):
+                owner, _ = self.lease_dict[idx]
+                raise PermissionError(f"Event {idx} is leased by {owner}.")
+
+            self.queue_dict[idx] = (username, segmask)
+
+        return True
+
+
+    def flush(self):
+        ''' Apply queued writes file by file, sorted by event.  Return the
+            number of events written.
+        '''
+        with self.lock:
+            queue_dict, self.queue_dict = self.queue_dict, {}
+
+            write_dict = {}
+            for idx, (_, segmask) in queue_dict.items():
+                path_cxi, event_idx = self.key_list[idx]
+                write_dict.setdefault(path_cxi, []).append((event_idx, segmask))
+
+            num_written = 0
+            for path_cxi, write_list in write_dict.items():
+                write_list.sort(key = lambda x: x[0])
+
+                fh      = self.fh_dict[path_cxi]
+                dataset = fh.get(CXI_KEY["segmask"])
+                try:
+                    for event_begin, segmask_list in iter_run(write_list):
+                        dataset[event_begin:event_begin + len(segmask_list)] = np.stack(segmask_list)
+                    fh.flush()
+                    num_written += len(write_list)
+
+                except Exception as e:
+                    print(f"Oops!!! Errors occurs while writing segmasks to {path_cxi}: {e}")
+
+                    # Retry later unless newer writes have come in...
+                    for idx, (username, segmask) in queue_dict.items():
+                        if self.key_list[idx][0] == path_cxi and not idx in self.queue_dict:
+                            self.queue_dict[idx] = (username, segmask)
+
+            self.num_written += num_written
+
+        return num_written
+
+
+    def get_status(self):
+        with self.lock:
+            owner_dict = {}
+            for owner, _ in self.lease_dict.values(): owner_dict[owner] = owner_dict.get(owner, 0) + 1
+
+            status = {
+                "num_event"   : len(self.key_list),
+                "num_leased"  : owner_dict,
+                "num_done"    : len(self.done_set),
+                "num_queued"  : len(self.queue_dict),
+                "num_written" : self.num_written,
+            }
+
+        return status
+
+
+
+
+class CoordinatorClient:
+    """
+    A connection to a coordinator process with the same interface as
+    Coordinator.
+    """
+
+    def __init__(self, address = ('localhost', 6021), authkey = None, path_authkey = None):
+        authkey = get_authkey(path_authkey) if authkey is None else authkey
+        if authkey is None:
+            raise ValueError(f"No authkey is found, set MANUAL_PEAK_LABELER_AUTHKEY or save the one of the coordinator "
+                             f"to {get_path_authkey() if path_authkey is None else path_authkey}!!!")
+
+        self.conn = Client(address, authkey = authkey)
+        self.lock = threading.Lock()
+
+        return None
+
+
+    def call(self, method, *args):
+        with self.lock:
+            self.conn.send((method, args))
+            is_ok, result = self.conn.recv()
+
+        # Errors come back as (type name, message)...
+        if not is_ok:
+            name, msg = result
+            if name in EXCEPTION_DICT: raise EXCEPTION_DICT[name](msg)
+            raise RuntimeError(f"{name}: {msg}")
+
+        return result
+
+
+    def get_num_event(self):
+        return self.call('get_num_event')
+
+
+    def lease(self, username, num_event = None):
+        return self.call('lease', username, num_event)
+
+
+    def acquire(self, username, idx):
+        return self.call('acquire', username, idx)
+
+
+    def renew(self, username, idx_list):
+        return self.call('renew', username, idx_list)
+
+
+    def release(self, username, idx_list = None, is_done = True):
+        return self.call('release', username, idx_list, is_done)
+
+
+    def get_owner(self, idx):
+        return self.call('get_owner', idx)
+
+
+    def read_segmask(self, idx):
+        return self.call('read_segmask', idx)
+
+
+    def submit(self, username, idx, segmask):
+        return self.call('submit', username, idx, segmask)
+
+
+    def flush(self):
+        return self.call('flush')
+
+
+    def get_status(self):
+        return self.call('get_status')
+
+
+    def close(self):
+        self.conn.close()
+
+
+
+
+class CoordinatedData(PeakNetData):
+    """
+    A PeakNetData that never opens cxi files for writing.
+
+    - Segmasks are read from the coordinator, which writes them under the
+      readers, while images and masks are read from files opened read only.
+    - Navigation walks through batches leased from the coordinator, and the
+      next batch is leased past the end of the last one.  Events leased by
+      someone else in the meantime are skipped.
+    - The first edit of an event, or saving it, leases it, and a conflict
+      with another user is reported right away.  Only the shown event and
+      events with unsaved edits are renewed.
+    - Leaving an event without unsaved edits releases it as done.  Saved
+      events are released unless shown, and `close` releases all leases.
+    - Saved segmasks are submitted to the coordinator, which needs a lease on
+      each event.  Events that fail to be saved stay in the buffer.
+    """
+
+    can_write_slab = False
+
+    # Leases being worked on are renewed at most this often...
+    lease_interval = 60.0
+
+    def __init__(self, config_data, coordinator):
+        self.coordinator = coordinator
+
+        # Leased events in the order they are visited, and the visited one...
+        self.batch_list = []
+        self.pos_batch  = -1
+
+        # The shown event, and events with unsaved edits, i.e. being worked on...
+        self.idx_shown    = None
+        self.edited_set   = set()
+        self.time_renewed = 0.0
+
+        super().__init__(config_data)
+
+        num_event = self.coordinator.get_num_event()
+        if num_event != len(self.idx_list):
+            raise ValueError(f"The coordinator has {num_event} events, but {self.path_yaml} has {len(self.idx_list)}!!!")
+
+        return None
+
+
+    def open_cxi(self, path_cxi):
+        return open_cxi_readonly(path_cxi)
+
+
+    def close(self):
+        # Nobody else could label held events until they expire...
+        try:
+            self.release(is_done = False)
+        except (OSError, EOFError) as e:
+            print(f"Oops!!! Leases can't be released: {e}")
+
+        super().close()
+
+
+    def load_event(self, idx):
+        path_cxi, event_idx, fh = self.idx_list[idx]
+
+        img     = read_masked_img(fh, event_idx, self.cxi_dict[path_cxi]["view_dict"])
+        segmask = self.coordinator.read_segmask(idx)
+
+        return img, segmask
+
+
+    ##################
+    ### NAVIGATION ###
+    ##################
+    def get_first_idx(self):
+        idx = self.get_next_idx(None)
+
+        return 0 if idx is None else idx
+
+
+    def get_next_idx(self, idx):
+        ''' Return the next leased event, leasing a new batch if needed.
+        '''
+        pos = self.pos_batch + 1
+        while True:
+            if not pos < len(self.batch_list):
+                idx_leased_list = self.lease()
+                if len(idx_leased_list) == 0:
+                    print(f"No more events to lease.")
+                    return idx
+
+                self.batch_list.extend(idx_leased_list)
+
+            idx_next = self.batch_list[pos]
+            if self.coordinator.get_owner(idx_next) in (None, self.username): break
+            pos += 1
+
+        self.pos_batch = pos
+
+        return idx_next
+
+
+    def get_prev_idx(self, idx):
+        if self.pos_batch < 1: return idx
+
+        self.pos_batch -= 1
+
+        return self.batch_list[self.pos_batch]
+
+
+    ##############
+    ### LEASES ###
+    ##############
+    def get_img(self, idx):
+        # Leaving an event without unsaved edits means it is done...
+        if self.idx_shown is not None and self.idx_shown != idx and not self.idx_shown in self.edited_set:
+            self.release([ self.idx_shown ], is_done = True)
+
+        self.idx_shown = idx
+        self.renew()
+
+        return super().get_img(idx)
+
+
+    def begin_edit(self, idx):
+        ''' Lease an event on its first edit, and warn if another user holds
+            it.
+        '''
+        if idx in self.edited_set: return self.renew()
+        self.edited_set.add(idx)
+
+        if self.coordinator.acquire(self.username, idx): return None
+
+        owner = self.coordinator.get_owner(idx)
+        print(f"Warning!!! Event {idx} is leased by {owner}, so its labels can't be saved until the lease is released or expires.")
+
+
+    def renew(self):
+        ''' Renew leases being worked on at most every lease_interval.
+        '''
+        now = time.time()
+        if now - self.time_renewed < self.lease_interval: return None
+        self.time_renewed = now
+
+        idx_list = sorted(self.edited_set | ({ self.idx_shown } if self.idx_shown is not None else set()))
+        self.coordinator.renew(self.username, idx_list)
+
+
+    def lease(self, num_event = None):
+        return self.coordinator.lease(self.username, num_event)
+
+
+    def release(self, idx_list = None, is_done = True):
+        return self.coordinator.release(self.username, idx_list, is_done)
+
+
+    def write_segmask(self, idx, label, flushes = True):
+        # The coordinator flushes its own batches...
+        segmask = self.to_segmask(label, dtype = self.get_segmask_dtype(idx))
+        segmask = self.to_panel_segmask(idx, segmask)
+
+        is_written = self.coordinator.submit(self.username, idx, segmask)
+
+        # Writes to events nobody works on, e.g. by propagation, keep no lease...
+        if is_written and idx != self.idx_shown and not idx in self.edited_set: self.release([ idx ], is_done = False)
+
+        return is_written
+
+
+    def flush_segmask(self):
+        self.coordinator.flush()
+
+
+    def save_buffered_segmask(self):
+        saved_idx_list = super().save_buffered_segmask()
+
+        # Saving means on disk...
+        if len(saved_idx_list) > 0: self.coordinator.flush()
+
+        # Only events that failed to be saved still have unsaved edits...
+        idx_saved_set   = self.edited_set - set(self.buffer_dict.keys())
+        self.edited_set = self.edited_set & set(self.buffer_dict.keys())
+        self.release(sorted(idx_saved_set - { self.idx_shown }), is_done = True)
+
+        return saved_idx_list
+
+
+
+
+def serve_client(coordinator, conn):
+    while True:
+        try:
+            method, args = conn.recv()
+        except (EOFError, OSError):
+            break
+
+        try:
+            if not method in COORDINATOR_METHOD_LIST: raise ValueError(f"Unknown method {method}")
+            conn.send((True, getattr(coordinator, method)(*args)))
+        except Exception as e:
+            # Never send objects that a client would have to unpickle as code...
+            conn.send((False, (type(e).__name__, str(e))))
+
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Coordinate several labelers working on the same run.")
+    parser.add_argument("path_yaml", help = "The yaml file listing cxi files, shared by all labelers.")
+    parser.add_argument("--host"          , default = "localhost")
+    parser.add_argument("--port"          , type = int  , default = 6021)
+    parser.add_argument("--lease_size"    , type = int  , default = 20, help = "Number of events in a lease batch.")
+    parser.add_argument("--lease_timeout" , type = float, default = 1800, help = "Seconds before an idle lease expires.")
+    parser.add_argument("--flush_interval", type = float, default = 2.0, help = "Seconds between batched writes.")
+    parser.add_argument("--authkey_file"  , default = None, help = "The authkey file, created with a random authkey unless it exists.")
+    args = parser.parse_args()
+
+    # Never serve without authentication, as every message is unpickled...
+    authkey = get_authkey(args.authkey_file)
+    if authkey is None:
+        path_authkey = get_path_authkey() if args.authkey_file is None else args.authkey_file
+        authkey = create_authkey(path_authkey)
+        print(f"A random authkey is saved to {path_authkey}.  Share it with other labelers, who save it to the same "
+              f"place with `chmod 600` or set MANUAL_PEAK_LABELER_AUTHKEY to it.")
+
+    coordinator = Coordinator(args.path_yaml, args.lease_size, args.lease_timeout, args.flush_interval)
+    print(f"Coordinating {coordinator.get_num_event()} events on {args.host}:{args.port}.")
+
+    try:
+        with Listener((args.host, args.port), authkey = authkey) as listener:
+            while True:
+                # A client with a wrong authkey is turned away, not fatal...
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, OSError, EOFError) as e:
+                    print(f"Oops!!! A connection is refused: {e}")
+                    continue
+
+                threading.Thread(target = serve_client, args = (coordinator, conn), daemon = True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        coordinator.close()
+
+
+if __name__ == "__main__":
+    main()
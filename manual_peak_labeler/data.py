@@ -8,18 +8,147 @@ import numpy as np
 import random
 from datetime import datetime
 
-from .utils  import set_seed, apply_mask
+from .         import perf
+from .geometry import get_index_map, load_geometry, assemble, disassemble
+from .utils    import set_seed, set_event_seed, get_event_key, apply_mask, build_color_lut, \
+                      get_layer_bits, segmask_to_bitplane, bitplane_to_segmask, remap_bitplane, build_bitplane_color_lut
+
+# Define the keys used to access a cxi file...
+CXI_KEY = {
+    "num_peaks" : "/entry_1/result_1/nPeaks",
+    "peak_y"    : "/entry_1/result_1/peakYPosRaw",
+    "peak_x"    : "/entry_1/result_1/peakXPosRaw",
+    "data"      : "/entry_1/data_1/data",
+    "mask"      : "/entry_1/data_1/mask",
+    "segmask"   : "/entry_1/data_1/segmask",
+}
+
+
+def get_default_layer_manager():
+    layer_metadata = {
+        0 : {'name' : 'background' , 'color' : '#FFFFFF'},
+        1 : {'name' : 'peak'       , 'color' : '#FF0000'},
+        2 : {'name' : 'do not pred', 'color' : '#0000FF'},
+        3 : {'name' : 'bad pixel'  , 'color' : '#00FF00'},
+    }
+    layer_order  = [0, 1, 2, 3]
+    layer_active = 1
+    layer_manager = { 'layer_metadata' : layer_metadata,
+                      'layer_order'    : layer_order,
+                      'layer_active'   : layer_active, }
+
+    return layer_manager
+
+
+def open_cxi_readonly(path_cxi):
+    ''' Open a cxi file for reading only.  HDF5 file locking is turned off
+        so that worker processes can read a file that the labeler holds in
+        r+ mode.
+    '''
+    try:
+        fh = h5py.File(path_cxi, 'r', locking = False)
+    except TypeError:
+        # h5py < 3.5 doesn't know about locking...
+        fh = h5py.File(path_cxi, 'r')
+
+    return fh
+
+
+def get_memmap(dataset):
+    ''' Return a read-only memory map of a dataset that is stored contiguous
+        and unfiltered, so that the OS pages it in without any extra copy.
+        Return None for any other layout, which is read through h5py.
+    '''
+    if dataset.chunks is not None                    : return None
+    if getattr(dataset, 'is_virtual', False)         : return None
+    if getattr(dataset, 'external', None) is not None: return None
+    if dataset.dtype.kind not in 'biufc'             : return None
+
+    # Nothing has been written yet...
+    offset = dataset.id.get_offset()
+    if offset is None: return None
+
+    return np.memmap(dataset.file.filename, dtype = dataset.dtype, mode = 'r', offset = offset, shape = dataset.shape)
+
+
+def get_view_dict(fh):
+    ''' Return memory maps of the data and the mask of a cxi file whenever
+        their layouts allow.  The segmask is always accessed through h5py, as
+        it is written by the labeler.
+    '''
+    view_dict = {}
+    for k in ("data", "mask"):
+        view = get_memmap(fh.get(CXI_KEY[k]))
+        if view is not None: view_dict[k] = view
+
+    return view_dict
+
+
+def read_masked_img(fh, event_idx, view_dict = None):
+    ''' Return the masked image of one event in a cxi file.  Datasets in
+        view_dict, e.g. memory maps, are read in place of the ones in the file.
+    '''
+    view_dict = {} if view_dict is None else view_dict
+
+    with perf.timer("read img"):
+        # Obtain the image...
+        k    = CXI_KEY["data"]
+        data = view_dict.get("data", fh.get(k))
+        img  = data[event_idx]
+
+        # Obtain the bad pixel mask, which is either per event or shared...
+        k    = CXI_KEY['mask']
+        mask = view_dict.get("mask", fh.get(k))
+        mask = mask[event_idx] if mask.ndim == data.ndim else mask[()]
+
+    # Apply mask...
+    with perf.timer("apply mask"):
+        img = apply_mask(img, 1 - mask, mask_value = 0)
+
+    return img
+
+
+def read_event(fh, event_idx, view_dict = None):
+    ''' Return the masked image and the segmask of one event in a cxi file.
+    '''
+    img = read_masked_img(fh, event_idx, view_dict)
+
+    # Obtain the segmask...
+    with perf.timer("read segmask"):
+        k       = CXI_KEY["segmask"]
+        segmask = fh.get(k)[event_idx]
+
+    return img, segmask
+
+
+def get_layout_issue(dataset):
+    ''' Return why the layout of a per-event dataset, e.g. segmask, is slow
+        for single event writes, or None if it is fine.
+    '''
+    if dataset.ndim < 3: return None
+
+    if dataset.chunks is None:
+        return "it is contiguous, so it can't be compressed"
+
+    if dataset.chunks[0] > 1:
+        return f"each chunk spans {dataset.chunks[0]} events, so writing one event rewrites all of them"
+
+    return None
+
+
+
 
 class DataManager:
     def __init__(self):
         super().__init__()
 
         # Internal variables...
-        self.img_state_dict = {}
-
         self.timestamp = self.get_timestamp()
 
-        self.state_random = [random.getstate(), np.random.get_state()]
+        # The random state is (seed, event key), from which the generators are
+        # seeded on demand, so it takes a few bytes however many events are
+        # visited...
+        self.state_random = (None, None)
 
         return None
 
@@ -31,16 +160,24 @@ class DataManager:
         return timestamp
 
 
-    def save_random_state(self):
-        self.state_random = (random.getstate(), np.random.get_state())
+    def save_random_state(self, key = None):
+        self.state_random = (getattr(self, 'seed', None), key)
 
         return None
 
 
     def set_random_state(self):
-        state_random, state_numpy = self.state_random
-        random.setstate(state_random)
-        np.random.set_state(state_numpy)
+        # Sessions saved by older versions hold full Mersenne Twister states...
+        if isinstance(self.state_random[1], tuple):
+            state_random, state_numpy = self.state_random
+            random.setstate(state_random)
+            np.random.set_state(state_numpy)
+
+            return None
+
+        seed, key = self.state_random
+        if key is None: set_seed(seed)
+        else          : set_event_seed(seed, key)
 
         return None
 
@@ -64,6 +201,19 @@ class PeakNetData(DataManager):
     - Offers an interface that allows users to modify the label tensor with the
       shape (1, H, W).  The label tensor only supports integer type.
 
+    Label representation
+    - By default, a label holds one integer encoding per pixel.
+    - With `uses_bitplane`, a label holds one bit per layer in the layer order
+      (background excluded), packed into uint8 (or uint16 beyond 8 layers), so
+      that a pixel can be in multiple layers.  It is converted from/to the
+      integer segmask in cxi files, where a pixel in multiple layers takes the
+      last of them in the layer order.
+
+    Multi-panel detectors
+    - With `path_geometry`, an npz of psana pixel indices (see geometry.py),
+      events stored as (panels, H, W) stacks are assembled into 2-D images
+      for display, and labels are taken back to panel pixels on saving.
+
     YAML
     - CXI 0
       - EVENT 0
@@ -73,53 +223,45 @@ class PeakNetData(DataManager):
       - EVENT 1
     """
 
+    # Segmasks of many events can be written as slabs straight into the cxi
+    # files held open for writing...
+    can_write_slab = True
+
     def __init__(self, config_data):
         super().__init__()
 
-        # Imported variables...
-        self.path_yaml     = getattr(config_data, 'path_yaml'    , None)
-        self.username      = getattr(config_data, 'username'     , None)
-        self.seed          = getattr(config_data, 'seed'         , None)
-        self.layer_manager = getattr(config_data, 'layer_manager', None)
-
-        if self.layer_manager is None:
-            layer_metadata = {
-                0 : {'name' : 'background' , 'color' : '#FFFFFF'},
-                1 : {'name' : 'peak'       , 'color' : '#FF0000'},
-                2 : {'name' : 'do not pred', 'color' : '#0000FF'},
-                3 : {'name' : 'bad pixel'  , 'color' : '#00FF00'},
-            }
-            layer_order  = [0, 1, 2, 3]
-            layer_active = 1
-            self.layer_manager = { 'layer_metadata' : layer_metadata,
-                                   'layer_order'    : layer_order,
-                                   'layer_active'   : layer_active, }
+        self.load_config(config_data)
 
         # Load the YAML file
         with open(self.path_yaml, 'r') as fh:
             config = yaml.safe_load(fh)
         path_cxi_list = config['cxi']
 
-        # Define the keys used below...
-        CXI_KEY = {
-            "num_peaks" : "/entry_1/result_1/nPeaks",
-            "peak_y"    : "/entry_1/result_1/peakYPosRaw",
-            "peak_x"    : "/entry_1/result_1/peakXPosRaw",
-            "data"      : "/entry_1/data_1/data",
-            "mask"      : "/entry_1/data_1/mask",
-            "segmask"   : "/entry_1/data_1/segmask",
-        }
-
         # Open all cxi files and track their status...
         cxi_dict = {}
         for path_cxi in path_cxi_list:
             # Open a new file???
             if path_cxi not in cxi_dict:
+                fh = self.open_cxi(path_cxi)
                 cxi_dict[path_cxi] = {
-                    "file_handle" : h5py.File(path_cxi, 'r+'),
+                    "file_handle" : fh,
                     "is_open"     : True,
+                    "view_dict"   : get_view_dict(fh) if self.uses_memmap else {},
                 }
 
+        # Panel stacks can't be shown without a geometry...
+        for path_cxi, cxi in cxi_dict.items():
+            if cxi["file_handle"].get(CXI_KEY["data"]).ndim > 3 and self.index_map is None:
+                raise ValueError(f"Events in {path_cxi} are panel stacks, but no path_geometry is given!!!")
+
+        # Warn about segmask layouts that make saving slow...
+        for path_cxi, cxi in cxi_dict.items():
+            issue = get_layout_issue(cxi["file_handle"].get(CXI_KEY["segmask"]))
+            if issue is None: continue
+
+            print(f"Warning!!! The segmask in {path_cxi} has a slow layout: {issue}.  "
+                  f"Convert it with `python -m manual_peak_labeler.rechunk`.")
+
         # Build an entire idx list...
         idx_list = []
         for path_cxi, cxi in cxi_dict.items():
@@ -142,6 +284,57 @@ class PeakNetData(DataManager):
         return None
 
 
+    def load_config(self, config_data):
+        # Imported variables...
+        self.path_yaml     = getattr(config_data, 'path_yaml'    , None)
+        self.username      = getattr(config_data, 'username'     , None)
+        self.seed          = getattr(config_data, 'seed'         , None)
+        self.layer_manager = getattr(config_data, 'layer_manager', None)
+        self.dir_thumbnail = getattr(config_data, 'dir_thumbnail', None)
+        self.uses_bitplane = getattr(config_data, 'uses_bitplane', False)
+        self.uses_memmap   = getattr(config_data, 'uses_memmap'  , True)
+        self.path_geometry = getattr(config_data, 'path_geometry', None)
+        self.dir_geometry  = getattr(config_data, 'dir_geometry' , None)
+
+        if self.dir_thumbnail is None:
+            self.dir_thumbnail = os.path.join(os.path.expanduser('~'), '.cache', 'manual_peak_labeler', 'thumbnail')
+
+        if self.dir_geometry is None:
+            self.dir_geometry = os.path.join(os.path.expanduser('~'), '.cache', 'manual_peak_labeler', 'geometry')
+
+        # Index maps are shared by all files with the same geometry...
+        self.index_map = None
+        if self.path_geometry is not None:
+            self.index_map = get_index_map(*load_geometry(self.path_geometry), dir_cache = self.dir_geometry)
+
+        if self.layer_manager is None: self.layer_manager = get_default_layer_manager()
+
+        # Bits are assigned once, so buffered bit-plane labels stay valid...
+        self.layer_bits = get_layer_bits(self.layer_manager['layer_order'])
+
+        return None
+
+
+    def set_layer_manager(self, layer_manager):
+        ''' Replace the layer manager, e.g. with one from a saved state.  Bits
+            of buffered bit-plane labels are moved to the new layer order.
+        '''
+        layer_bits = get_layer_bits(layer_manager['layer_order'])
+
+        if self.uses_bitplane and layer_bits != self.layer_bits:
+            for idx, (img, label) in self.buffer_dict.items():
+                self.buffer_dict[idx] = (img, remap_bitplane(label, self.layer_bits, layer_bits))
+
+        self.layer_manager = layer_manager
+        self.layer_bits    = layer_bits
+
+        return None
+
+
+    def open_cxi(self, path_cxi):
+        return h5py.File(path_cxi, 'r+')
+
+
     def __enter__(self):
         return self
 
@@ -155,71 +348,247 @@ class PeakNetData(DataManager):
             is_open = cxi.get("is_open")
             if is_open:
                 cxi.get("file_handle").close()
+                cxi["view_dict"] = {}
                 cxi["is_open"] = False
                 print(f"{path_cxi} is closed.")
 
 
+    @perf.timer("get_img")
     def get_img(self, idx):
         path_cxi, event_idx, fh = self.idx_list[idx]
 
         buffer_key = idx
+        perf.count("buffer hit" if buffer_key in self.buffer_dict else "buffer miss")
         if not buffer_key in self.buffer_dict:
-            # Obtain the image...
-            k   = self.CXI_KEY["data"]
-            img = fh.get(k)[event_idx]
-
-            # Obtain the bad pixel mask...
-            k    = self.CXI_KEY['mask']
-            mask = fh.get(k)
-            mask = mask[event_idx] if mask.ndim == 3 else mask[()]
-
-            # Apply mask...
-            img = apply_mask(img, 1 - mask, mask_value = 0)
-
-            # Obtain the segmask...
-            k       = self.CXI_KEY["segmask"]
-            segmask = fh.get(k)[event_idx]
+            img, segmask = self.load_event(idx)
+            img, segmask = self.assemble_event(img, segmask)
+            segmask = self.from_segmask(segmask)
 
             self.buffer_dict[buffer_key] = (img, segmask)
             print(f"Event {event_idx} is in the buffer.")
 
         img, segmask = self.buffer_dict[buffer_key]
 
-        # Save random state...
-        # Might not be useful for this labeler
-        if not idx in self.img_state_dict:
-            self.save_random_state()
-            self.img_state_dict[idx] = self.state_random
-        else:
-            self.state_random = self.img_state_dict[idx]
-            self.set_random_state()
+        self.sync_random_state(idx)
 
         return img[None,], segmask[None,]
 
 
-    # [DEV]
-    def save_buffered_segmask(self):
+    def sync_random_state(self, idx):
+        # Derive the random state of an event from its key...
+        # Might not be useful for this labeler
+        path_cxi, event_idx, _ = self.idx_list[idx]
+        self.save_random_state(get_event_key(path_cxi, event_idx))
+        self.set_random_state()
+
+        return None
+
+
+    def fetch_img(self, idx):
+        ''' Return the masked image and the segmask of an event without
+            adding them to the buffer, which is meant for read ahead.  It
+            leaves the random state alone, so it is safe to call from a
+            worker thread.
+        '''
+        buffered = self.buffer_dict.get(idx)
+        if buffered is not None: return buffered
+
+        img, segmask = self.load_event(idx)
+        img, segmask = self.assemble_event(img, segmask)
+
+        return img, self.from_segmask(segmask)
+
+
+    def get_first_idx(self):
+        return 0
+
+
+    def get_next_idx(self, idx):
+        # Support rollover...
+        return (idx + 1) % len(self.idx_list)
+
+
+    def get_prev_idx(self, idx):
+        # Support rollover...
+        return (idx - 1) % len(self.idx_list)
+
+
+    def begin_edit(self, idx):
+        ''' Called before the labels of an event are edited, e.g. to lease it
+            from a coordinator.
+        '''
+        return None
+
+
+    def load_event(self, idx):
+        ''' Return the masked image and the integer segmask of an event as
+            they are stored in its cxi file.
+        '''
+        path_cxi, event_idx, fh = self.idx_list[idx]
+
+        return read_event(fh, event_idx, self.cxi_dict[path_cxi]["view_dict"])
+
+
+    def assemble_event(self, img, segmask):
+        ''' Assemble the image and the segmask of an event stored as panel
+            stacks.  Events stored as 2-D images are returned as they are.
+        '''
+        if img.ndim == 2: return img, segmask
+
+        with perf.timer("assemble"):
+            img     = assemble(img    , self.index_map)
+            segmask = assemble(segmask, self.index_map)
+
+        return img, segmask
+
+
+    def to_panel_segmask(self, idx, segmask):
+        ''' Take an assembled segmask back to the panel stack of an event if
+            its cxi file stores panel stacks.
+        '''
+        _, _, fh = self.idx_list[idx]
+        if fh.get(self.CXI_KEY["segmask"]).ndim < 4: return segmask
+
+        return disassemble(segmask, self.index_map)
+
+
+    def from_segmask(self, segmask):
+        ''' Convert an integer segmask in cxi to the label representation.
+        '''
+        if not self.uses_bitplane: return segmask
+
+        return segmask_to_bitplane(segmask, self.layer_bits)
+
+
+    def to_segmask(self, label, dtype = 'int64'):
+        ''' Convert a label to an integer segmask in cxi.
+        '''
+        if not self.uses_bitplane: return label
+
+        return bitplane_to_segmask(label, self.layer_bits, self.layer_manager['layer_order'], dtype = dtype)
+
+
+    def get_color_lut(self):
+        if not self.uses_bitplane: return build_color_lut(self.layer_manager)
+
+        return build_bitplane_color_lut(self.layer_manager, self.layer_bits)
+
+
+    def is_labeled(self, label, layer):
+        ''' Return whether pixels in a label are in a layer.  A pixel is in
+            the background (0) when it is in no other layer.
+        '''
+        if not self.uses_bitplane or layer == 0: return label == layer
+
+        return (label & self.layer_bits[layer]) != 0
+
+
+    def is_unlabeled(self, label, layer):
+        ''' Return whether no pixel in a label is in a layer.  Without bit
+            planes, a pixel in any layer counts.
+        '''
+        if not self.uses_bitplane or layer == 0: return np.all(label == 0)
+
+        return not np.any(label & self.layer_bits[layer])
+
+
+    def paint_label(self, label, where, layer, erases = False):
+        ''' Add (or remove) pixels selected by where to (or from) a layer in
+            place.  Without bit planes, removing a pixel clears all its labels.
+            The background (0) works as an eraser of all layers either way.
+        '''
+        if not self.uses_bitplane:
+            label[where] = 0 if erases else layer
+            return None
+
+        if layer == 0:
+            label[where] = 0
+            return None
+
+        bit = label.dtype.type(self.layer_bits[layer])
+        label[where] = label[where] & ~bit if erases else label[where] | bit
+
+
+    def get_num_peaks(self, idx):
+        _, event_idx, fh = self.idx_list[idx]
+
+        return int(fh.get(self.CXI_KEY["num_peaks"])[event_idx])
+
+
+    def get_segmask_dtype(self, idx):
+        _, _, fh = self.idx_list[idx]
+
+        return fh.get(self.CXI_KEY["segmask"]).dtype
+
+
+    def get_peak_positions(self, idx):
+        ''' Return the peak positions found by psocake as an array with the
+            shape of (N, 2), each position is given by (y, x).
+        '''
+        _, event_idx, fh = self.idx_list[idx]
+
+        num_peaks = self.get_num_peaks(idx)
+        peak_y = fh.get(self.CXI_KEY["peak_y"])[event_idx, :num_peaks]
+        peak_x = fh.get(self.CXI_KEY["peak_x"])[event_idx, :num_peaks]
+
+        return np.stack([peak_y, peak_x], axis = -1)
+
+
+    @perf.timer("write_segmask")
+    def write_segmask(self, idx, label, flushes = True):
+        ''' Write the label of an event to the segmask in its cxi file unless
+            nothing has changed.  Return whether it is written.  Batch writers
+            may skip flushing and flush the file once per batch.
+        '''
         # Use the key to access a segmask...
         k = self.CXI_KEY["segmask"]
 
+        path_cxi, event_idx, fh = self.idx_list[idx]
+
+        segmask = self.to_segmask(label, dtype = fh.get(k).dtype)
+        segmask = self.to_panel_segmask(idx, segmask)
+        if np.all(fh.get(k)[event_idx] == segmask): return False
+
+        fh.get(k)[event_idx] = segmask    # (H, W) -> (H, W), or (panels, H, W)
+
+        # Flush it to disk now...
+        if flushes: fh.flush()
+
+        return True
+
+
+    def flush_segmask(self):
+        ''' Flush segmasks written with flushes = False.
+        '''
+        for cxi in self.cxi_dict.values():
+            if cxi["is_open"]: cxi["file_handle"].flush()
+
+
+    # [DEV]
+    @perf.timer("save_buffered_segmask")
+    def save_buffered_segmask(self):
+        saved_idx_list = []
+        failed_dict    = {}
         for idx, (_, unsaved_segmask) in self.buffer_dict.items():
 
             path_cxi, event_idx, fh = self.idx_list[idx]
 
             # Update the content in segmask with caution...
             try:
-                if np.all(fh.get(k)[event_idx] == unsaved_segmask): continue
-
-                fh.get(k)[event_idx] = unsaved_segmask    # (H, W) -> (H, W)
-
-                # Flush it to disk now...
-                fh.flush()
+                if not self.write_segmask(idx, unsaved_segmask): continue
 
+                saved_idx_list.append(idx)
                 print(f"The new segmask for event {event_idx} is saved.")
 
             except Exception as e:
-                print(f"Oops!!! Errors occurs while saving the new segmask for event {event_idx}.")
+                print(f"Oops!!! Errors occurs while saving the new segmask for event {event_idx}: {e}")
+
+                # Keep it, so that the work isn't lost...
+                failed_dict[idx] = self.buffer_dict[idx]
 
         # Empty the buffer again...
-        self.buffer_dict = {}
-        print(f"Buffer is cleaned.")
+        self.buffer_dict = failed_dict
+        if len(failed_dict) > 0: print(f"{len(failed_dict)} unsaved events are kept in the buffer.")
+        else                   : print(f"Buffer is cleaned.")
+
+        return saved_idx_list
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from collections import OrderedDict
+
+from .utils     import build_color_lut
+from .thumbnail import ThumbnailCache, ThumbnailGenerator, make_thumbnail_label, get_segmask_crc, get_bin_size
+
+from pyqtgraph.Qt import QtWidgets, QtCore, QtGui
+
+class ThumbnailModel(QtCore.QAbstractListModel):
+    """
+    A list model with one row per event in the data manager.  Thumbnails are
+    only fetched when the view asks for them, which only happens for visible
+    rows.  Missing thumbnails are handed over to the generator, and rows are
+    repainted once their thumbnails are ready.
+    """
+
+    def __init__(self, data_manager, cache, generator, size_icon = 128, max_pixmap = 2048):
+        super().__init__()
+
+        self.data_manager = data_manager
+        self.cache        = cache
+        self.generator    = generator
+        self.size_icon    = size_icon
+        self.max_pixmap   = max_pixmap
+
+        # Keep recently painted pixmaps in memory...
+        self.pixmap_dict = OrderedDict()
+
+        # Collect requests from one paint pass and submit them together...
+        self.request_list = []
+
+        # Map a cache key back to a row...
+        self.row_dict = { (path_cxi, event_idx) : row for row, (path_cxi, event_idx, _) in enumerate(self.data_manager.idx_list) }
+
+        # Rows still showing pixmaps of a cxi file that has been replaced since...
+        self.stale_set = set()
+
+        self.placeholder = QtGui.QPixmap(self.size_icon, self.size_icon)
+        self.placeholder.fill(QtGui.QColor('#202020'))
+
+        self.lut = build_color_lut(self.data_manager.layer_manager)
+
+        return None
+
+
+    def rowCount(self, parent = QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.data_manager.idx_list)
+
+
+    def data(self, index, role = QtCore.Qt.DisplayRole):
+        if not index.isValid(): return None
+
+        row = index.row()
+
+        if role == QtCore.Qt.DisplayRole: return str(row)
+
+        if role == QtCore.Qt.DecorationRole: return self.get_pixmap(row)
+
+        return None
+
+
+    def get_pixmap(self, row):
+        path_cxi, event_idx, _ = self.data_manager.idx_list[row]
+
+        if row in self.pixmap_dict:
+            self.pixmap_dict.move_to_end(row)
+
+            # Keep showing it until the new thumbnail is ready...
+            if row in self.stale_set:
+                self.stale_set.discard(row)
+                self.request_list.append((path_cxi, event_idx))
+
+            return self.pixmap_dict[row]
+
+        thumbnail = self.cache.get(path_cxi, event_idx)
+
+        if thumbnail is None:
+            self.request_list.append((path_cxi, event_idx))
+            return self.placeholder
+
+        pixmap = self.render(*thumbnail)
+
+        self.pixmap_dict[row] = pixmap
+        if len(self.pixmap_dict) > self.max_pixmap: self.pixmap_dict.popitem(last = False)
+
+        return pixmap
+
+
+    def render(self, img_thumb, label_thumb):
+        ''' Blend the label colors into the grayscale image.
+        '''
+        label_thumb = np.minimum(label_thumb, len(self.lut) - 1)
+        rgba  = self.lut[label_thumb]
+        alpha = rgba[..., 3:4] / 255.0
+        rgb   = img_thumb[..., None] * (1 - alpha) + rgba[..., :3] * alpha
+
+        # The viewer displays the 0th axis horizontally and the 1st axis
+        # upwards, so flip the thumbnail to match it...
+        rgb = np.ascontiguousarray(rgb.astype('uint8').transpose(1, 0, 2)[::-1])
+
+        size_y, size_x = rgb.shape[:2]
+        qimg = QtGui.QImage(rgb.data, size_x, size_y, 3 * size_x, QtGui.QImage.Format_RGB888).copy()
+
+        return QtGui.QPixmap.fromImage(qimg).scaled(self.size_icon, self.size_icon, QtCore.Qt.KeepAspectRatio)
+
+
+    def submit_requests(self):
+        if len(self.request_list) == 0: return None
+
+        self.generator.submit(self.request_list)
+        self.request_list = []
+
+
+    def collect_results(self):
+        for key in self.generator.poll():
+            row = self.row_dict.get(key)
+            if row is None: continue
+
+            self.invalidate_row(row)
+
+
+    def invalidate_row(self, row):
+        self.pixmap_dict.pop(row, None)
+        self.stale_set.discard(row)
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [QtCore.Qt.DecorationRole])
+
+
+    def check_files(self):
+        ''' Mark rows of cxi files replaced by anyone, e.g. by rechunking, as
+            stale, so that visible ones are produced again.
+        '''
+        path_cxi_set = set()
+        for path_cxi in self.data_manager.path_cxi_list:
+            if path_cxi in path_cxi_set: continue
+            path_cxi_set.add(path_cxi)
+
+            if not self.cache.check_stamp(path_cxi): continue
+
+            row_list = [ row for row in self.pixmap_dict if self.data_manager.idx_list[row][0] == path_cxi ]
+            self.stale_set.update(row_list)
+
+            # Only visible rows are painted, and thus requested, again...
+            if len(row_list) > 0: self.dataChanged.emit(self.index(min(row_list)), self.index(max(row_list)), [QtCore.Qt.DecorationRole])
+
+
+    def verify_rows(self, row_list):
+        ''' Check the segmask crc behind cached thumbnails of the rows, so
+            that segmasks changed on disk by anyone, e.g. autolabel or other
+            labelers, are shown.  Rows in the buffer are left to
+            refresh_buffered_labels.
+        '''
+        key_list = []
+        for row in row_list:
+            if row in self.data_manager.buffer_dict: continue
+
+            path_cxi, event_idx, _ = self.data_manager.idx_list[row]
+            key_list.append((path_cxi, event_idx))
+
+        self.generator.verify(key_list)
+
+
+    def refresh_buffered_labels(self):
+        ''' Refresh label thumbnails of events whose segmask in the buffer no
+            longer matches the one behind the cached thumbnail.
+        '''
+        for row, (_, label) in list(self.data_manager.buffer_dict.items()):
+            path_cxi, event_idx, _ = self.data_manager.idx_list[row]
+            label = self.data_manager.to_segmask(label, dtype = self.data_manager.get_segmask_dtype(row))
+
+            thumbnail = self.cache.get(path_cxi, event_idx)
+            if thumbnail is None: continue
+
+            crc = get_segmask_crc(label)
+            if crc == self.cache.get_crc(path_cxi, event_idx): continue
+
+            bin_size    = get_bin_size(label.shape, self.generator.max_size)
+            label_thumb = make_thumbnail_label(label, bin_size)
+            self.cache.put_label(path_cxi, event_idx, label_thumb, crc)
+
+            self.invalidate_row(row)
+
+        self.cache.flush()
+
+
+
+
+class Gallery(QtWidgets.QWidget):
+    """
+    A grid of thumbnails of all events.  Clicking a thumbnail emits the
+    sequence number of the event.
+    """
+
+    sigEventSelected = QtCore.Signal(int)
+
+    def __init__(self, data_manager, size_icon = 128, num_workers = None):
+        super().__init__()
+
+        self.cache     = ThumbnailCache(data_manager.dir_thumbnail)
+        self.generator = ThumbnailGenerator(self.cache, num_workers = num_workers, max_size = size_icon,
+                                            path_geometry = data_manager.path_geometry, dir_geometry = data_manager.dir_geometry)
+        self.model     = ThumbnailModel(data_manager, self.cache, self.generator, size_icon = size_icon)
+
+        # Config the view for many equally sized items...
+        view = QtWidgets.QListView()
+        view.setViewMode(QtWidgets.QListView.IconMode)
+        view.setResizeMode(QtWidgets.QListView.Adjust)
+        view.setMovement(QtWidgets.QListView.Static)
+        view.setUniformItemSizes(True)
+        view.setLayoutMode(QtWidgets.QListView.Batched)
+        view.setBatchSize(256)
+        view.setIconSize(QtCore.QSize(size_icon, size_icon))
+        view.setGridSize(QtCore.QSize(size_icon + 8, size_icon + 24))
+        view.setModel(self.model)
+        view.clicked.connect(lambda index: self.sigEventSelected.emit(index.row()))
+        self.view = view
+
+        layout = QtWidgets.QVBoxLayout()
+        layout.addWidget(view)
+        self.setLayout(layout)
+        self.resize(900, 700)
+        self.setWindowTitle("Gallery")
+
+        # Submit requests of visible rows and collect results periodically...
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.pollThumbnails)
+
+        # Check visible rows against changes on disk less often...
+        self.timer_verify = QtCore.QTimer()
+        self.timer_verify.timeout.connect(self.verifyThumbnails)
+
+        return None
+
+
+    def pollThumbnails(self):
+        self.model.submit_requests()
+        self.model.collect_results()
+
+
+    def verifyThumbnails(self):
+        self.model.check_files()
+        self.model.verify_rows(self.get_visible_rows())
+
+
+    def get_visible_rows(self):
+        viewport = self.view.viewport()
+        index_first = self.view.indexAt(QtCore.QPoint(4, 4))
+        if not index_first.isValid(): return []
+
+        # The last cell may be empty, so scan back along the bottom edge...
+        row_last = self.model.rowCount() - 1
+        for x in range(viewport.width() - 4, 0, -self.view.gridSize().width()):
+            index_last = self.view.indexAt(QtCore.QPoint(x, viewport.height() - 4))
+            if index_last.isValid():
+                row_last = index_last.row()
+                break
+
+        return list(range(index_first.row(), row_last + 1))
+
+
+    def refresh(self):
+        self.verifyThumbnails()
+        self.model.refresh_buffered_labels()
+
+
+    def invalidate(self, idx_list):
+        ''' Drop thumbnails of events whose segmask has changed on disk.
+        '''
+        for idx in idx_list:
+            path_cxi, event_idx, _ = self.model.data_manager.idx_list[idx]
+            self.cache.invalidate(path_cxi, event_idx)
+            self.model.invalidate_row(idx)
+
+        self.cache.flush()
+
+
+    def scrollTo(self, idx):
+        self.view.scrollTo(self.model.index(idx), QtWidgets.QAbstractItemView.PositionAtCenter)
+
+
+    def showEvent(self, event):
+        self.timer.start(100)
+        self.timer_verify.start(2000)
+        event.accept()
+
+
+    def closeEvent(self, event):
+        self.timer.stop()
+        self.timer_verify.stop()
+        event.accept()
+
+
+    def close_cache(self):
+        self.timer.stop()
+        self.timer_verify.stop()
+        self.generator.close()
+        self.cache.close()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Assemble multi-panel detector frames, i.e. (panels, H, W) stacks, into 2-D
+images with a precomputed index map, and take labels in the assembled image
+back to panel pixels.
+
+A geometry is given by the pixel indices of every panel pixel in the
+assembled image, as returned by psana's `Detector.indexes_xy`, where
+index_x is the row and index_y is the column.  The map built from it is one
+flat index per panel pixel, so assembling a frame is one scatter and taking
+a label back is one gather.  Maps are cached per geometry in memory and as
+npz files.
+
+Usage:
+    python -m manual_peak_labeler.geometry exp run detector_name geometry.npz
+
+exports the geometry of a psana detector, which is then given to the labeler
+as `path_geometry`, so that labeling needs no psana.
+"""
+
+import os
+import hashlib
+import argparse
+import numpy as np
+
+# Index maps by geometry key...
+INDEX_MAP_CACHE = {}
+
+def get_geometry_key(index_x, index_y):
+    ''' Return a key that changes whenever any pixel moves.
+    '''
+    index_x = np.ascontiguousarray(index_x, dtype = 'int64')
+    index_y = np.ascontiguousarray(index_y, dtype = 'int64')
+
+    sha = hashlib.sha1()
+    sha.update(str(index_x.shape).encode())
+    sha.update(index_x.tobytes())
+    sha.update(index_y.tobytes())
+
+    return sha.hexdigest()[:16]
+
+
+def build_index_map(index_x, index_y):
+    ''' Return the index map of a geometry.
+
+        - idx_flat : the flat index in the assembled image of every panel
+                     pixel, in the order of the raveled panel stack.
+        - is_gap   : pixels of the assembled image that no panel pixel covers.
+
+        Where panels overlap, assembling keeps one of them, and taking a
+        label back gives it to all of them.
+    '''
+    index_x = np.asarray(index_x, dtype = 'int64')
+    index_y = np.asarray(index_y, dtype = 'int64')
+    assert index_x.shape == index_y.shape, f"index_x {index_x.shape} and index_y {index_y.shape} don't match!!!"
+
+    shape_img = (int(index_x.max()) + 1, int(index_y.max()) + 1)
+    size_img  = shape_img[0] * shape_img[1]
+
+    # Smaller indices are faster to scatter and gather...
+    dtype_idx = 'int32' if size_img < 2**31 else 'int64'
+    idx_flat  = (index_x * shape_img[1] + index_y).ravel().astype(dtype_idx)
+
+    is_gap = np.ones(size_img, dtype = bool)
+    is_gap[idx_flat] = False
+
+    index_map = {
+        "key"         : get_geometry_key(index_x, index_y),
+        "shape_panel" : index_x.shape,
+        "shape_img"   : shape_img,
+        "idx_flat"    : idx_flat,
+        "is_gap"      : is_gap.reshape(shape_img),
+    }
+
+    return index_map
+
+
+def save_index_map(path_npz, index_map):
+    # Write to a temporary file first, so that readers never see half of it...
+    path_tmp = f"{path_npz}.{os.getpid()}.tmp.npz"
+    np.savez(path_tmp, **index_map)
+    os.replace(path_tmp, path_npz)
+
+
+def load_index_map(path_npz):
+    with np.load(path_npz) as npz:
+        index_map = {
+            "key"         : str(npz["key"]),
+            "shape_panel" : tuple(int(v) for v in npz["shape_panel"]),
+            "shape_img"   : tuple(int(v) for v in npz["shape_img"]),
+            "idx_flat"    : npz["idx_flat"],
+            "is_gap"      : npz["is_gap"],
+        }
+
+    return index_map
+
+
+def get_index_map(index_x, index_y, dir_cache = None):
+    ''' Return the index map of a geometry from memory, from the npz cache
+        in dir_cache, or by building it, in this order.
+    '''
+    key = get_geometry_key(index_x, index_y)
+    if key in INDEX_MAP_CACHE: return INDEX_MAP_CACHE[key]
+
+    path_npz = None if dir_cache is None else os.path.join(dir_cache, f"{key}.npz")
+    if path_npz is not None and os.path.exists(path_npz):
+        index_map = load_index_map(path_npz)
+    else:
+        index_map = build_index_map(index_x, index_y)
+
+        if path_npz is not None:
+            os.makedirs(dir_cache, exist_ok = True)
+            save_index_map(path_npz, index_map)
+
+    INDEX_MAP_CACHE[key] = index_map
+
+    return index_map
+
+
+def save_geometry(path_npz, index_x, index_y):
+    np.savez(path_npz, index_x = index_x, index_y = index_y)
+
+
+def load_geometry(path_npz):
+    ''' Return (index_x, index_y) saved by save_geometry.
+    '''
+    with np.load(path_npz) as npz:
+        return npz["index_x"], npz["index_y"]
+
+
+def assemble(panels, index_map, fill_value = 0):
+    ''' Assemble a (panels, H, W) stack into a 2-D image.  Gaps between
+        panels take fill_value.
+    '''
+    img = np.full(index_map["shape_img"], fill_value, dtype = panels.dtype)
+    img.reshape(-1)[index_map["idx_flat"]] = panels.reshape(-1)
+
+    return img
+
+
+def disassemble(img, index_map):
+    ''' Take a 2-D image, e.g. a label, back to a (panels, H, W) stack.
+        Anything in the gaps is dropped.
+    '''
+    return np.ascontiguousarray(img).reshape(-1)[index_map["idx_flat"]].reshape(index_map["shape_panel"])
+
+
+def main():
+    from .utils import PsanaImg
+
+    parser = argparse.ArgumentParser(description = "Export the geometry of a psana detector for the labeler.")
+    parser.add_argument("exp")
+    parser.add_argument("run", type = int)
+    parser.add_argument("detector_name")
+    parser.add_argument("path_npz", help = "Save index_x and index_y to this npz file.")
+    parser.add_argument("--mode"     , default = "idx", help = "psana data source mode.")
+    parser.add_argument("--event_num", type = int, default = 0, help = "The event whose geometry is exported.")
+    args = parser.parse_args()
+
+    psana_img = PsanaImg(args.exp, args.run, args.mode, args.detector_name)
+    index_x, index_y = psana_img.indexes_xy(args.event_num)
+    save_geometry(args.path_npz, index_x, index_y)
+
+    index_map = build_index_map(index_x, index_y)
+    print(f"The geometry of {index_map['shape_panel']} panels assembled into {index_map['shape_img']} "
+          f"({index_map['key']}) is saved to {args.path_npz}.")
+
+
+if __name__ == "__main__":
+    main()
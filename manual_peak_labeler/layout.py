@@ -5,7 +5,7 @@ import os
 import sys
 
 from pyqtgraph          import LayoutWidget, ImageView, PlotItem, ImageItem, ViewBox
-from pyqtgraph.Qt       import QtWidgets
+from pyqtgraph.Qt       import QtWidgets, QtGui
 from pyqtgraph.dockarea import DockArea, Dock
 
 class MainLayout(QtWidgets.QWidget):
@@ -86,3 +86,25 @@ class MainLayout(QtWidgets.QWidget):
         self.dock_dict["ImgQry"].addWidget(wdgt)
 
         return wdgt
+
+
+    def config_perf_dock(self):
+        ''' Dock of Perf shows latencies and counters.  It is rarely needed, so
+            it is built on first use.
+        '''
+        # Biolerplate code to start widget config
+        wdgt = LayoutWidget()
+
+        # Set up a read-only text box in a fixed width font...
+        text = QtWidgets.QPlainTextEdit()
+        text.setReadOnly(True)
+        text.setLineWrapMode(QtWidgets.QPlainTextEdit.NoWrap)
+        text.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+
+        wdgt.addWidget(text, row = 0, col = 0)
+
+        self.dock_dict["Perf"] = Dock("Perf", size = (300, 300))
+        self.dock_dict["Perf"].addWidget(wdgt)
+        self.area.addDock(self.dock_dict["Perf"], "right", self.dock_dict["ImgQry"])
+
+        return text
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from .utils import extract_patches, colorize_label
+
+from pyqtgraph    import ImageView, PlotItem, ImageItem
+from pyqtgraph.Qt import QtWidgets, QtCore
+
+def tile_patches(patches, num_col, size_gap, fill_value = 0):
+    ''' Tile patches of shape (N, h, w, ...) into one mosaic.  The mosaic
+        follows the viewer convention, i.e. the 0th axis is displayed
+        horizontally and the 1st axis upwards, so the first patch sits at the
+        top left corner.
+    '''
+    num_patch, size_patch = patches.shape[:2]
+    size_tile = size_patch + size_gap
+    num_row   = max(1, -(-num_patch // num_col))
+    shape_ext = patches.shape[3:]
+
+    tiles = np.full((num_row * num_col, size_tile, size_tile) + shape_ext, fill_value, dtype = patches.dtype)
+    tiles[:num_patch, :size_patch, :size_patch] = patches
+
+    # (row, col, i, j) -> (col, i, row, j), with rows flipped upwards...
+    tiles  = tiles.reshape((num_row, num_col, size_tile, size_tile) + shape_ext)[::-1]
+    axes   = (1, 2, 0, 3) + tuple(range(4, 4 + len(shape_ext)))
+    mosaic = tiles.transpose(axes).reshape((num_col * size_tile, num_row * size_tile) + shape_ext)
+
+    return mosaic
+
+
+
+
+class PatchGrid(QtWidgets.QWidget):
+    """
+    A grid of patches around peaks of the current event.  A click on a patch
+    emits the pixel position in the frame, so that the window can edit the
+    underlying segmask.
+    """
+
+    sigPixelClicked  = QtCore.Signal(int, int)
+    sigConfigChanged = QtCore.Signal()
+
+    SOURCE_LIST = [ 'cxi peaks', 'segmask blobs' ]
+
+    def __init__(self, size_patch = 32, size_gap = 2):
+        super().__init__()
+
+        self.size_gap    = size_gap
+        self.origin_list = np.zeros((0, 2), dtype = int)
+        self.num_col     = 1
+        self.img         = None
+
+        # Config the viewer and its overlay...
+        self.viewer     = ImageView(view = PlotItem())
+        self.label_item = ImageItem(None)
+        self.viewer.getView().addItem(self.label_item)
+        self.viewer.getView().scene().sigMouseClicked.connect(self.mouseClicked)
+
+        # Config the controls...
+        self.combo_source = QtWidgets.QComboBox()
+        self.combo_source.addItems(self.SOURCE_LIST)
+        self.combo_source.currentIndexChanged.connect(lambda _: self.sigConfigChanged.emit())
+
+        self.spin_size = QtWidgets.QSpinBox()
+        self.spin_size.setRange(4, 256)
+        self.spin_size.setValue(size_patch)
+        self.spin_size.valueChanged.connect(lambda _: self.sigConfigChanged.emit())
+
+        layout_ctrl = QtWidgets.QHBoxLayout()
+        layout_ctrl.addWidget(QtWidgets.QLabel("Source"))
+        layout_ctrl.addWidget(self.combo_source)
+        layout_ctrl.addWidget(QtWidgets.QLabel("Patch size"))
+        layout_ctrl.addWidget(self.spin_size)
+        layout_ctrl.addStretch()
+
+        layout = QtWidgets.QVBoxLayout()
+        layout.addLayout(layout_ctrl)
+        layout.addWidget(self.viewer)
+        self.setLayout(layout)
+        self.resize(800, 800)
+        self.setWindowTitle("Patch grid")
+
+        return None
+
+
+    @property
+    def source(self):
+        return self.SOURCE_LIST[self.combo_source.currentIndex()]
+
+
+    @property
+    def size_patch(self):
+        return self.spin_size.value()
+
+
+    def set_frame(self, img, label, center_list, levels, lut):
+        ''' Extract patches around each center and display them.
+        '''
+        self.img = img
+
+        patches, self.origin_list = extract_patches(img, center_list, self.size_patch)
+        self.num_col = max(1, int(np.ceil(np.sqrt(len(patches)))))
+
+        mosaic = tile_patches(patches, self.num_col, self.size_gap)
+        self.viewer.setImage(mosaic, levels = levels)
+
+        self.refresh_label(label, lut)
+
+        self.setWindowTitle(f"Patch grid  |  {len(patches)} patches")
+
+
+    def refresh_label(self, label, lut):
+        ''' Redraw label overlays with the current patch positions.
+        '''
+        label_patches, _ = extract_patches(label, self.origin_list + self.size_patch // 2, self.size_patch)
+        layers = tile_patches(colorize_label(label_patches, lut), self.num_col, self.size_gap)
+
+        self.label_item.setImage(layers, levels = [0, 128])
+
+
+    def mouseClicked(self, event):
+        if event.button() != QtCore.Qt.LeftButton: return None
+        if len(self.origin_list) == 0: return None
+
+        mouse_pos = self.viewer.getView().vb.mapSceneToView(event.scenePos())
+        x = int(np.floor(mouse_pos.x()))
+        y = int(np.floor(mouse_pos.y()))
+
+        # Locate the patch and the pixel within...
+        size_tile = self.size_patch + self.size_gap
+        num_row   = -(-len(self.origin_list) // self.num_col)
+        col, i = divmod(x, size_tile)
+        row, j = divmod(y, size_tile)
+        row    = num_row - 1 - row
+
+        if not (0 <= col < self.num_col and 0 <= row < num_row): return None
+        if not (i < self.size_patch and j < self.size_patch)   : return None
+
+        idx_patch = row * self.num_col + col
+        if not idx_patch < len(self.origin_list): return None
+
+        # Skip the padding around the edge of the frame...
+        x_frame, y_frame = self.origin_list[idx_patch] + (i, j)
+        size_x, size_y   = self.img.shape[-2:]
+        if not (0 <= x_frame < size_x and 0 <= y_frame < size_y): return None
+
+        self.sigPixelClicked.emit(int(x_frame), int(y_frame))
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Lightweight timers and counters for finding out where the labeler spends its
+time.  Recording is off by default and each timer then costs a flag check.
+Turn it on by setting MANUAL_PEAK_LABELER_PERF=1, calling enable(), or
+opening the perf panel in the labeler (L).
+
+Usage:
+    from . import perf
+
+    @perf.timer("refresh_layers")
+    def refresh_layers(self): ...
+
+    with perf.timer("setImage"):
+        ...
+
+    perf.count("buffer hit")
+    perf.export_trace("trace.json")    # Open it in chrome://tracing or Perfetto.
+"""
+
+import os
+import json
+import time
+import threading
+import functools
+import collections
+
+import numpy as np
+
+# Keep the latest spans only, so that memory stays bounded in long sessions...
+SIZE_RING = 20000
+
+STATE = {
+    "is_enabled"   : os.environ.get("MANUAL_PEAK_LABELER_PERF", "0") not in ("", "0"),
+    "span_ring"    : collections.deque(maxlen = SIZE_RING),
+    "counter_dict" : collections.Counter(),
+    "time_origin"  : time.perf_counter(),
+}
+
+def enable(is_enabled = True):
+    STATE["is_enabled"] = is_enabled
+
+
+def is_enabled():
+    return STATE["is_enabled"]
+
+
+def reset():
+    STATE["span_ring"].clear()
+    STATE["counter_dict"].clear()
+    STATE["time_origin"] = time.perf_counter()
+
+
+def record(name, time_start, duration):
+    ''' Record a span that starts at time_start (perf_counter) and lasts
+        duration seconds.
+    '''
+    STATE["span_ring"].append((name, time_start, duration, threading.get_ident()))
+
+
+def count(name, num = 1):
+    if STATE["is_enabled"]: STATE["counter_dict"][name] += num
+
+
+class timer:
+    """
+    Time a block as a context manager, or every call as a decorator.
+
+        with timer("setImage"): ...
+
+        @timer("dispImg")
+        def dispImg(self, ...): ...
+    """
+
+    __slots__ = ("name", "time_start")
+
+    def __init__(self, name):
+        self.name       = name
+        self.time_start = None
+
+
+    def __enter__(self):
+        if STATE["is_enabled"]: self.time_start = time.perf_counter()
+
+        return self
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.time_start is not None:
+            record(self.name, self.time_start, time.perf_counter() - self.time_start)
+            self.time_start = None
+
+        return False
+
+
+    def __call__(self, func):
+        name = self.name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not STATE["is_enabled"]: return func(*args, **kwargs)
+
+            time_start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time_start, time.perf_counter() - time_start)
+
+        return wrapper
+
+
+
+
+def get_summary(num_recent = None):
+    ''' Return the count, the last, the mean, the p50 and the p99 latency in
+        seconds of each span name among the num_recent latest spans.
+    '''
+    span_list = list(STATE["span_ring"])
+    if num_recent is not None: span_list = span_list[-num_recent:]
+
+    duration_dict = {}
+    for name, _, duration, _ in span_list:
+        duration_dict.setdefault(name, []).append(duration)
+
+    summary_dict = {}
+    for name, duration_list in duration_dict.items():
+        duration_arr = np.asarray(duration_list)
+        summary_dict[name] = {
+            "count" : len(duration_arr),
+            "last"  : float(duration_arr[-1]),
+            "mean"  : float(duration_arr.mean()),
+            "p50"   : float(np.percentile(duration_arr, 50)),
+            "p99"   : float(np.percentile(duration_arr, 99)),
+        }
+
+    return summary_dict
+
+
+def get_hit_rate(name_hit, name_miss):
+    ''' Return the hit rate from two counters, or None before any access.
+    '''
+    num_hit  = STATE["counter_dict"][name_hit]
+    num_miss = STATE["counter_dict"][name_miss]
+    num      = num_hit + num_miss
+
+    return num_hit / num if num > 0 else None
+
+
+def format_summary(num_recent = None):
+    summary_dict = get_summary(num_recent)
+
+    line_list = [ f"{'':<24s} {'count':>6s} {'last':>9s} {'p50':>9s} {'p99':>9s}  (ms)" ]
+    for name, summary in sorted(summary_dict.items()):
+        line_list.append(f"{name:<24s} {summary['count']:>6d} {summary['last'] * 1e3:>9.2f} "
+                         f"{summary['p50'] * 1e3:>9.2f} {summary['p99'] * 1e3:>9.2f}")
+
+    if len(STATE["counter_dict"]) > 0:
+        line_list.append("")
+        for name, num in sorted(STATE["counter_dict"].items()):
+            line_list.append(f"{name:<24s} {num:>6d}")
+
+    return "\n".join(line_list)
+
+
+def export_trace(path_json):
+    ''' Save recorded spans and counters in the Chrome trace event format.
+    '''
+    pid         = os.getpid()
+    time_origin = STATE["time_origin"]
+
+    event_list = []
+    for name, time_start, duration, tid in list(STATE["span_ring"]):
+        event_list.append({
+            "name" : name,
+            "ph"   : "X",
+            "ts"   : (time_start - time_origin) * 1e6,
+            "dur"  : duration * 1e6,
+            "pid"  : pid,
+            "tid"  : tid,
+        })
+
+    # Counters are totals, so they are shown once at the end...
+    if len(STATE["counter_dict"]) > 0:
+        event_list.append({
+            "name" : "counters",
+            "ph"   : "C",
+            "ts"   : (time.perf_counter() - time_origin) * 1e6,
+            "pid"  : pid,
+            "args" : dict(STATE["counter_dict"]),
+        })
+
+    with open(path_json, 'w') as fh:
+        json.dump({ "traceEvents" : event_list, "displayTimeUnit" : "ms" }, fh)
+
+    print(f"{len(event_list)} trace events are saved to {path_json}.")
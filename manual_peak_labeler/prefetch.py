@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import colorize_label, get_levels
+
+def prepare_frame(data_manager, idx, lut):
+    ''' Return everything needed to display an event, i.e. the masked image,
+        its display levels, the segmask and the colorized segmask.
+    '''
+    img, label = data_manager.fetch_img(idx)
+
+    frame = {
+        "idx"       : idx,
+        "img"       : img,
+        "label"     : label,
+        "levels"    : get_levels(img),
+        "layers"    : colorize_label(label, lut),
+        "num_peaks" : data_manager.get_num_peaks(idx),
+    }
+
+    return frame
+
+
+
+
+class Prefetcher:
+    """
+    Read ahead a window of events in worker threads.  h5py serializes file
+    access, but masking, level computation and colorization run in numpy,
+    which releases the GIL on large arrays.
+    """
+
+    def __init__(self, data_manager, depth = 8, num_workers = 2):
+        self.data_manager = data_manager
+        self.depth        = depth
+
+        self.executor    = ThreadPoolExecutor(max_workers = num_workers)
+        self.future_dict = {}
+
+        self.lut = self.data_manager.get_color_lut()
+
+        return None
+
+
+    def schedule(self, idx_list):
+        ''' Keep frames of idx_list in flight and drop all others.  Pass a
+            range rather than a list, so that only the first depth events are
+            ever looked at.
+        '''
+        idx_list = idx_list[:self.depth]
+
+        for idx in list(self.future_dict.keys()):
+            if idx in idx_list: continue
+            self.future_dict.pop(idx).cancel()
+
+        for idx in idx_list:
+            if idx in self.future_dict: continue
+            self.future_dict[idx] = self.executor.submit(prepare_frame, self.data_manager, idx, self.lut)
+
+
+    def get(self, idx):
+        ''' Return the frame if it is ready, otherwise None.
+        '''
+        future = self.future_dict.get(idx)
+        if future is None or not future.done(): return None
+
+        del self.future_dict[idx]
+
+        return future.result()
+
+
+    def close(self):
+        for future in self.future_dict.values(): future.cancel()
+        self.future_dict = {}
+        self.executor.shutdown(wait = False)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Propagate a label region, e.g. a beamstop shadow or a dead ASIC, from one
+event to many.  A region is a boolean mask of the displayed image, which is
+painted into (or erased from) one layer of every target event:
+
+- Buffered events are painted in place and saved with the rest of the buffer.
+- Other events are read, painted and written back as slabs of consecutive
+  events when the data manager holds the cxi files for writing, otherwise
+  event by event through write_segmask.
+
+Previous values of the region are kept in an undo record.
+"""
+
+import numpy as np
+
+from .         import perf
+from .data     import CXI_KEY
+from .geometry import assemble, disassemble
+
+def get_idx_list(expr, data_manager, idx_current = None):
+    ''' Return the sorted idx list selected by an expression of comma
+        separated terms, e.g. "0-99, 120, 200-, peaks>10, same file".
+
+        - Ranges ("a-b", "a-", "-b") and single events select events, and
+          all events are selected without any of them.
+        - "peaks>N", "peaks<N" and "same file", i.e. the cxi file of
+          idx_current, filter them.
+    '''
+    num_event = len(data_manager.idx_list)
+
+    is_selected = np.zeros(num_event, dtype = bool)
+    has_range   = False
+    filter_list = []
+    for term in expr.split(","):
+        term = term.strip()
+        if term == "": continue
+
+        if term.startswith("peaks>") or term.startswith("peaks<"):
+            filter_list.append((term[5], int(term[6:])))
+        elif term == "same file":
+            filter_list.append(("file", None))
+        elif "-" in term:
+            has_range = True
+            begin, end = term.split("-", 1)
+            begin = 0             if begin.strip() == "" else int(begin)
+            end   = num_event - 1 if end.strip()   == "" else int(end)
+            is_selected[max(begin, 0):min(end, num_event - 1) + 1] = True
+        else:
+            has_range = True
+            idx = int(term)
+            if 0 <= idx < num_event: is_selected[idx] = True
+
+    # No range means every event...
+    if not has_range: is_selected[:] = True
+
+    idx_list = []
+    for idx in np.nonzero(is_selected)[0].tolist():
+        is_kept = True
+        for kind, value in filter_list:
+            if kind == "file":
+                is_kept = data_manager.idx_list[idx][0] == data_manager.idx_list[idx_current][0]
+            else:
+                num_peaks = data_manager.get_num_peaks(idx)
+                is_kept   = num_peaks > value if kind == ">" else num_peaks < value
+            if not is_kept: break
+
+        if is_kept: idx_list.append(idx)
+
+    return idx_list
+
+
+def compact(values):
+    ''' Return label values in the smallest integer type that holds them, as
+        undo records of thousands of events add up.
+    '''
+    if values.size == 0 or values.dtype.kind not in 'iu' or values.min() < 0: return values
+
+    return values.astype(np.min_scalar_type(int(values.max())))
+
+
+def iter_slab(key_list, slab_size):
+    ''' Group sorted (path_cxi, event_idx) keys into slabs of consecutive
+        events in one file, and yield (path_cxi, event_begin, event_end).
+    '''
+    slab = None
+    for path_cxi, event_idx in key_list:
+        if slab is not None and (path_cxi != slab[0] or event_idx != slab[2] or slab[2] - slab[1] == slab_size):
+            yield slab
+            slab = None
+
+        if slab is None: slab = [ path_cxi, event_idx, event_idx ]
+        slab[2] = event_idx + 1
+
+    if slab is not None: yield slab
+
+
+def get_file_region(region, dataset, index_map):
+    ''' Return the region in the layout of a segmask dataset, i.e. taken
+        back to panel pixels for panel stacks.
+    '''
+    if dataset.ndim < 4: return region
+
+    return disassemble(region, index_map)
+
+
+@perf.timer("propagate_region")
+def propagate_region(data_manager, region, layer, idx_list, erases = False, slab_size = 32, callback = None):
+    ''' Paint (or erase) a region of the displayed image into (or from) a
+        layer of every event in idx_list.  callback(num_done, num_total) is
+        called along the way, and returning False from it stops early.
+        Return an undo record of what has been changed.
+    '''
+    idx_list  = sorted(set(idx_list))
+    num_total = len(idx_list)
+    num_done  = 0
+
+    record = {
+        "region"      : region,
+        "buffer_list" : [],    # (idx, label values)
+        "event_list"  : [],    # (idx, label values)
+        "slab_list"   : [],    # (path_cxi, event_begin, event_end, segmask values)
+    }
+
+    def report(num):
+        nonlocal num_done
+        num_done += num
+
+        return callback is None or callback(num_done, num_total) is not False
+
+    # Buffered labels are painted in place...
+    idx_buffered_list = [ idx for idx in idx_list if idx in data_manager.buffer_dict ]
+    for idx in idx_buffered_list:
+        label = data_manager.buffer_dict[idx][1]
+        record["buffer_list"].append((idx, compact(label[region])))
+        data_manager.paint_label(label, region, layer, erases)
+    if not report(len(idx_buffered_list)): return record
+
+    idx_remaining_list = [ idx for idx in idx_list if not idx in data_manager.buffer_dict ]
+
+    if not data_manager.can_write_slab:
+        for idx in idx_remaining_list:
+            _, label = data_manager.fetch_img(idx)
+            label  = label.copy()
+            values = compact(label[region])
+            data_manager.paint_label(label, region, layer, erases)
+
+            try:
+                if data_manager.write_segmask(idx, label, flushes = False): record["event_list"].append((idx, values))
+            except Exception as e:
+                print(f"Oops!!! Errors occurs while writing the segmask of event {idx}: {e}")
+
+            if not report(1): break
+
+        data_manager.flush_segmask()
+
+        return record
+
+    # Read, paint and write slabs of consecutive events...
+    key_list = [ tuple(data_manager.idx_list[idx][:2]) for idx in idx_remaining_list ]
+    for path_cxi, event_begin, event_end in iter_slab(key_list, slab_size):
+        dataset     = data_manager.cxi_dict[path_cxi]["file_handle"].get(CXI_KEY["segmask"])
+        region_file = get_file_region(region, dataset, data_manager.index_map)
+
+        with perf.timer("read slab"):
+            slab = dataset[event_begin:event_end]
+
+        # Without bit planes, the label is the slab itself...
+        values = compact(slab[:, region_file])
+        label  = data_manager.from_segmask(slab.copy())
+        data_manager.paint_label(label, (slice(None), region_file), layer, erases)
+        slab_new = data_manager.to_segmask(label, dtype = slab.dtype)
+
+        if not np.array_equal(slab_new, slab):
+            with perf.timer("write slab"):
+                dataset[event_begin:event_end] = slab_new
+            record["slab_list"].append((path_cxi, event_begin, event_end, values))
+
+        if not report(event_end - event_begin): break
+
+    data_manager.flush_segmask()
+
+    return record
+
+
+def get_idx_changed_list(record, data_manager):
+    ''' Return the idx list of events whose segmask in cxi files has been
+        changed by a propagation.
+    '''
+    idx_dict = { (path_cxi, event_idx) : idx for idx, (path_cxi, event_idx, _) in enumerate(data_manager.idx_list) }
+
+    idx_list = [ idx for idx, _ in record["event_list"] ]
+    for path_cxi, event_begin, event_end, _ in record["slab_list"]:
+        idx_list.extend(idx_dict[(path_cxi, event_idx)] for event_idx in range(event_begin, event_end))
+
+    return idx_list
+
+
+@perf.timer("undo_propagation")
+def undo_propagation(data_manager, record, callback = None):
+    ''' Restore the region of every event changed by a propagation.  Events
+        that have entered the buffer since then are restored in the buffer
+        as well, so that saving doesn't bring the propagation back.
+    '''
+    region = record["region"]
+
+    num_total = len(record["buffer_list"]) + len(record["event_list"]) + sum(e - b for _, b, e, _ in record["slab_list"])
+    num_done  = 0
+
+    def report(num):
+        nonlocal num_done
+        num_done += num
+        if callback is not None: callback(num_done, num_total)
+
+    # Labels saved since then are restored through the file...
+    event_list = []
+    for idx, values in record["buffer_list"]:
+        if idx in data_manager.buffer_dict:
+            data_manager.buffer_dict[idx][1][region] = values
+        else:
+            event_list.append((idx, values))
+    report(len(record["buffer_list"]) - len(event_list))
+
+    for idx, values in record["event_list"] + event_list:
+        if idx in data_manager.buffer_dict:
+            label = data_manager.buffer_dict[idx][1]
+        else:
+            _, label = data_manager.fetch_img(idx)
+            label = label.copy()
+        label[region] = values
+
+        if not idx in data_manager.buffer_dict: data_manager.write_segmask(idx, label, flushes = False)
+        report(1)
+
+    idx_dict = { (path_cxi, event_idx) : idx for idx, (path_cxi, event_idx, _) in enumerate(data_manager.idx_list) }
+    for path_cxi, event_begin, event_end, values in record["slab_list"]:
+        dataset     = data_manager.cxi_dict[path_cxi]["file_handle"].get(CXI_KEY["segmask"])
+        region_file = get_file_region(region, dataset, data_manager.index_map)
+
+        slab = dataset[event_begin:event_end]
+        slab[:, region_file] = values
+        dataset[event_begin:event_end] = slab
+
+        for i, event_idx in enumerate(range(event_begin, event_end)):
+            idx = idx_dict[(path_cxi, event_idx)]
+            if not idx in data_manager.buffer_dict: continue
+
+            # Restore the buffer from the restored segmask...
+            segmask = slab[i] if slab.ndim == 3 else assemble(slab[i], data_manager.index_map)
+            data_manager.buffer_dict[idx][1][region] = data_manager.from_segmask(segmask[region])
+
+        report(event_end - event_begin)
+
+    data_manager.flush_segmask()
+
+    return None
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Convert per-event datasets in a cxi file to one chunk per event with a fast
+lossless filter, so that saving the segmask of one event only rewrites that
+event.  Everything else in the file is copied as is, including soft and
+external links.
+
+Usage:
+    python -m manual_peak_labeler.rechunk input.cxi output.cxi [--data]
+"""
+
+import os
+import argparse
+import h5py
+import numpy as np
+
+from .data import CXI_KEY, get_layout_issue
+
+def create_rechunked_dataset(group, name, dataset_in, compression = 'lzf', compression_opts = None):
+    ''' Create an empty dataset like dataset_in, but with one chunk per event.
+    '''
+    chunks = (1, ) + dataset_in.shape[1:]
+
+    # Shuffling bytes makes integer labels compress a lot better...
+    uses_shuffle = np.issubdtype(dataset_in.dtype, np.integer) and dataset_in.dtype.itemsize > 1
+
+    dataset_out = group.create_dataset(name, shape            = dataset_in.shape,
+                                             maxshape         = dataset_in.maxshape,
+                                             dtype            = dataset_in.dtype,
+                                             chunks           = chunks,
+                                             compression      = compression,
+                                             compression_opts = compression_opts,
+                                             shuffle          = uses_shuffle,
+                                             fillvalue        = dataset_in.fillvalue)
+    for k, v in dataset_in.attrs.items(): dataset_out.attrs[k] = v
+
+    return dataset_out
+
+
+def iter_block(num_event, block_size):
+    for event_begin in range(0, num_event, block_size):
+        yield event_begin, min(event_begin + block_size, num_event)
+
+
+def align_block_size(dataset, block_size):
+    ''' Round block_size to a multiple of the events per chunk of dataset, so
+        that no chunk is read and decompressed by two blocks.
+    '''
+    if dataset.chunks is None: return block_size
+
+    chunk_size = dataset.chunks[0]
+
+    return max(chunk_size, block_size // chunk_size * chunk_size)
+
+
+def copy_group(group_in, group_out, path_rechunk_list, compression, compression_opts, block_size):
+    for k, v in group_in.attrs.items(): group_out.attrs[k] = v
+
+    for name in group_in:
+        link = group_in.get(name, getlink = True)
+
+        # Keep links as links rather than copying their targets...
+        if isinstance(link, h5py.SoftLink):
+            group_out[name] = h5py.SoftLink(link.path)
+            continue
+        if isinstance(link, h5py.ExternalLink):
+            group_out[name] = h5py.ExternalLink(link.filename, link.path)
+            continue
+
+        obj = group_in[name]
+
+        if isinstance(obj, h5py.Group):
+            copy_group(obj, group_out.require_group(name), path_rechunk_list, compression, compression_opts, block_size)
+            continue
+
+        # Copy the rest as is...
+        if not obj.name in path_rechunk_list or obj.ndim < 3:
+            group_in.copy(obj, group_out, name = name)
+            continue
+
+        dataset_out = create_rechunked_dataset(group_out, name, obj, compression, compression_opts)
+        for event_begin, event_end in iter_block(obj.shape[0], align_block_size(obj, block_size)):
+            dataset_out[event_begin:event_end] = obj[event_begin:event_end]
+
+        print(f"{obj.name} is rechunked.")
+
+
+def rechunk_cxi(path_in, path_out, key_list = ('segmask', ), compression = 'lzf', compression_opts = None, block_size = 64):
+    ''' Copy a cxi file while rechunking datasets in key_list.  Datasets are
+        streamed in blocks of events aligned to their chunks, so memory stays
+        bounded.
+    '''
+    path_rechunk_list = [ CXI_KEY[k] for k in key_list ]
+
+    with h5py.File(path_in, 'r') as fh_in, h5py.File(path_out, 'w') as fh_out:
+        copy_group(fh_in, fh_out, path_rechunk_list, compression, compression_opts, block_size)
+
+    return None
+
+
+def verify_cxi(path_in, path_out, key_list = ('segmask', ), block_size = 64):
+    ''' Return whether rechunked datasets hold the same content as the
+        original ones.
+    '''
+    is_same = True
+    with h5py.File(path_in, 'r') as fh_in, h5py.File(path_out, 'r') as fh_out:
+        for k in key_list:
+            dataset_in  = fh_in.get(CXI_KEY[k])
+            dataset_out = fh_out.get(CXI_KEY[k])
+
+            if dataset_out is None or dataset_in.shape != dataset_out.shape or dataset_in.dtype != dataset_out.dtype:
+                print(f"Mismatched {k}: shape or dtype differs.")
+                is_same = False
+                continue
+
+            for event_begin, event_end in iter_block(dataset_in.shape[0], align_block_size(dataset_in, block_size)):
+                if not np.array_equal(dataset_in[event_begin:event_end], dataset_out[event_begin:event_end]):
+                    print(f"Mismatched {k} within events [{event_begin}, {event_end}).")
+                    is_same = False
+                    break
+
+    return is_same
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Rechunk per-event datasets in a cxi file to one chunk per event.")
+    parser.add_argument("path_in" , help = "Input cxi file.")
+    parser.add_argument("path_out", help = "Output cxi file.")
+    parser.add_argument("--data"       , action = "store_true", help = "Also rechunk the data and the mask.")
+    parser.add_argument("--compression", default = "lzf", help = "HDF5 filter, e.g. lzf or gzip (default: lzf).")
+    parser.add_argument("--level"      , type = int, default = None, help = "Compression level for gzip.")
+    parser.add_argument("--block_size" , type = int, default = 64, help = "Number of events streamed at a time, rounded to whole input chunks.")
+    parser.add_argument("--no_verify"  , action = "store_true", help = "Skip verifying the output against the input.")
+    args = parser.parse_args()
+
+    key_list = ('segmask', 'data', 'mask') if args.data else ('segmask', )
+
+    with h5py.File(args.path_in, 'r') as fh:
+        for k in key_list:
+            issue = get_layout_issue(fh.get(CXI_KEY[k]))
+            print(f"{CXI_KEY[k]}: {'fine' if issue is None else issue}")
+
+    rechunk_cxi(args.path_in, args.path_out, key_list, args.compression, args.level, args.block_size)
+
+    if args.no_verify: return None
+
+    if not verify_cxi(args.path_in, args.path_out, key_list, args.block_size):
+        raise SystemExit(f"{args.path_out} doesn't match {args.path_in}!!!")
+
+    size_in  = os.path.getsize(args.path_in)
+    size_out = os.path.getsize(args.path_out)
+    print(f"{args.path_out} is verified ({size_in / 2**20:.1f} MB -> {size_out / 2**20:.1f} MB).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Report the state of labeling across a run.  Segmasks, masks and peak counts
+are streamed in blocks of events from a process pool, and each event is
+reduced to a few numbers:
+
+- pixels per layer,
+- peak blobs, i.e. connected components of the peak layer,
+- whether it is unlabeled or fully masked,
+- label pixels per layer that overlap the bad pixel mask,
+- the difference between peak blobs and nPeaks.
+
+Usage:
+    python -m manual_peak_labeler.report run.yaml [--output report.json] [--text report.txt]
+"""
+
+import json
+import argparse
+import yaml
+import numpy as np
+import multiprocessing as mp
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from .data import CXI_KEY, open_cxi_readonly, get_default_layer_manager
+
+def count_blobs(is_labeled):
+    import skimage.measure as sm
+
+    # Most frames of a run in progress are unlabeled...
+    if not is_labeled.any(): return 0
+
+    # Panels of a stack are labeled in 2-D as one image with an empty row
+    # after each panel, so that blobs on adjacent panels never merge...
+    if is_labeled.ndim == 3:
+        is_labeled = np.pad(is_labeled, ((0, 0), (0, 1), (0, 0))).reshape(-1, is_labeled.shape[-1])
+
+    return int(sm.label(is_labeled).max())
+
+
+def summarize_block(path_cxi, event_begin, event_end, num_layer, layer_peak):
+    ''' Reduce a block of events in one cxi file to per-event numbers.  It
+        runs in a worker process, so the file is opened read only.
+    '''
+    with open_cxi_readonly(path_cxi) as fh:
+        segmask_block   = fh.get(CXI_KEY["segmask"])[event_begin:event_end]
+        num_peaks_block = fh.get(CXI_KEY["num_peaks"])[event_begin:event_end]
+
+        # The mask is either per event or shared...
+        mask = fh.get(CXI_KEY["mask"])
+        mask_block = mask[event_begin:event_end] if mask.ndim == segmask_block.ndim else mask[()][None,]
+
+    num_event = event_end - event_begin
+    summary = {
+        "num_pixel"   : np.zeros((num_event, num_layer), dtype = 'int64'),
+        "num_overlap" : np.zeros((num_event, num_layer), dtype = 'int64'),
+        "num_blob"    : np.zeros(num_event, dtype = 'int64'),
+        "num_peaks"   : num_peaks_block.astype('int64'),
+        "is_masked"   : np.zeros(num_event, dtype = bool),
+    }
+
+    for i, segmask in enumerate(segmask_block):
+        is_bad = mask_block[i if len(mask_block) > 1 else 0] != 0
+
+        # Encodings beyond the layers in use are counted with the last one...
+        segmask = np.clip(segmask, 0, num_layer - 1).ravel()
+
+        summary["num_pixel"  ][i] = np.bincount(segmask, minlength = num_layer)
+        summary["num_overlap"][i] = np.bincount(segmask[is_bad.ravel()], minlength = num_layer)
+        summary["num_blob"   ][i] = count_blobs(segmask.reshape(is_bad.shape) == layer_peak)
+        summary["is_masked"  ][i] = is_bad.all()
+
+    return path_cxi, event_begin, summary
+
+
+def build_report(path_cxi_list, layer_manager = None, layer_peak = 1, num_workers = None, block_size = 16, max_pending = None):
+    ''' Return per-event numbers of all events in path_cxi_list, keyed by the
+        cxi file.  At most max_pending blocks are in flight, so memory stays
+        bounded.
+    '''
+    layer_manager = get_default_layer_manager() if layer_manager is None else layer_manager
+    num_layer     = max(layer_manager['layer_order']) + 1
+
+    num_workers = mp.cpu_count() if num_workers is None else num_workers
+    max_pending = 2 * num_workers if max_pending is None else max_pending
+
+    # Allocate per-event arrays of each cxi file...
+    event_dict = {}
+    block_list = []
+    for path_cxi in dict.fromkeys(path_cxi_list):
+        with open_cxi_readonly(path_cxi) as fh:
+            num_event = len(fh.get(CXI_KEY["num_peaks"]))
+
+        event_dict[path_cxi] = {
+            "num_pixel"   : np.zeros((num_event, num_layer), dtype = 'int64'),
+            "num_overlap" : np.zeros((num_event, num_layer), dtype = 'int64'),
+            "num_blob"    : np.zeros(num_event, dtype = 'int64'),
+            "num_peaks"   : np.zeros(num_event, dtype = 'int64'),
+            "is_masked"   : np.zeros(num_event, dtype = bool),
+        }
+        for event_begin in range(0, num_event, block_size):
+            block_list.append((path_cxi, event_begin, min(event_begin + block_size, num_event)))
+
+    with ProcessPoolExecutor(max_workers = num_workers, mp_context = mp.get_context('spawn')) as executor:
+        pending_set = set()
+        block_iter  = iter(block_list)
+        num_done    = 0
+        while True:
+            while len(pending_set) < max_pending:
+                block = next(block_iter, None)
+                if block is None: break
+
+                pending_set.add(executor.submit(summarize_block, *block, num_layer, layer_peak))
+
+            if len(pending_set) == 0: break
+
+            done_set, pending_set = wait(pending_set, return_when = FIRST_COMPLETED)
+            for future in done_set:
+                path_cxi, event_begin, summary = future.result()
+                for k, v in summary.items():
+                    event_dict[path_cxi][k][event_begin:event_begin + len(v)] = v
+
+                num_done += 1
+                if num_done % 100 == 0: print(f"{num_done}/{len(block_list)} blocks are summarized.")
+
+    return event_dict
+
+
+def summarize_report(event_dict, layer_manager = None, tolerance = 0):
+    ''' Return a JSON-friendly summary of per-event numbers.  A labeled event
+        disagrees with nPeaks when their difference exceeds tolerance.
+    '''
+    layer_manager  = get_default_layer_manager() if layer_manager is None else layer_manager
+    layer_metadata = layer_manager['layer_metadata']
+
+    def name_layer(num_per_layer, skips_background = False):
+        return { layer_metadata.get(encode, {'name' : str(encode)})['name'] : int(v)
+                 for encode, v in enumerate(num_per_layer) if encode > 0 or not skips_background }
+
+    report = { "total" : {}, "cxi" : {} }
+    total  = { "num_event" : 0, "num_labeled" : 0, "num_masked" : 0, "num_disagreed" : 0, "num_blob" : 0, "num_peaks" : 0 }
+    num_pixel_total   = 0
+    num_overlap_total = 0
+    for path_cxi, event in event_dict.items():
+        is_labeled   = event["num_pixel"][:, 1:].sum(axis = 1) > 0
+        is_overlapped = event["num_overlap"][:, 1:].sum(axis = 1) > 0
+        is_disagreed = is_labeled & (np.abs(event["num_blob"] - event["num_peaks"]) > tolerance)
+
+        report["cxi"][path_cxi] = {
+            "num_event"           : len(is_labeled),
+            "num_pixel"           : name_layer(event["num_pixel"].sum(axis = 0)),
+            "num_overlap"         : name_layer(event["num_overlap"].sum(axis = 0), skips_background = True),
+            "unlabeled_event"     : np.nonzero(~is_labeled)[0].tolist(),
+            "masked_event"        : np.nonzero(event["is_masked"])[0].tolist(),
+            "overlapped_event"    : np.nonzero(is_overlapped)[0].tolist(),
+            "disagreed_event"     : np.nonzero(is_disagreed)[0].tolist(),
+            "num_blob_per_event"  : event["num_blob"].tolist(),
+            "num_peaks_per_event" : event["num_peaks"].tolist(),
+        }
+
+        total["num_event"]     += len(is_labeled)
+        total["num_labeled"]   += int(is_labeled.sum())
+        total["num_masked"]    += int(event["is_masked"].sum())
+        total["num_disagreed"] += int(is_disagreed.sum())
+        total["num_blob"]      += int(event["num_blob"][is_labeled].sum())
+        total["num_peaks"]     += int(event["num_peaks"][is_labeled].sum())
+        num_pixel_total   = num_pixel_total   + event["num_pixel"].sum(axis = 0)
+        num_overlap_total = num_overlap_total + event["num_overlap"].sum(axis = 0)
+
+    total["num_pixel"]   = name_layer(np.atleast_1d(num_pixel_total))
+    total["num_overlap"] = name_layer(np.atleast_1d(num_overlap_total), skips_background = True)
+    report["total"] = total
+
+    return report
+
+
+def format_report(report, max_event = 10):
+    ''' Return a compact text summary of a report.
+    '''
+    def format_event_list(event_list):
+        shown = ", ".join(str(event_idx) for event_idx in event_list[:max_event])
+        if len(event_list) > max_event: shown += f", ... ({len(event_list)} events)"
+
+        return shown
+
+    total = report["total"]
+    line_list = [
+        f"Events     : {total['num_event']} ({total['num_labeled']} labeled, {total['num_masked']} fully masked)",
+        f"Peak blobs : {total['num_blob']} in labeled events, where nPeaks counts {total['num_peaks']}",
+        f"Disagreed  : {total['num_disagreed']} labeled events with peak blobs different from nPeaks",
+        f"Pixels     : " + ", ".join(f"{name} {v}" for name, v in total["num_pixel"].items()),
+        f"Overlapped : " + ", ".join(f"{name} {v}" for name, v in total["num_overlap"].items()) + " label pixels on bad pixels",
+    ]
+
+    for path_cxi, summary in report["cxi"].items():
+        line_list.append("")
+        line_list.append(f"{path_cxi} ({summary['num_event']} events)")
+        for k in ("unlabeled_event", "masked_event", "overlapped_event", "disagreed_event"):
+            if len(summary[k]) == 0: continue
+            line_list.append(f"  {k.replace('_event', ''):<11s}: {format_event_list(summary[k])}")
+
+    return "\n".join(line_list)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Report the state of labeling across all events listed in a yaml file.")
+    parser.add_argument("path_yaml", help = "The yaml file listing cxi files.")
+    parser.add_argument("--output"     , default = None, help = "Save the report to a JSON file.")
+    parser.add_argument("--text"       , default = None, help = "Save the text summary to a file.")
+    parser.add_argument("--layer_peak" , type = int, default = 1, help = "Encoding of the peak layer.")
+    parser.add_argument("--tolerance"  , type = int, default = 0, help = "Allowed difference between peak blobs and nPeaks.")
+    parser.add_argument("--num_workers", type = int, default = None)
+    parser.add_argument("--block_size" , type = int, default = 16, help = "Number of events read at a time.")
+    args = parser.parse_args()
+
+    with open(args.path_yaml, 'r') as fh:
+        config = yaml.safe_load(fh)
+
+    event_dict = build_report(config['cxi'], layer_peak = args.layer_peak, num_workers = args.num_workers, block_size = args.block_size)
+    report     = summarize_report(event_dict, tolerance = args.tolerance)
+    text       = format_report(report)
+
+    print(text)
+
+    if args.output is not None:
+        with open(args.output, 'w') as fh: json.dump(report, fh)
+
+    if args.text is not None:
+        with open(args.text, 'w') as fh: fh.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Serve events from a separate process, so that slow reads never stall the GUI
+under the GIL.  The server owns the cxi files and a PeakNetData, and writes
+ready frames into a shared memory ring buffer that the GUI maps without
+copying.  Requests and label writes go through a pipe.
+
+Shared memory requires python >= 3.8.
+"""
+
+import sys
+import time
+import types
+import threading
+import multiprocessing as mp
+import numpy as np
+
+from .      import perf
+from .data  import PeakNetData, DataManager, CXI_KEY
+from .utils import apply_mask, set_seed, get_layer_bits, remap_bitplane
+
+# Methods of PeakNetData that a client can call on the server...
+SERVER_METHOD_LIST = [ 'get_num_peaks', 'get_peak_positions', 'write_segmask', 'flush_segmask' ]
+
+# Config forwarded to the server, which always deals with integer segmasks...
+SERVER_CONFIG_LIST = [ 'path_yaml', 'username', 'seed', 'layer_manager', 'dir_thumbnail', 'uses_memmap',
+                       'path_geometry', 'dir_geometry' ]
+
+def get_slot_layout(shape_img, dtype_img, shape_label, dtype_label, alignment = 64):
+    ''' Return the offset of the label and the size of a slot that holds one
+        image followed by its label.
+    '''
+    def align(size): return -(-size // alignment) * alignment
+
+    size_img     = align(int(np.prod(shape_img))   * np.dtype(dtype_img).itemsize)
+    size_label   = align(int(np.prod(shape_label)) * np.dtype(dtype_label).itemsize)
+
+    return size_img, size_img + size_label
+
+
+def serve(conn, config_data):
+    ''' Main loop of the server process.
+    '''
+    from multiprocessing import shared_memory
+
+    data_manager = PeakNetData(config_data)
+
+    # Find the largest slot needed by any cxi file...
+    size_slot  = 0
+    dtype_dict = {}
+    for path_cxi, cxi in data_manager.cxi_dict.items():
+        fh      = cxi["file_handle"]
+        data    = fh.get(CXI_KEY["data"])
+        segmask = fh.get(CXI_KEY["segmask"])
+
+        # Let numpy tell the dtype of a masked image...
+        dtype_img = apply_mask(np.zeros(1, dtype = data.dtype), np.ones(1), mask_value = 0).dtype
+
+        # Panel stacks are served assembled...
+        shape_img = data.shape[1:] if data.ndim == 3 else data_manager.index_map["shape_img"]
+
+        _, size = get_slot_layout(shape_img, dtype_img, shape_img, segmask.dtype)
+        size_slot = max(size_slot, size)
+        dtype_dict[path_cxi] = segmask.dtype.str
+
+    key_list = [ (path_cxi, event_idx) for path_cxi, event_idx, _ in data_manager.idx_list ]
+    conn.send((size_slot, key_list, dtype_dict))
+
+    # Map the ring buffer created by the client...
+    name_shm, num_slot = conn.recv()
+    shm = shared_memory.SharedMemory(name = name_shm)
+
+    while True:
+        req_id, cmd, args = conn.recv()
+
+        if cmd == 'close': break
+
+        try:
+            if cmd == 'frame':
+                idx, slot = args
+                img, segmask = data_manager.fetch_img(idx)
+
+                offset = slot * size_slot
+                offset_label, _ = get_slot_layout(img.shape, img.dtype, segmask.shape, segmask.dtype)
+                np.ndarray(img.shape, dtype = img.dtype, buffer = shm.buf, offset = offset)[...] = img
+                np.ndarray(segmask.shape, dtype = segmask.dtype, buffer = shm.buf, offset = offset + offset_label)[...] = segmask
+
+                result = (img.shape, img.dtype.str, segmask.shape, segmask.dtype.str)
+
+            elif cmd in SERVER_METHOD_LIST:
+                result = getattr(data_manager, cmd)(*args)
+
+            else:
+                raise ValueError(f"Unknown command {cmd}")
+
+            conn.send((req_id, True, result))
+
+        except Exception as e:
+            conn.send((req_id, False, repr(e)))
+
+    data_manager.close()
+    shm.close()
+    conn.close()
+
+
+
+
+class RemoteData(PeakNetData):
+    """
+    A drop-in replacement of PeakNetData whose events are served by a
+    separate process.
+
+    - Images are read-only views into the shared memory ring buffer.  A slot
+      is reused once num_slot newer frames have been requested, except the
+      one of the current event, so num_slot should be larger than any read
+      ahead depth in use (the prefetcher reads 8 events ahead).
+    - Labels are copied out of the ring buffer, edited locally and sent back
+      on saving.
+    - While waiting for the server, Qt events except user input keep being
+      processed, so the GUI keeps repainting, and keys or clicks, e.g. the
+      next N, wait until the frame has arrived instead of reentering get_img.
+    - The lock only guards the bookkeeping and is never held while waiting,
+      so a slow read ahead by the prefetcher doesn't block the GUI.  One
+      thread at a time reads responses from the pipe for all waiters.
+    """
+
+    can_write_slab = False
+
+    def __init__(self, config_data, num_slot = 16, depth = 4):
+        DataManager.__init__(self)
+
+        from multiprocessing import shared_memory
+
+        self.load_config(config_data)
+
+        config_server = types.SimpleNamespace(**{ k : getattr(self, k) for k in SERVER_CONFIG_LIST })
+
+        # Start the server...
+        ctx = mp.get_context('spawn')
+        self.conn, conn_server = ctx.Pipe()
+        self.process = ctx.Process(target = serve, args = (conn_server, config_server), daemon = True)
+        self.process.start()
+        conn_server.close()
+
+        # Create the ring buffer...
+        size_slot, key_list, dtype_dict = self.conn.recv()
+        self.shm = shared_memory.SharedMemory(create = True, size = num_slot * size_slot)
+        self.conn.send((self.shm.name, num_slot))
+
+        # Internal variables...
+        self.CXI_KEY       = CXI_KEY
+        self.idx_list      = [ (path_cxi, event_idx, None) for path_cxi, event_idx in key_list ]
+        self.path_cxi_list = list(dtype_dict.keys())
+        self.dtype_dict    = dtype_dict
+        self.buffer_dict   = {}
+
+        self.size_slot   = size_slot
+        self.num_slot    = num_slot
+        self.depth       = depth
+        self.slot_owner  = [ None ] * num_slot
+        self.slot_next   = 0
+        self.idx_current = None
+
+        self.req_id        = 0
+        self.frame_dict    = {}    # idx    -> (img, label) in the ring buffer
+        self.pending_dict  = {}    # req_id -> (idx, slot)
+        self.pending_idx   = {}    # idx    -> req_id
+        self.response_dict = {}    # req_id -> (is_ok, result)
+
+        self.lock      = threading.RLock()
+        self.lock_recv = threading.Lock()
+        self.is_open   = True
+
+        set_seed(self.seed)
+
+        return None
+
+
+    def close(self):
+        if not self.is_open: return None
+
+        with self.lock:
+            self.conn.send((None, 'close', ()))
+            self.process.join(timeout = 5)
+            self.conn.close()
+
+            # Views held elsewhere, e.g. by the window, keep the mapping alive...
+            self.frame_dict  = {}
+            self.buffer_dict = {}
+            try:
+                self.shm.close()
+            except BufferError:
+                pass
+            self.shm.unlink()
+
+            self.is_open = False
+            print(f"Data server is closed.")
+
+
+    ##############
+    ### SERVER ###
+    ##############
+    def send(self, cmd, *args):
+        with self.lock:
+            self.req_id += 1
+            self.conn.send((self.req_id, cmd, args))
+
+            return self.req_id
+
+
+    def recv(self):
+        req_id, is_ok, result = self.conn.recv()
+
+        with self.lock: self.adopt(req_id, is_ok, result)
+
+
+    def adopt(self, req_id, is_ok, result):
+        if not req_id in self.pending_dict:
+            self.response_dict[req_id] = (is_ok, result)
+            return None
+
+        # Adopt a frame in the ring buffer...
+        idx, slot = self.pending_dict.pop(req_id)
+        del self.pending_idx[idx]
+
+        if not is_ok:
+            print(f"Oops!!! Errors occurs while serving event {idx}: {result}")
+            return None
+
+        shape_img, dtype_img, shape_label, dtype_label = result
+        offset = slot * self.size_slot
+        offset_label, _ = get_slot_layout(shape_img, dtype_img, shape_label, dtype_label)
+
+        img = np.ndarray(shape_img, dtype = dtype_img, buffer = self.shm.buf, offset = offset)
+        img.flags.writeable = False
+
+        label = np.ndarray(shape_label, dtype = dtype_label, buffer = self.shm.buf, offset = offset + offset_label)
+        label = self.from_segmask(label.copy())
+
+        self.frame_dict[idx] = (img, label)
+
+
+    def wait(self, is_done):
+        ''' Receive responses until is_done() is True.  Call it without
+            holding the lock.
+        '''
+        # Only pump Qt events in the GUI thread of a GUI session...
+        Qt  = sys.modules.get('pyqtgraph.Qt')
+        app = None
+        if Qt is not None and threading.current_thread() is threading.main_thread():
+            app = Qt.QtWidgets.QApplication.instance()
+
+        while True:
+            with self.lock:
+                if is_done(): return None
+
+            # Another thread is receiving for everyone...
+            is_received = False
+            if self.lock_recv.acquire(blocking = False):
+                try:
+                    is_received = self.conn.poll(0.01)
+                    if is_received: self.recv()
+                finally:
+                    self.lock_recv.release()
+            else:
+                time.sleep(0.002)
+
+            if not is_received and app is not None:
+                # User input stays queued, so no handler reenters the caller...
+                app.processEvents(Qt.QtCore.QEventLoop.ExcludeUserInputEvents)
+
+
+    def call(self, method, *args):
+        req_id = self.send(method, *args)
+        self.wait(lambda: req_id in self.response_dict)
+
+        with self.lock: is_ok, result = self.response_dict.pop(req_id)
+
+        if not is_ok: raise RuntimeError(result)
+
+        return result
+
+
+    def allocate_slot(self):
+        ''' Return the next slot that is neither pending nor showing the
+            current event, or None if all slots are busy.
+        '''
+        for _ in range(self.num_slot):
+            slot = self.slot_next
+            self.slot_next = (self.slot_next + 1) % self.num_slot
+
+            idx_old = self.slot_owner[slot]
+            if idx_old is not None and (idx_old in self.pending_idx or idx_old == self.idx_current): continue
+
+            # The old frame is gone, but its label is kept...
+            if idx_old is not None:
+                self.frame_dict.pop(idx_old, None)
+                if idx_old in self.buffer_dict: self.buffer_dict[idx_old] = (None, self.buffer_dict[idx_old][1])
+
+            return slot
+
+        return None
+
+
+    def request_frame(self, idx):
+        ''' Register a request of a frame unless it is already there or on its
+            way.  Return False if all slots are busy.
+        '''
+        with self.lock:
+            if idx in self.frame_dict or idx in self.pending_idx: return True
+
+            slot = self.allocate_slot()
+            if slot is None: return False
+            self.slot_owner[slot] = idx
+
+            req_id = self.send('frame', idx, slot)
+            self.pending_dict[req_id] = (idx, slot)
+            self.pending_idx[idx]     = req_id
+
+            return True
+
+
+    def get_frame(self, idx):
+        # Wait for any pending frame to free a slot...
+        while not self.request_frame(idx):
+            with self.lock: num_pending = len(self.pending_idx)
+            self.wait(lambda: len(self.pending_idx) < num_pending)
+
+        self.wait(lambda: idx in self.frame_dict or not idx in self.pending_idx)
+
+        with self.lock:
+            if not idx in self.frame_dict: raise RuntimeError(f"Event {idx} can't be served!!!")
+
+            return self.frame_dict[idx]
+
+
+    ############
+    ### DATA ###
+    ############
+    @perf.timer("get_img")
+    def get_img(self, idx):
+        with self.lock:
+            self.idx_current = idx
+            img, segmask = self.buffer_dict.get(idx, (None, None))
+
+        perf.count("buffer miss" if img is None else "buffer hit")
+        if img is None:
+            img, segmask_served = self.get_frame(idx)
+
+            with self.lock:
+                # A label may have been buffered in the meantime...
+                segmask = self.buffer_dict.get(idx, (None, segmask_served))[1]
+                if segmask is None: segmask = segmask_served
+
+                self.buffer_dict[idx] = (img, segmask)
+            print(f"Event {self.idx_list[idx][1]} is in the buffer.")
+
+        # Read ahead as far as slots are free...
+        for idx_next in range(idx + 1, min(idx + 1 + self.depth, len(self.idx_list))):
+            if not self.request_frame(idx_next): break
+
+        self.sync_random_state(idx)
+
+        return img[None,], segmask[None,]
+
+
+    def fetch_img(self, idx):
+        with self.lock: img, segmask = self.buffer_dict.get(idx, (None, None))
+        if img is not None: return img, segmask
+
+        img, segmask_served = self.get_frame(idx)
+
+        return img, segmask_served if segmask is None else segmask
+
+
+    def set_layer_manager(self, layer_manager):
+        # Labels of frames in the ring buffer are in bit planes too...
+        with self.lock:
+            layer_bits = get_layer_bits(layer_manager['layer_order'])
+
+            if self.uses_bitplane and layer_bits != self.layer_bits:
+                for idx, (img, label) in self.frame_dict.items():
+                    self.frame_dict[idx] = (img, remap_bitplane(label, self.layer_bits, layer_bits))
+
+            super().set_layer_manager(layer_manager)
+
+
+    def get_num_peaks(self, idx):
+        return self.call('get_num_peaks', idx)
+
+
+    def get_peak_positions(self, idx):
+        return self.call('get_peak_positions', idx)
+
+
+    def get_segmask_dtype(self, idx):
+        path_cxi, _, _ = self.idx_list[idx]
+
+        return np.dtype(self.dtype_dict[path_cxi])
+
+
+    def write_segmask(self, idx, label, flushes = True):
+        segmask = self.to_segmask(label, dtype = self.get_segmask_dtype(idx))
+        is_written = self.call('write_segmask', idx, segmask, flushes)
+
+        # The frame in the ring buffer has the old label, so serve it again...
+        if is_written:
+            with self.lock: self.frame_dict.pop(idx, None)
+
+        return is_written
+
+
+    def flush_segmask(self):
+        return self.call('flush_segmask')
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import zlib
+import h5py
+import numpy as np
+import multiprocessing as mp
+
+from concurrent.futures import ProcessPoolExecutor
+
+from .utils    import downsample
+from .data     import CXI_KEY, open_cxi_readonly, read_masked_img
+from .geometry import get_index_map, load_geometry, assemble
+
+def get_bin_size(shape, max_size = 128):
+    ''' Return the bin size that turns a frame into a thumbnail whose longest
+        side is no longer than max_size.
+    '''
+    return max(1, -(-max(shape[-2:]) // max_size))
+
+
+def get_segmask_crc(segmask):
+    return zlib.crc32(np.ascontiguousarray(segmask)) & 0xFFFFFFFF
+
+
+def get_file_stamp(path_cxi, fh):
+    ''' Return (device, inode, *segmask shape) of an opened cxi file, which
+        changes when the file is replaced, e.g. by rechunking, or resized, but
+        not when segmasks are written in place, unlike its mtime.
+    '''
+    stat  = os.stat(path_cxi)
+    shape = fh.get(CXI_KEY["segmask"]).shape
+
+    return (int(stat.st_dev), int(stat.st_ino)) + tuple(int(v) for v in shape)
+
+
+def make_thumbnail_img(img, bin_size):
+    ''' Downsample a masked image and scale it to uint8 with the same levels
+        used by the main viewer.
+    '''
+    img_thumb = downsample(img, bin_size, bin_size, mask = (img != 0).astype('float32'))
+
+    vmin = np.mean(img_thumb)
+    vmax = vmin + 8 * np.std(img_thumb)
+    img_thumb = (img_thumb - vmin) / (vmax - vmin + 1e-6)
+    img_thumb = np.clip(img_thumb, 0, 1) * 255
+
+    return img_thumb.astype('uint8')
+
+
+def make_thumbnail_label(segmask, bin_size):
+    ''' Downsample a segmask by taking the max in each block, so that a
+        single labeled pixel survives the downsampling.
+    '''
+    size_y, size_x = segmask.shape[-2:]
+    pad_y = -size_y % bin_size
+    pad_x = -size_x % bin_size
+    segmask = np.pad(segmask, ((0, pad_y), (0, pad_x)))
+
+    size_y, size_x = segmask.shape
+    label_thumb = segmask.reshape(size_y // bin_size, bin_size, size_x // bin_size, bin_size).max(axis = (1, 3))
+
+    return np.clip(label_thumb, 0, 255).astype('uint8')
+
+
+def make_thumbnail_batch(path_cxi, event_idx_list, max_size = 128, path_geometry = None, dir_geometry = None, crc_list = None):
+    ''' Produce thumbnails of a batch of events in one cxi file.  It runs in a
+        worker process, so the file is opened read only.  Panel stacks are
+        assembled with the geometry in path_geometry.
+
+        With crc_list, i.e. the crc of the segmask behind each cached
+        thumbnail, only events whose segmask has changed are produced, and
+        images of the others are never read.
+    '''
+    index_map = None
+    if path_geometry is not None: index_map = get_index_map(*load_geometry(path_geometry), dir_cache = dir_geometry)
+
+    crc_list = [ None ] * len(event_idx_list) if crc_list is None else crc_list
+
+    thumbnail_list = []
+    with open_cxi_readonly(path_cxi) as fh:
+        stamp = get_file_stamp(path_cxi, fh)
+
+        for event_idx, crc_cached in zip(event_idx_list, crc_list):
+            segmask = fh.get(CXI_KEY["segmask"])[event_idx]
+            if segmask.ndim == 3: segmask = assemble(segmask, index_map)
+
+            crc = get_segmask_crc(segmask)
+            if crc == crc_cached: continue
+
+            img = read_masked_img(fh, event_idx)
+            if img.ndim == 3: img = assemble(img, index_map)
+
+            bin_size    = get_bin_size(img.shape, max_size)
+            img_thumb   = make_thumbnail_img(img, bin_size)
+            label_thumb = make_thumbnail_label(segmask, bin_size)
+
+            thumbnail_list.append((event_idx, img_thumb, label_thumb, crc))
+
+    return path_cxi, stamp, thumbnail_list
+
+
+
+
+class ThumbnailCache:
+    """
+    An on-disk thumbnail cache keyed by (path_cxi, event_idx).  Only the main
+    process reads from or writes to the cache files.
+
+    Each cxi file has its own cache file holding the following datasets, all
+    indexed by the event index in the cxi file.
+    - img      : (N, h, w) uint8, the downsampled image scaled to [0, 255].
+    - label    : (N, h, w) uint8, the block max of the segmask.
+    - crc      : (N,) uint32, the crc32 of the segmask behind the label.
+    - is_valid : (N,) bool, whether a thumbnail has been produced.
+
+    The stamp of the cxi file, see get_file_stamp, is kept in the attrs of
+    the cache file, and all thumbnails of a cxi file are dropped once it has
+    been replaced or resized.  Only its inode is checked here, as the file
+    may be opened by the labeler in this process, and the rest is taken from
+    stamps of thumbnails produced by workers.  Segmasks changed in place are
+    caught per event by their crc, see ThumbnailGenerator.verify.
+    """
+
+    def __init__(self, dir_cache):
+        self.dir_cache  = dir_cache
+        self.fh_dict    = {}
+        self.stamp_dict = {}
+
+        os.makedirs(self.dir_cache, exist_ok = True)
+
+        return None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+    def close(self):
+        for fh in self.fh_dict.values(): fh.close()
+        self.fh_dict    = {}
+        self.stamp_dict = {}
+
+
+    def get_path_cache(self, path_cxi):
+        path_cxi = os.path.abspath(path_cxi)
+        basename = os.path.splitext(os.path.basename(path_cxi))[0]
+        path_key = zlib.crc32(path_cxi.encode())
+
+        return os.path.join(self.dir_cache, f"{basename}.{path_key:08x}.thumb.h5")
+
+
+    def get_file(self, path_cxi):
+        if not path_cxi in self.fh_dict:
+            fh = h5py.File(self.get_path_cache(path_cxi), 'a')
+            self.fh_dict[path_cxi] = fh
+
+            stamp = fh.attrs.get('stamp')
+            self.stamp_dict[path_cxi] = None if stamp is None else tuple(int(v) for v in stamp)
+            self.check_stamp(path_cxi)
+
+        return self.fh_dict[path_cxi]
+
+
+    def check_stamp(self, path_cxi):
+        ''' Drop all thumbnails of a cxi file if it has been replaced since
+            they were produced.  Return whether they are dropped.
+        '''
+        try:
+            stat = os.stat(path_cxi)
+        except OSError:
+            return False
+
+        stamp = self.stamp_dict[path_cxi]
+        if stamp is not None and stamp[:2] == (stat.st_dev, stat.st_ino): return False
+
+        # The next thumbnail produced brings the new stamp...
+        return self.drop_all(path_cxi, None)
+
+
+    def drop_all(self, path_cxi, stamp):
+        fh = self.get_file(path_cxi)
+
+        self.stamp_dict[path_cxi] = stamp
+        if stamp is None: fh.attrs.pop('stamp', None)
+        else            : fh.attrs['stamp'] = stamp
+
+        if not 'is_valid' in fh: return False
+
+        fh['is_valid'][...] = False
+
+        return True
+
+
+    def get(self, path_cxi, event_idx):
+        ''' Return (img_thumb, label_thumb) or None if the event has no valid
+            thumbnail yet.
+        '''
+        fh = self.get_file(path_cxi)
+
+        if not 'is_valid' in fh                  : return None
+        if not event_idx < len(fh['is_valid'])   : return None
+        if not fh['is_valid'][event_idx]         : return None
+
+        return fh['img'][event_idx], fh['label'][event_idx]
+
+
+    def is_valid(self, path_cxi, event_idx):
+        fh = self.get_file(path_cxi)
+
+        if not 'is_valid' in fh               : return False
+        if not event_idx < len(fh['is_valid']): return False
+
+        return bool(fh['is_valid'][event_idx])
+
+
+    def get_crc(self, path_cxi, event_idx):
+        fh = self.get_file(path_cxi)
+
+        if not 'crc' in fh               : return None
+        if not event_idx < len(fh['crc']): return None
+
+        return fh['crc'][event_idx]
+
+
+    def create_datasets(self, fh, num_event, size_y, size_x):
+        for k, dtype in (('img', 'uint8'), ('label', 'uint8')):
+            fh.create_dataset(k, shape       = (num_event, size_y, size_x),
+                                 maxshape    = (None, size_y, size_x),
+                                 chunks      = (1, size_y, size_x),
+                                 compression = 'lzf',
+                                 dtype       = dtype)
+        fh.create_dataset('crc'     , shape = (num_event,), maxshape = (None,), dtype = 'uint32')
+        fh.create_dataset('is_valid', shape = (num_event,), maxshape = (None,), dtype = 'bool')
+
+
+    def put(self, path_cxi, event_idx, img_thumb, label_thumb, crc, stamp = None):
+        ''' Save a thumbnail produced from the cxi file with the given stamp.
+            Return False without saving it if the file has been replaced
+            since then.
+        '''
+        fh = self.get_file(path_cxi)
+
+        if stamp is not None and tuple(stamp) != self.stamp_dict[path_cxi]:
+            # Drop thumbnails of an older file, or this one if it is...
+            try:
+                stat = os.stat(path_cxi)
+            except OSError:
+                return False
+            if tuple(stamp[:2]) != (stat.st_dev, stat.st_ino): return False
+
+            self.drop_all(path_cxi, tuple(stamp))
+
+        if not 'is_valid' in fh:
+            self.create_datasets(fh, event_idx + 1, *img_thumb.shape)
+
+        # Grow the cache when an event beyond the current size shows up...
+        if not event_idx < len(fh['is_valid']):
+            for k in ('img', 'label', 'crc', 'is_valid'): fh[k].resize(event_idx + 1, axis = 0)
+
+        fh['img'     ][event_idx] = img_thumb
+        fh['label'   ][event_idx] = label_thumb
+        fh['crc'     ][event_idx] = crc
+        fh['is_valid'][event_idx] = True
+
+        return True
+
+
+    def put_label(self, path_cxi, event_idx, label_thumb, crc):
+        ''' Refresh only the label of an existing thumbnail.
+        '''
+        fh = self.get_file(path_cxi)
+
+        fh['label'][event_idx] = label_thumb
+        fh['crc'  ][event_idx] = crc
+
+
+    def invalidate(self, path_cxi, event_idx):
+        # No need to create a cache file just to invalidate it...
+        if not path_cxi in self.fh_dict and not os.path.exists(self.get_path_cache(path_cxi)): return None
+
+        fh = self.get_file(path_cxi)
+
+        if not 'is_valid' in fh               : return None
+        if not event_idx < len(fh['is_valid']): return None
+
+        fh['is_valid'][event_idx] = False
+
+
+    def flush(self):
+        for fh in self.fh_dict.values(): fh.flush()
+
+
+
+
+class ThumbnailGenerator:
+    """
+    Produce thumbnails in a process pool.  Jobs are submitted in batches of
+    events from the same cxi file, and finished jobs are collected by polling
+    from the GUI thread, which is the only one touching the cache.
+    """
+
+    def __init__(self, cache, num_workers = None, max_size = 128, batch_size = 16, path_geometry = None, dir_geometry = None):
+        self.cache         = cache
+        self.max_size      = max_size
+        self.batch_size    = batch_size
+        self.path_geometry = path_geometry
+        self.dir_geometry  = dir_geometry
+
+        # Spawn workers so that no Qt state is inherited through fork...
+        self.executor = ProcessPoolExecutor(max_workers = num_workers, mp_context = mp.get_context('spawn'))
+
+        self.pending_set  = set()
+        self.future_list  = []    # (future, keys submitted with it)
+
+        return None
+
+
+    def submit(self, key_list, crc_dict = None):
+        ''' Submit a list of (path_cxi, event_idx) to the pool.  Keys in
+            crc_dict are only produced again if their segmask crc differs.
+        '''
+        # Group events by cxi file...
+        event_dict = {}
+        for key in key_list:
+            if key in self.pending_set: continue
+            self.pending_set.add(key)
+
+            path_cxi, event_idx = key
+            if not path_cxi in event_dict: event_dict[path_cxi] = []
+            event_dict[path_cxi].append(event_idx)
+
+        for path_cxi, event_idx_list in event_dict.items():
+            event_idx_list = sorted(event_idx_list)
+            for i in range(0, len(event_idx_list), self.batch_size):
+                batch    = event_idx_list[i:i + self.batch_size]
+                crc_list = None if crc_dict is None else [ crc_dict.get((path_cxi, event_idx)) for event_idx in batch ]
+                future   = self.executor.submit(make_thumbnail_batch, path_cxi, batch, self.max_size,
+                                                self.path_geometry, self.dir_geometry, crc_list)
+                self.future_list.append((future, [ (path_cxi, event_idx) for event_idx in batch ]))
+
+
+    def verify(self, key_list):
+        ''' Produce thumbnails of a list of (path_cxi, event_idx) again if
+            their segmask has changed since, e.g. by autolabel or other
+            labelers, or if they are not in the cache.
+        '''
+        crc_dict = {}
+        for path_cxi, event_idx in key_list:
+            if not self.cache.is_valid(path_cxi, event_idx): continue
+            crc_dict[(path_cxi, event_idx)] = int(self.cache.get_crc(path_cxi, event_idx))
+
+        self.submit(key_list, crc_dict)
+
+
+    def poll(self):
+        ''' Save finished thumbnails to the cache and return their keys,
+            including those of thumbnails that are dropped as their cxi file
+            has been replaced in the meantime.
+        '''
+        done_key_list = []
+        future_list   = []
+        for future, key_list in self.future_list:
+            if not future.done():
+                future_list.append((future, key_list))
+                continue
+
+            # Keys of failed jobs can be submitted again...
+            self.pending_set.difference_update(key_list)
+
+            try:
+                path_cxi, stamp, thumbnail_list = future.result()
+            except Exception as e:
+                print(f"Oops!!! Errors occurs while making thumbnails: {e}")
+                continue
+
+            for event_idx, img_thumb, label_thumb, crc in thumbnail_list:
+                self.cache.put(path_cxi, event_idx, img_thumb, label_thumb, crc, stamp)
+                done_key_list.append((path_cxi, event_idx))
+
+        self.future_list = future_list
+
+        if len(done_key_list) > 0: self.cache.flush()
+
+        return done_key_list
+
+
+    def close(self):
+        for future, _ in self.future_list: future.cancel()
+        self.executor.shutdown(wait = False)
@@ -1,10 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import zlib
+import mmap
+import pickle
+import locale
 import random
 import numpy as np
-import skimage.measure as sm
-import psana
+
+# skimage and psana are imported where they are needed, so that importing
+# utils stays cheap and works on machines without psana.
 
 def set_seed(seed):
     random.seed(seed)
@@ -13,6 +19,37 @@ def set_seed(seed):
     return None
 
 
+def get_event_key(path_cxi, event_idx):
+    ''' Return an integer key of an event that stays the same across
+        sessions, unlike its idx, which depends on the yaml file.
+    '''
+    return (zlib.crc32(path_cxi.encode()) << 32) | int(event_idx)
+
+
+def get_event_seed_sequence(seed, key):
+    return np.random.SeedSequence([ 0 if seed is None else seed, key ])
+
+
+def set_event_seed(seed, key):
+    ''' Seed the global random generators with a stream derived from (seed,
+        key), so that an event always sees the same random numbers without
+        storing any generator state.
+    '''
+    state = get_event_seed_sequence(seed, key).generate_state(4)
+
+    random.seed(int.from_bytes(state.tobytes(), 'little'))
+    np.random.seed(state)
+
+    return None
+
+
+def get_event_rng(seed, key):
+    ''' Return a counter-based generator of the stream derived from (seed,
+        key), which leaves the global random generators alone.
+    '''
+    return np.random.Generator(np.random.Philox(get_event_seed_sequence(seed, key)))
+
+
 
 
 def hex_to_rgb(hex_string):
@@ -30,38 +67,296 @@ def hex_to_rgb(hex_string):
 
 
 
-def read_log(file):
+def build_color_lut(layer_manager, alpha = 100):
+    ''' Return a lookup table of shape (N, 4) that maps a layer encoding to
+        an RGBA color, so that a label can be colorized by one gather, i.e.
+        lut[label].
+    '''
+    layer_metadata = layer_manager['layer_metadata']
+    num_encode     = max(layer_metadata.keys()) + 1
+
+    lut = np.zeros((num_encode, 4), dtype = 'uint8')
+    for encode in layer_manager['layer_order']:
+        color_hex = layer_metadata[encode]['color']
+
+        if color_hex == '#FFFFFF': continue
+
+        lut[encode, :3] = hex_to_rgb(color_hex)
+        lut[encode,  3] = alpha
+
+    return lut
+
+
+
+
+def colorize_label(label, lut):
+    ''' Colorize a label with a lookup table.  Encodings not covered by the
+        lookup table stay transparent.
+    '''
+    lut = np.concatenate([lut, np.zeros((1, 4), dtype = lut.dtype)])
+    label = np.where((label >= 0) & (label < len(lut) - 1), label, len(lut) - 1)
+
+    return lut[label]
+
+
+
+
+def get_layer_bits(layer_order):
+    ''' Assign one bit to each layer in the layer order.  The background
+        (encoded as 0) is the absence of any label, so it has no bit.
+    '''
+    encode_list = [ encode for encode in layer_order if encode != 0 ]
+    assert len(encode_list) <= 16, f"{len(encode_list)} layers can't be packed into 16 bits!!!"
+
+    return { encode : 1 << i for i, encode in enumerate(encode_list) }
+
+
+
+
+def get_bitplane_dtype(layer_bits):
+    return 'uint8' if len(layer_bits) <= 8 else 'uint16'
+
+
+
+
+def segmask_to_bitplane(segmask, layer_bits):
+    ''' Convert an integer segmask to a bit-plane segmask.
+    '''
+    dtype = get_bitplane_dtype(layer_bits)
+
+    lut = np.zeros(max(layer_bits.keys(), default = 0) + 2, dtype = dtype)
+    for encode, bit in layer_bits.items(): lut[encode] = bit
+
+    # Unknown encodings carry no label...
+    segmask = np.where((segmask >= 0) & (segmask < len(lut) - 1), segmask, len(lut) - 1)
+
+    return lut[segmask]
+
+
+
+
+def remap_bitplane(bitplane, layer_bits_old, layer_bits_new):
+    ''' Move the bit of each layer in a bit-plane segmask to its bit in a new
+        assignment.  Layers without a new bit are dropped.
+    '''
+    remapped = np.zeros(bitplane.shape, dtype = get_bitplane_dtype(layer_bits_new))
+    for encode, bit in layer_bits_old.items():
+        if not encode in layer_bits_new: continue
+        remapped[(bitplane & bit) != 0] |= layer_bits_new[encode]
+
+    return remapped
+
+
+
+
+def bitplane_to_segmask(bitplane, layer_bits, layer_order, dtype = 'int64'):
+    ''' Convert a bit-plane segmask to an integer segmask.  A pixel in
+        multiple layers takes the last of them in the layer order.
+    '''
+    value_list = np.arange(1 << len(layer_bits))
+
+    lut = np.zeros(len(value_list), dtype = dtype)
+    for encode in layer_order:
+        if not encode in layer_bits: continue
+        lut[(value_list & layer_bits[encode]) != 0] = encode
+
+    return lut[bitplane]
+
+
+
+
+def build_bitplane_color_lut(layer_manager, layer_bits, alpha = 100):
+    ''' Return a lookup table that maps every bit-plane value to the RGBA
+        color of its top layer in the layer order.
+    '''
+    layer_metadata = layer_manager['layer_metadata']
+    value_list     = np.arange(1 << len(layer_bits))
+
+    lut = np.zeros((len(value_list), 4), dtype = 'uint8')
+    for encode in layer_manager['layer_order']:
+        if not encode in layer_bits: continue
+
+        color_hex = layer_metadata[encode]['color']
+        if color_hex == '#FFFFFF': continue
+
+        is_in_layer = (value_list & layer_bits[encode]) != 0
+        lut[is_in_layer, :3] = hex_to_rgb(color_hex)
+        lut[is_in_layer,  3] = alpha
+
+    return lut
+
+
+
+
+def get_levels(img):
+    ''' Return the display levels of an image.
+    '''
+    vmin = np.mean(img)
+    vmax = vmin + 8 * np.std(img)
+
+    return [vmin, vmax]
+
+
+
+
+# Keywords of records in a log...
+LOG_KW_KV   = "KV - "
+LOG_KW_DATA = "DATA - "
+
+def iter_log_line(file):
+    ''' Yield (offset, line) of every line in a log that holds a KV or DATA
+        record, where offset is the byte offset of the line.  The file is
+        memory mapped and searched for keywords with bytes.find, so other
+        lines never reach python.  Lines end at a newline or a carriage
+        return like in text mode.
+    '''
+    encoding = locale.getpreferredencoding(False)
+
+    with open(file, 'rb') as fh:
+        # Empty files can't be mapped...
+        if os.fstat(fh.fileno()).st_size == 0: return None
+
+        with mmap.mmap(fh.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+            # Cache the next position of each needle, so that a needle absent
+            # from the rest of the file isn't searched for over and over...
+            needle_list = [ LOG_KW_KV.encode(), LOG_KW_DATA.encode(), b"\r" ]
+            next_list   = [ mm.find(needle) for needle in needle_list ]
+            def find(i, pos):
+                if -1 < next_list[i] < pos: next_list[i] = mm.find(needle_list[i], pos)
+                return next_list[i]
+
+            pos = 0
+            while True:
+                kw_kv, kw_data = find(0, pos), find(1, pos)
+                if kw_kv == -1 and kw_data == -1: break
+                kw_pos = kw_data if kw_kv == -1 else kw_kv if kw_data == -1 else min(kw_kv, kw_data)
+
+                # Lines before pos are consumed, so look back no further...
+                line_begin = max(mm.rfind(b"\n", pos, kw_pos), mm.rfind(b"\r", pos, kw_pos)) + 1
+
+                eol_lf, eol_cr = mm.find(b"\n", kw_pos), find(2, kw_pos)
+                line_end = max(eol_lf, eol_cr) if eol_lf == -1 or eol_cr == -1 else min(eol_lf, eol_cr)
+                if line_end == -1: line_end = len(mm)
+
+                yield line_begin, mm[line_begin:line_end].decode(encoding)
+
+                pos = line_end
+
+
+def read_log_line(file, offset_list):
+    ''' Yield lines starting at given byte offsets of a log.
+    '''
+    encoding = locale.getpreferredencoding(False)
+
+    with open(file, 'rb') as fh:
+        for offset in offset_list:
+            fh.seek(offset)
+            line = fh.readline()
+
+            # A carriage return ends a line like in text mode...
+            line = line.split(b"\r", maxsplit = 1)[0].rstrip(b"\n")
+
+            yield line.decode(encoding)
+
+
+def parse_log_line(line, kv_dict, data_dict, info_set):
+    ''' Add the KV and DATA records in a line to kv_dict and data_dict.
+        Return the key of each record for indexing, or None.  DATA records
+        already in info_set are skipped before building their tuples.
+    '''
+    key_kv   = None
+    key_data = None
+
+    # Collect kv information...
+    if LOG_KW_KV in line:
+        info = line[line.rfind(LOG_KW_KV) + len(LOG_KW_KV):]
+        k, v = info.split(":", maxsplit = 1)
+        if not k in kv_dict: kv_dict[k.strip()] = v.strip()
+
+        key_kv = k.strip()
+
+    # Collect data information...
+    if LOG_KW_DATA in line:
+        info = line[line.rfind(LOG_KW_DATA) + len(LOG_KW_DATA):].strip()
+        if not info in info_set:
+            info_set.add(info)
+            k = info.split(",")
+
+            # Remove contents after colon...
+            k[1:] = [ i[:i.rfind(":")].strip() for i in k[1:] ]
+
+            # Convert list to tuple...
+            k = tuple(k)
+
+            if not k in data_dict: data_dict[k] = True
+
+            key_data = k[0]
+
+    return key_kv, key_data
+
+
+def read_log(file, path_index = None):
     '''Return all lines in the user supplied parameter file without comments.
-    ''' 
-    # Retrieve key-value information...
-    kw_kv     = "KV - " 
-    kv_dict   = {}
 
-    # Retrieve data information...
-    kw_data   = "DATA - " 
+       With path_index, the byte offsets of KV records by key and DATA records
+       by their first field are saved, so that query_log can skip the full
+       scan later.
+    '''
+    kv_dict   = {}
     data_dict = {}
-    with open(file,'r') as fh: 
-        for line in fh.readlines():
-            # Collect kv information...
-            if kw_kv in line:
-                info = line[line.rfind(kw_kv) + len(kw_kv):]
-                k, v = info.split(":", maxsplit = 1)
-                if not k in kv_dict: kv_dict[k.strip()] = v.strip()
+    info_set  = set()
+    index_dict = { "kv" : {}, "data" : {} }
+    for offset, line in iter_log_line(file):
+        key_kv, key_data = parse_log_line(line, kv_dict, data_dict, info_set)
+
+        if path_index is None: continue
+        if key_kv   is not None: index_dict["kv"  ].setdefault(key_kv  , []).append(offset)
+        if key_data is not None: index_dict["data"].setdefault(key_data, []).append(offset)
+
+    if path_index is not None:
+        stat = os.stat(file)
+        index_dict["size"]  = stat.st_size
+        index_dict["mtime"] = stat.st_mtime
+        with open(path_index, 'wb') as fh:
+            pickle.dump(index_dict, fh, protocol = pickle.HIGHEST_PROTOCOL)
+
+    ret_dict = { "kv" : kv_dict, "data" : tuple(data_dict.keys()) }
 
-            # Collect data information...
-            if kw_data in line:
-                info = line[line.rfind(kw_data) + len(kw_data):]
-                k = info.strip().split(",")
+    return ret_dict
 
-                # Remove contents after colon...
-                k[1:] = [ i[:i.rfind(":")].strip() for i in k[1:] ]
 
-                # Convert list to tuple...
-                k = tuple(k)
+def query_log(file, path_index, key_kv_list = (), key_data_list = ()):
+    ''' Return what read_log returns, but only for given KV keys and DATA
+        records with given first fields, by reading indexed lines only.  The
+        index is rebuilt when the log has changed since it was saved.
+    '''
+    index_dict = None
+    if os.path.exists(path_index):
+        with open(path_index, 'rb') as fh:
+            index_dict = pickle.load(fh)
+
+    stat = os.stat(file)
+    if index_dict is None or index_dict["size"] != stat.st_size or index_dict["mtime"] != stat.st_mtime:
+        read_log(file, path_index)
+        with open(path_index, 'rb') as fh:
+            index_dict = pickle.load(fh)
+
+    # Revisit lines in the order of the log...
+    offset_list = []
+    for k in key_kv_list  : offset_list.extend(index_dict["kv"  ].get(k, []))
+    for k in key_data_list: offset_list.extend(index_dict["data"].get(k, []))
+    offset_list = sorted(set(offset_list))
 
-                if not k in data_dict: data_dict[k] = True
+    kv_dict   = {}
+    data_dict = {}
+    info_set  = set()
+    for line in read_log_line(file, offset_list):
+        parse_log_line(line, kv_dict, data_dict, info_set)
 
-    ret_dict = { "kv" : kv_dict, "data" : tuple(data_dict.keys()) }
+    ret_dict = {
+        "kv"   : { k : v for k, v in kv_dict.items() if k in key_kv_list },
+        "data" : tuple(k for k in data_dict.keys() if k[0] in key_data_list),
+    }
 
     return ret_dict
 
@@ -121,6 +416,8 @@ def downsample(assem, bin_row=2, bin_col=2, mask=None):
     """ Downsample an SPI image.  
         Adopted from https://github.com/chuckie82/DeepProjection/blob/master/DeepProjection/utils.py
     """
+    import skimage.measure as sm
+
     if mask is None:
         combinedMask = np.ones_like(assem)
     else:
@@ -136,6 +433,65 @@ def downsample(assem, bin_row=2, bin_col=2, mask=None):
 
 
 
+def extract_patches(img, center_list, size_patch, pad_value = 0):
+    ''' Extract square patches centered at each center by one vectorized
+        gather.  Patches going across the edge are padded with pad_value.
+
+    Args:
+        img: numpy.ndarray with the shape of (H, W).
+        center_list: numpy.ndarray with the shape of (N, 2), each center is
+                     given by (index along H, index along W).
+        size_patch: the side length of a patch.
+
+    Returns:
+        patches: numpy.ndarray with the shape of (N, size_patch, size_patch).
+        origin_list: numpy.ndarray with the shape of (N, 2), the index of the
+                     first pixel of each patch in img.
+    '''
+    size_y, size_x = img.shape[-2:]
+    half = size_patch // 2
+
+    center_list = np.round(np.asarray(center_list, dtype = 'float64').reshape(-1, 2)).astype(int)
+    center_list[:, 0] = np.clip(center_list[:, 0], 0, size_y - 1)
+    center_list[:, 1] = np.clip(center_list[:, 1], 0, size_x - 1)
+    origin_list = center_list - half
+
+    # Pad once so that no patch runs out of bound...
+    img_pad = np.pad(img, half, mode = 'constant', constant_values = pad_value)
+
+    # Offsetting by half maps an index in img to the one in img_pad...
+    offset = np.arange(size_patch)
+    idx_y  = origin_list[:, 0, None, None] + offset[None, :, None] + half
+    idx_x  = origin_list[:, 1, None, None] + offset[None, None, :] + half
+    patches = img_pad[idx_y, idx_x]
+
+    return patches, origin_list
+
+
+
+
+def find_label_centers(label):
+    ''' Return the centers of connected components of labeled pixels, as an
+        array with the shape of (N, 2).
+    '''
+    import skimage.measure as sm
+
+    components = sm.label(label > 0)
+
+    # Average pixel indices within each component...
+    idx_y, idx_x = np.indices(components.shape)
+    counts = np.bincount(components.ravel())
+    sum_y  = np.bincount(components.ravel(), weights = idx_y.ravel())
+    sum_x  = np.bincount(components.ravel(), weights = idx_x.ravel())
+
+    # Component 0 is the background...
+    center_list = np.stack([sum_y[1:] / counts[1:], sum_x[1:] / counts[1:]], axis = -1)
+
+    return center_list
+
+
+
+
 class PsanaImg:
     """
     It serves as an image accessing layer based on the data management system
@@ -143,6 +499,7 @@ class PsanaImg:
     """
 
     def __init__(self, exp, run, mode, detector_name):
+        import psana
 
         # Biolerplate code to access an image
         # Set up data source
@@ -173,6 +530,18 @@ class PsanaImg:
         return img
 
 
+    def indexes_xy(self, event_num = 0):
+        ''' Return the row and column indices of every calib pixel in the
+            assembled image, each with the shape of (panels, H, W).
+        '''
+        timestamp = self.timestamps[int(event_num)]
+        event     = self.run_current.event(timestamp)
+
+        index_x, index_y = self.detector.indexes_xy(event)
+
+        return np.asarray(index_x), np.asarray(index_y)
+
+
 
 
 def apply_mask(data, mask, mask_value = np.nan):
@@ -3,10 +3,12 @@
 
 import os
 import sys
+import time
 import pickle
 import numpy as np
 
-from .utils import hex_to_rgb
+from .      import perf
+from .utils import colorize_label, get_levels, find_label_centers
 
 import pyqtgraph as pg
 
@@ -29,7 +31,7 @@ class Window(QtWidgets.QMainWindow):
 
         self.num_img = len(self.data_manager.idx_list)
 
-        self.idx_img = 0
+        self.idx_img = self.data_manager.get_first_idx()
 
         self.setupButtonFunction()
         self.setupButtonShortcut()
@@ -41,6 +43,10 @@ class Window(QtWidgets.QMainWindow):
         self.label = None
         self.unsaved_label = {}
 
+        # The last rectangle or polygon, and undo records of propagations...
+        self.last_region      = None
+        self.propagation_list = []
+
         self.uses_roi_eraser = False
         self.label_item = ImageItem(None)
         self.roi_item   = PolyLineROI(self.pen_click_pos_list, closed=True)
@@ -48,10 +54,22 @@ class Window(QtWidgets.QMainWindow):
         self.layout.viewer_img.getView().addItem(self.roi_item)
 
         self.layer_panel = { 'wgt' : None, 'panel' : None }
+        self.gallery     = None
+        self.patch_grid  = None
+        self.perf_panel  = { 'text' : None, 'timer' : None }
 
         self.requires_overlay = True
         self.uses_auto_range = True
 
+        # Playback is driven by a timer and fed by a prefetcher...
+        self.playback_fps         = 10.0
+        self.playback_pause_rules = { 'empty_segmask' : False, 'num_peaks_above' : None }
+        self.playback = None
+
+        # Whether an event is being loaded, which may process Qt events, e.g.
+        # playback timers, while a data server is serving it...
+        self.is_loading = False
+
         self.proxy_click = None
         self.proxy_moved = None
 
@@ -63,6 +81,9 @@ class Window(QtWidgets.QMainWindow):
 
 
     def closeEvent(self, event):
+        if self.playback is not None: self.stopPlayback()
+        if self.gallery is not None: self.gallery.close_cache()
+        if self.perf_panel['timer'] is not None: self.perf_panel['timer'].stop()
         QtWidgets.QApplication.closeAllWindows()
         event.accept()
 
@@ -80,6 +101,12 @@ class Window(QtWidgets.QMainWindow):
         QtWidgets.QShortcut(QtCore.Qt.Key_S    , self, self.switchOffOverlay)
         QtWidgets.QShortcut(QtCore.Qt.Key_A    , self, self.resetRange)
         QtWidgets.QShortcut(QtCore.Qt.Key_T    , self, self.toggleAutoRange)
+        QtWidgets.QShortcut(QtCore.Qt.Key_I    , self, self.showGallery)
+        QtWidgets.QShortcut(QtCore.Qt.Key_K    , self, self.togglePlayback)
+        QtWidgets.QShortcut(QtCore.Qt.Key_J    , self, self.showPatchGrid)
+        QtWidgets.QShortcut(QtCore.Qt.Key_L    , self, self.togglePerfPanel)
+        QtWidgets.QShortcut(QtCore.Qt.Key_Y    , self, self.propagateRegionDialog)
+        QtWidgets.QShortcut(QtCore.Qt.Key_U    , self, self.undoPropagation)
 
 
     def showLayerPanel(self):
@@ -111,6 +138,108 @@ class Window(QtWidgets.QMainWindow):
         self.layer_panel['wgt'].show()
 
 
+    def showGallery(self):
+        if self.gallery is None:
+            # Rarely used widgets are imported and built on first use...
+            from .gallery import Gallery
+
+            self.gallery = Gallery(self.data_manager)
+            self.gallery.sigEventSelected.connect(self.goToEvent)
+
+        self.gallery.refresh()
+        self.gallery.scrollTo(self.idx_img)
+        self.gallery.show()
+
+
+    def showPatchGrid(self):
+        if self.patch_grid is None:
+            from .patch_grid import PatchGrid
+
+            self.patch_grid = PatchGrid()
+            self.patch_grid.sigPixelClicked.connect(self.patchGridClickedToLabel)
+            self.patch_grid.sigConfigChanged.connect(self.refreshPatchGrid)
+
+        self.refreshPatchGrid()
+        self.patch_grid.show()
+
+
+    def refreshPatchGrid(self):
+        img   = self.img[0]
+        label = self.label[0]
+
+        if self.patch_grid.source == 'cxi peaks':
+            center_list = self.data_manager.get_peak_positions(self.idx_img)
+        else:
+            center_list = find_label_centers(label)
+
+        lut = self.data_manager.get_color_lut()
+        self.patch_grid.set_frame(img, label, center_list, get_levels(img), lut)
+
+
+    @perf.timer("label patch grid")
+    def patchGridClickedToLabel(self, x, y):
+        self.prepareEdit()
+        self.toggleLabelAt(x, y)
+        self.dispImg(requires_refresh_img = False, requires_refresh_layers = True)
+
+
+    @perf.timer("invalidateThumbnails")
+    def invalidateThumbnails(self, idx_list):
+        if self.gallery is not None:
+            self.gallery.invalidate(idx_list)
+            return None
+
+        # Keep the on-disk cache in sync even if the gallery is never opened...
+        from .thumbnail import ThumbnailCache
+
+        with ThumbnailCache(self.data_manager.dir_thumbnail) as cache:
+            for idx in idx_list:
+                path_cxi, event_idx, _ = self.data_manager.idx_list[idx]
+                cache.invalidate(path_cxi, event_idx)
+
+
+    def togglePerfPanel(self):
+        if self.perf_panel['text'] is None:
+            self.perf_panel['text'] = self.layout.config_perf_dock()
+
+            # Refresh the panel while it is shown...
+            timer = QtCore.QTimer()
+            timer.timeout.connect(self.refreshPerfPanel)
+            self.perf_panel['timer'] = timer
+
+            dock = self.layout.dock_dict["Perf"]
+            dock.hide()
+
+        dock  = self.layout.dock_dict["Perf"]
+        timer = self.perf_panel['timer']
+        if dock.isVisible():
+            dock.hide()
+            timer.stop()
+        else:
+            # Nothing is recorded until someone looks...
+            perf.enable()
+            dock.show()
+            timer.start(500)
+            self.refreshPerfPanel()
+
+
+    def refreshPerfPanel(self):
+        buffer_dict = self.data_manager.buffer_dict
+        num_byte = sum(sum(arr.nbytes for arr in frame if arr is not None) for frame in buffer_dict.values())
+        hit_rate = perf.get_hit_rate("buffer hit", "buffer miss")
+        hit_rate = "n/a" if hit_rate is None else f"{hit_rate * 100:.1f}%"
+
+        msg = (f"Buffer: {len(buffer_dict)} events, {num_byte / 2**20:.1f} MB, hit rate {hit_rate}\n\n"
+               f"{perf.format_summary(num_recent = 1000)}")
+
+        self.perf_panel['text'].setPlainText(msg)
+
+
+    def goToEvent(self, idx):
+        self.idx_img = min(max(0, idx), self.num_img - 1)
+        self.dispImg()
+
+
     def resetRange(self):
         self.dispImg(requires_refresh_img = True, requires_refresh_layers = False)
 
@@ -177,21 +306,29 @@ class Window(QtWidgets.QMainWindow):
         self.proxy_click = SignalProxy(self.layout.viewer_img.getView().scene().sigMouseClicked, slot = self.mouseClickedToLabelROI)
 
 
+    @perf.timer("label point")
     def mouseClickedToLabel(self, event):
         mouse_pos = self.layout.viewer_img.getView().vb.mapSceneToView(event[0].scenePos())
 
         x = int(mouse_pos.x())
         y = int(mouse_pos.y())
 
+        self.prepareEdit()
+        self.toggleLabelAt(x, y)
+
+        self.dispImg(requires_refresh_img = False, requires_refresh_layers = True)
+
+
+    def toggleLabelAt(self, x, y):
         label = self.label    # (1, H, W)
         layer_active = self.data_manager.layer_manager['layer_active']
         size_x, size_y = label.shape[-2:]
         if x < size_x and y < size_y:
-            label[0, x, y] = 0 if label[0, x, y] == layer_active else layer_active
-
-        self.dispImg(requires_refresh_img = False, requires_refresh_layers = True)
+            is_labeled = self.data_manager.is_labeled(label[0, x, y], layer_active)
+            self.data_manager.paint_label(label[0], (x, y), layer_active, erases = is_labeled)
 
 
+    @perf.timer("label rectangle")
     def mouseClickedToLabelRange(self, event):
         mouse_pos = self.layout.viewer_img.getView().vb.mapSceneToView(event[0].scenePos())
 
@@ -201,6 +338,8 @@ class Window(QtWidgets.QMainWindow):
         self.two_click_pos_list.append((x, y))
 
         if len(self.two_click_pos_list) == 2:
+            self.prepareEdit()
+
             (x_0, y_0), (x_1, y_1) = self.two_click_pos_list
 
             label = self.label    # (1, H, W)
@@ -215,14 +354,18 @@ class Window(QtWidgets.QMainWindow):
             x_b, x_e = sorted([x_0, x_1])
             y_b, y_e = sorted([y_0, y_1])
 
-            label_selected    = label[0, x_b:x_e+1, y_b:y_e+1]
-            label_selected[:] = layer_active if np.all(label_selected == 0) == True else 0
-            label[0, x_b:x_e+1, y_b:y_e+1] = label_selected
+            label_selected = label[0, x_b:x_e+1, y_b:y_e+1]
+            is_unlabeled   = self.data_manager.is_unlabeled(label_selected, layer_active)
+            self.data_manager.paint_label(label_selected, Ellipsis, layer_active, erases = not is_unlabeled)
+
+            self.last_region = np.zeros(label.shape[-2:], dtype = bool)
+            self.last_region[x_b:x_e+1, y_b:y_e+1] = True
 
             self.dispImg(requires_refresh_img = False, requires_refresh_layers = True)
             self.two_click_pos_list = []
 
 
+    @perf.timer("add polygon node")
     def mouseClickedToLabelROI(self, event):
         mouse_pos = self.layout.viewer_img.getView().vb.mapSceneToView(event[0].scenePos())
 
@@ -245,6 +388,7 @@ class Window(QtWidgets.QMainWindow):
         self.layout.viewer_img.getView().addItem(self.roi_item)
 
 
+    @perf.timer("label polygon")
     def connectNodes(self):
         if len(self.pen_click_pos_list) < 3: 
             self.pen_click_pos_list = []
@@ -259,6 +403,7 @@ class Window(QtWidgets.QMainWindow):
         self.layout.viewer_img.getView().addItem(self.roi_item)
 
         # Fetch image, label and mask...
+        self.prepareEdit()
         label = self.label
         layer_active = self.data_manager.layer_manager['layer_active']
 
@@ -287,16 +432,15 @@ class Window(QtWidgets.QMainWindow):
         idx_y = np.minimum(np.maximum(idx_y, 0), size_y - 1)
         idx_x = np.minimum(np.maximum(idx_x, 0), size_x - 1)
 
-        # !!! FUTURE IDEA !!! 
-        # Use the 0th-dim for saving multiple labels
-        ## roi[0][idx_y, idx_x] = np.logical_or (roi[0][idx_y, idx_x], layer_active * roi_patch) if not self.uses_roi_eraser else \
-        ##                        np.logical_and(roi[0][idx_y, idx_x], 1 - roi_patch)
-        ## label[0][idx_y, idx_x] = layer_active
-
+        # Multiple labels per pixel are supported by bit-plane labels, where
+        # the eraser only removes the active layer...
         label_patch = label[0][idx_y, idx_x]
-        label_patch[roi_patch] = layer_active if not self.uses_roi_eraser else 0
+        self.data_manager.paint_label(label_patch, roi_patch, layer_active, erases = self.uses_roi_eraser)
         label[0][idx_y, idx_x] = label_patch
 
+        self.last_region = np.zeros(label.shape[-2:], dtype = bool)
+        self.last_region[idx_y[roi_patch], idx_x[roi_patch]] = True
+
         self.dispImg(requires_refresh_img = False, requires_refresh_layers = True)
 
         self.layout.viewer_img.getView().removeItem(self.roi_item)
@@ -332,48 +476,50 @@ class Window(QtWidgets.QMainWindow):
     ###############
     ### DIPSLAY ###
     ###############
+    @perf.timer("refresh_layers")
     def refresh_layers(self):
         # Turn label into a layer of shape (1, H, W, 4)...
         # The type is uint8 for pyqt visualization purpose
-        label  = self.label
-        layers = np.zeros(label.shape + (4, ), dtype = 'uint8')
+        label = self.label
 
         # Color them based on layer encoding in the layer metadata...
-        for encode in self.data_manager.layer_manager['layer_order']:
-            metadata = self.data_manager.layer_manager['layer_metadata'][encode]
-            color_hex = metadata['color']
-
-            if color_hex == '#FFFFFF': continue
-
-            r, g, b = hex_to_rgb(color_hex)
-
-            layers[:, :, :, 0][label == encode] = r
-            layers[:, :, :, 1][label == encode] = g
-            layers[:, :, :, 2][label == encode] = b
-            layers[:, :, :, 3][label == encode] = 100
+        lut    = self.data_manager.get_color_lut()
+        layers = colorize_label(label, lut)
 
         self.label_item.setImage(layers[0], levels = [0, 128])
 
 
+    @perf.timer("dispImg")
     def dispImg(self, requires_refresh_img = True, requires_refresh_layers = True):
         # Let idx_img bound within reasonable range....
         self.idx_img = min(max(0, self.idx_img), self.num_img - 1)
 
-        img, label = self.data_manager.get_img(self.idx_img)
+        self.is_loading = True
+        try:
+            img, label = self.data_manager.get_img(self.idx_img)
+        finally:
+            self.is_loading = False
         self.img = img
         self.label = label
 
-        vmin = np.mean(img)
-        vmax = vmin + 8 * np.std(img)
-        ## print(vmin, vmax)
-        levels = [vmin, vmax]
+        with perf.timer("get_levels"):
+            levels = get_levels(img)
 
         if requires_refresh_img:
             # Display images...
-            self.layout.viewer_img.setImage(img[0], levels = levels, autoRange = self.uses_auto_range)
+            with perf.timer("setImage"):
+                self.layout.viewer_img.setImage(img[0], levels = levels, autoRange = self.uses_auto_range)
 
         if requires_refresh_layers: self.refresh_layers()
 
+        # Keep the patch grid in sync...
+        if self.patch_grid is not None and self.patch_grid.isVisible():
+            if requires_refresh_img:
+                self.refreshPatchGrid()
+            elif requires_refresh_layers:
+                lut = self.data_manager.get_color_lut()
+                self.patch_grid.refresh_label(label[0], lut)
+
         # Display title...
         self.layout.viewer_img.getView().setTitle(f"Sequence number: {self.idx_img}/{self.num_img - 1}")
 
@@ -384,9 +530,7 @@ class Window(QtWidgets.QMainWindow):
     ### NAVIGATION ###
     ##################
     def nextImg(self):
-        # Support rollover...
-        idx_next = self.idx_img + 1
-        self.idx_img = idx_next if idx_next < self.num_img else 0
+        self.idx_img = self.data_manager.get_next_idx(self.idx_img)
 
         self.dispImg()
 
@@ -396,9 +540,7 @@ class Window(QtWidgets.QMainWindow):
     def prevImg(self):
         idx_img_current = self.idx_img
 
-        # Support rollover...
-        idx_prev = self.idx_img - 1
-        self.idx_img = idx_prev if -1 < idx_prev else self.num_img - 1
+        self.idx_img = self.data_manager.get_prev_idx(self.idx_img)
 
         # Update image only when next/prev event is found???
         if idx_img_current != self.idx_img:
@@ -407,6 +549,159 @@ class Window(QtWidgets.QMainWindow):
         return None
 
 
+    ################
+    ### PLAYBACK ###
+    ################
+    def togglePlayback(self):
+        if self.playback is None:
+            self.startPlayback()
+        else:
+            self.stopPlayback()
+
+
+    def startPlayback(self):
+        # Nothing to play at the last event...
+        if not self.idx_img + 1 < self.num_img: return None
+
+        from .prefetch import Prefetcher
+
+        prefetcher = Prefetcher(self.data_manager)
+        prefetcher.schedule(range(self.idx_img + 1, self.num_img))
+
+        timer = QtCore.QTimer()
+        timer.setTimerType(QtCore.Qt.PreciseTimer)
+        timer.timeout.connect(self.stepPlayback)
+
+        self.playback = {
+            'timer'       : timer,
+            'prefetcher'  : prefetcher,
+            'time_start'  : time.perf_counter(),
+            'num_shown'   : 0,
+            'num_dropped' : 0,
+        }
+
+        timer.start(int(1000 / self.playback_fps))
+        print(f"Playback starts at {self.playback_fps} fps.")
+
+
+    def stopPlayback(self, reason = None):
+        playback = self.playback
+        playback['timer'].stop()
+        playback['prefetcher'].close()
+        self.playback = None
+
+        time_elapsed = time.perf_counter() - playback['time_start']
+        num_shown    = playback['num_shown']
+        num_dropped  = playback['num_dropped']
+        fps          = num_shown / time_elapsed if time_elapsed > 0 else 0.0
+
+        msg = f"{num_shown} frames in {time_elapsed:.2f} s, {fps:.2f}/{self.playback_fps:.2f} fps, {num_dropped} dropped"
+        print(f"Playback stops{'' if reason is None else ' on ' + reason}: {msg}.")
+
+        # Display the current event through the buffer so that it can be labeled...
+        self.dispImg(requires_refresh_img = False)
+        self.layout.viewer_img.getView().setTitle(f"Sequence number: {self.idx_img}/{self.num_img - 1}  |  {msg}")
+
+
+    def stepPlayback(self):
+        playback   = self.playback
+        prefetcher = playback['prefetcher']
+
+        # Never step while an event is being loaded...
+        if self.is_loading: return None
+
+        idx_next = self.idx_img + 1
+        frame    = prefetcher.get(idx_next)
+
+        # The frame isn't ready in time...
+        if frame is None:
+            playback['num_dropped'] += 1
+            return None
+
+        self.idx_img = idx_next
+        self.img     = frame['img'][None,]
+        self.label   = frame['label'][None,]
+        self.layout.viewer_img.setImage(frame['img'], levels = frame['levels'], autoRange = False)
+        if self.requires_overlay: self.label_item.setImage(frame['layers'], levels = [0, 128])
+        playback['num_shown'] += 1
+
+        time_elapsed = time.perf_counter() - playback['time_start']
+        fps          = playback['num_shown'] / time_elapsed if time_elapsed > 0 else 0.0
+        self.layout.viewer_img.getView().setTitle(f"Sequence number: {self.idx_img}/{self.num_img - 1}  |  "
+                                                  f"{fps:.1f} fps, {playback['num_dropped']} dropped")
+
+        reason = self.matchPauseRule(frame)
+        if reason is not None or not self.idx_img + 1 < self.num_img:
+            self.stopPlayback(reason)
+            return None
+
+        prefetcher.schedule(range(self.idx_img + 1, self.num_img))
+
+
+    def prepareEdit(self):
+        ''' Call it before any edit of the shown labels.
+        '''
+        self.adoptPlaybackFrame()
+        self.data_manager.begin_edit(self.idx_img)
+
+
+    def adoptPlaybackFrame(self):
+        ''' Labels shown during playback are copies outside the buffer, so
+            stop the playback and show the event through the buffer before
+            any edit.
+        '''
+        if self.playback is not None: self.stopPlayback("edit")
+
+
+    def matchPauseRule(self, frame):
+        ''' Return the reason to pause on a frame, otherwise None.
+        '''
+        rules = self.playback_pause_rules
+
+        if rules['empty_segmask'] and not np.any(frame['label']):
+            return "empty segmask"
+
+        threshold = rules['num_peaks_above']
+        if threshold is not None and frame['num_peaks'] > threshold:
+            return f"{frame['num_peaks']} peaks"
+
+        return None
+
+
+    def setPlaybackDialog(self):
+        fps, is_ok = QtWidgets.QInputDialog.getDouble(self, "Playback", "Frames per second", self.playback_fps, 0.1, 1000.0, 1)
+        if not is_ok: return None
+
+        # Rules are written as a comma separated list, e.g. "empty, peaks>30"...
+        rules     = self.playback_pause_rules
+        rules_str = ", ".join(( [ "empty" ] if rules['empty_segmask'] else [] ) +
+                              ( [ f"peaks>{rules['num_peaks_above']}" ] if rules['num_peaks_above'] is not None else [] ))
+        rules_str, is_ok = QtWidgets.QInputDialog.getText(self, "Playback", "Pause on (e.g. empty, peaks>30)", text = rules_str)
+        if not is_ok: return None
+
+        rules = { 'empty_segmask' : False, 'num_peaks_above' : None }
+        for rule in rules_str.split(","):
+            rule = rule.strip()
+            if rule == "": continue
+
+            if rule == "empty":
+                rules['empty_segmask'] = True
+            elif rule.startswith("peaks>"):
+                try:
+                    rules['num_peaks_above'] = int(rule[len("peaks>"):])
+                except ValueError:
+                    print(f"Oops!!! {rule} is not a valid pause rule.")
+                    return None
+            else:
+                print(f"Oops!!! {rule} is not a valid pause rule.")
+                return None
+
+        self.playback_fps         = fps
+        self.playback_pause_rules = rules
+
+        return None
+
+
     ################
     ### MENU BAR ###
     ################
@@ -433,7 +728,7 @@ class Window(QtWidgets.QMainWindow):
         if os.path.exists(path_pickle):
             with open(path_pickle, 'rb') as fh:
                 obj_saved = pickle.load(fh)
-                self.data_manager.layer_manager = obj_saved[0]
+                self.data_manager.set_layer_manager(obj_saved[0])
                 self.data_manager.state_random  = obj_saved[1]
                 self.idx_img                    = obj_saved[2]
                 self.timestamp                  = obj_saved[3]
@@ -456,12 +751,21 @@ class Window(QtWidgets.QMainWindow):
         )
 
         if is_confirmed == QtWidgets.QMessageBox.Yes:
-            self.data_manager.save_buffered_segmask()
+            saved_idx_list = self.data_manager.save_buffered_segmask()
+            self.invalidateThumbnails(saved_idx_list)
             self.dispImg()
 
         return None
 
 
+    def exportTraceDialog(self):
+        path_json, _ = QtWidgets.QFileDialog.getSaveFileName(self, 'Export Trace', f'{self.timestamp}.trace.json')
+
+        if path_json: perf.export_trace(path_json)
+
+        return None
+
+
     def selectActiveLayerDialog(self):
         idx, is_ok = QtWidgets.QInputDialog.getText(self, "Activate label", "Activate label")
 
@@ -471,6 +775,94 @@ class Window(QtWidgets.QMainWindow):
         return None
 
 
+    def runWithProgress(self, title, func, *args, **kwargs):
+        ''' Run func with a progress dialog, where func reports progress
+            through a callback keyword argument.
+        '''
+        dialog = QtWidgets.QProgressDialog(title, "Cancel", 0, 100, self)
+        dialog.setWindowModality(QtCore.Qt.WindowModal)
+        dialog.setMinimumDuration(500)
+
+        def callback(num_done, num_total):
+            dialog.setMaximum(max(num_total, 1))
+            dialog.setValue(num_done)
+            QtWidgets.QApplication.processEvents()
+
+            return not dialog.wasCanceled()
+
+        try:
+            return func(*args, callback = callback, **kwargs)
+        finally:
+            dialog.close()
+
+
+    def propagateRegionDialog(self):
+        from .propagate import get_idx_list, propagate_region, get_idx_changed_list
+
+        layer_manager  = self.data_manager.layer_manager
+        layer_active   = layer_manager['layer_active']
+        layer_metadata = layer_manager['layer_metadata']
+
+        # The region is either the last rectangle/polygon or a whole layer...
+        source_list = [ "last rectangle/polygon" ] if self.last_region is not None else []
+        source_list += [ f"layer {encode}: {layer_metadata[encode]['name']}" for encode in layer_manager['layer_order'] if encode != 0 ]
+        source, is_ok = QtWidgets.QInputDialog.getItem(self, "Propagate", "Region", source_list, 0, False)
+        if not is_ok: return None
+
+        if source == "last rectangle/polygon":
+            region = self.last_region
+            layer  = layer_active
+        else:
+            layer  = int(source[len("layer "):source.find(":")])
+            region = np.asarray(self.data_manager.is_labeled(self.label[0], layer))
+
+        if not region.any():
+            print(f"Oops!!! The region is empty.")
+            return None
+
+        expr, is_ok = QtWidgets.QInputDialog.getText(self, "Propagate", "Events (e.g. 0-99, 120, 200-, peaks>10, same file)",
+                                                     text = f"{self.idx_img + 1}-, same file")
+        if not is_ok: return None
+
+        action, is_ok = QtWidgets.QInputDialog.getItem(self, "Propagate", f"Layer {layer_metadata[layer]['name']}", [ "Label", "Erase" ], 0, False)
+        if not is_ok: return None
+
+        try:
+            idx_list = get_idx_list(expr, self.data_manager, self.idx_img)
+        except ValueError:
+            print(f"Oops!!! {expr} is not a valid event expression.")
+            return None
+
+        record = self.runWithProgress(f"Propagating to {len(idx_list)} events...", propagate_region,
+                                      self.data_manager, region, layer, idx_list, erases = action == "Erase")
+        self.propagation_list.append(record)
+
+        idx_changed_list = get_idx_changed_list(record, self.data_manager)
+        if len(idx_changed_list) > 0: self.invalidateThumbnails(idx_changed_list)
+        print(f"The region is propagated to {len(record['buffer_list']) + len(idx_changed_list)} events.")
+
+        self.dispImg(requires_refresh_img = False)
+
+        return None
+
+
+    def undoPropagation(self):
+        from .propagate import undo_propagation, get_idx_changed_list
+
+        if len(self.propagation_list) == 0: return None
+
+        record = self.propagation_list.pop()
+        self.runWithProgress("Undoing the propagation...", undo_propagation, self.data_manager, record)
+
+        idx_changed_list = get_idx_changed_list(record, self.data_manager)
+        if len(idx_changed_list) > 0: self.invalidateThumbnails(idx_changed_list)
+        print(f"The last propagation is undone.")
+
+        self.dispImg(requires_refresh_img = False)
+
+        return None
+
+
     def goEventDialog(self):
         idx, is_ok = QtWidgets.QInputDialog.getText(self, "Enter the event number to go", "Enter the event number to go")
 
@@ -496,12 +888,28 @@ class Window(QtWidgets.QMainWindow):
         fileMenu.addAction(self.saveAction)
         ## fileMenu.addAction(self.loadDataAction)
         fileMenu.addAction(self.saveDataAction)
+        fileMenu.addAction(self.exportTraceAction)
+
+        # Edit menu
+        editMenu = QtWidgets.QMenu("&Edit", self)
+        menuBar.addMenu(editMenu)
+
+        editMenu.addAction(self.propagateAction)
+        editMenu.addAction(self.undoPropagationAction)
 
         # Go menu
         goMenu = QtWidgets.QMenu("&Go", self)
         menuBar.addMenu(goMenu)
 
         goMenu.addAction(self.goAction)
+        goMenu.addAction(self.galleryAction)
+
+        # Playback menu
+        playbackMenu = QtWidgets.QMenu("&Playback", self)
+        menuBar.addMenu(playbackMenu)
+
+        playbackMenu.addAction(self.playbackAction)
+        playbackMenu.addAction(self.playbackConfigAction)
 
         return None
 
@@ -519,9 +927,27 @@ class Window(QtWidgets.QMainWindow):
         self.saveDataAction = QtWidgets.QAction(self)
         self.saveDataAction.setText("&Save Segmask")
 
+        self.exportTraceAction = QtWidgets.QAction(self)
+        self.exportTraceAction.setText("&Export Perf Trace")
+
+        self.propagateAction = QtWidgets.QAction(self)
+        self.propagateAction.setText("&Propagate Region")
+
+        self.undoPropagationAction = QtWidgets.QAction(self)
+        self.undoPropagationAction.setText("&Undo Propagation")
+
         self.goAction = QtWidgets.QAction(self)
         self.goAction.setText("&Event")
 
+        self.galleryAction = QtWidgets.QAction(self)
+        self.galleryAction.setText("&Gallery")
+
+        self.playbackAction = QtWidgets.QAction(self)
+        self.playbackAction.setText("&Start/Stop")
+
+        self.playbackConfigAction = QtWidgets.QAction(self)
+        self.playbackConfigAction.setText("&Settings")
+
         return None
 
 
@@ -530,7 +956,15 @@ class Window(QtWidgets.QMainWindow):
         self.saveAction.triggered.connect(self.saveStateDialog)
         ## self.loadDataAction.triggered.connect(self.loadDataDialog)
         self.saveDataAction.triggered.connect(self.saveDataDialog)
+        self.exportTraceAction.triggered.connect(self.exportTraceDialog)
+
+        self.propagateAction.triggered.connect(self.propagateRegionDialog)
+        self.undoPropagationAction.triggered.connect(self.undoPropagation)
 
         self.goAction.triggered.connect(self.goEventDialog)
+        self.galleryAction.triggered.connect(self.showGallery)
+
+        self.playbackAction.triggered.connect(self.togglePlayback)
+        self.playbackConfigAction.triggered.connect(self.setPlaybackDialog)
 
         return None